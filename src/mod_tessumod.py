@@ -30,10 +30,11 @@ from messenger.proto.events import g_messengerEvents
 from PlayerEvents import g_playerEvents
 from VOIP.VOIPManager import VOIPManager
 
-from tessumod import mytsplugin, notifications, positional_audio, utils
+from tessumod import file_watch, mytsplugin, notifications, positional_audio, talk_states, utils
+from tessumod.file_writer import BackgroundFileWriter
 from tessumod.asyncore_utils import EventLoopAdapter
 from tessumod.http import HTTPClient
-from tessumod.keyvaluestorage import KeyValueStorage
+from tessumod.keyvaluestorage import JournaledKeyValueStorage
 from tessumod.settings import Settings
 from tessumod.ts3 import TS3Client
 from tessumod.user_cache import UserCache
@@ -44,22 +45,27 @@ on_player_speaking = Event.Event()
 PLUGIN_INFO_URL = "http://jhakonen.github.io/wot-teamspeak-mod/plugin_info.json"
 
 g_authentication_error = None
+g_file_watcher = None
+g_file_writer = None
 g_http_client = None
 g_keyvaluestorage = None
 g_minimap_ctrl = None
+g_player_resolutions = None
 g_positional_audio = None
 g_settings = None
 g_settings_timer = None
+g_speak_stop_timers = None
 g_talk_states = None
 g_ts = None
-g_ts_timer = None
+g_event_loop = None
 g_user_cache = None
 
 def init():
 	'''Mod's main entry point. Called by WoT's built-in mod loader.'''
 	try:
 		global g_ts, g_talk_states, g_minimap_ctrl, g_user_cache, g_positional_audio, g_keyvaluestorage
-		global g_authentication_error, g_settings, g_settings_timer, g_ts_timer, g_http_client
+		global g_authentication_error, g_settings, g_settings_timer, g_event_loop, g_http_client
+		global g_player_resolutions, g_file_watcher, g_file_writer, g_speak_stop_timers
 
 		g_authentication_error = False
 		utils.init()
@@ -68,26 +74,37 @@ def init():
 		# make sure that ini-folder exists
 		try:
 			os.makedirs(utils.get_ini_dir_path())
-			os.makedirs(os.path.join(utils.get_ini_dir_path(), "states"))
 		except os.error:
 			pass
 		settings_ini_path     = os.path.join(utils.get_ini_dir_path(), "tessu_mod.ini")
 		cache_ini_path        = os.path.join(utils.get_ini_dir_path(), "tessu_mod_cache.ini")
+		cache_db_path         = os.path.join(utils.get_ini_dir_path(), "tessu_mod_cache.db")
+		states_path           = os.path.join(utils.get_ini_dir_path(), "tessu_mod_states.jsonl")
 
 		# do all intializations here
-		g_settings = Settings(settings_ini_path)
+		g_file_watcher = file_watch.create_file_watcher()
+		g_settings = Settings(settings_ini_path, g_file_watcher)
 		g_settings.on_reloaded += load_settings
-		g_user_cache = UserCache(cache_ini_path)
+		g_file_writer = BackgroundFileWriter()
+		g_user_cache = UserCache(cache_ini_path, g_file_watcher, g_file_writer,
+			db_path = cache_db_path if g_settings.get_cache_backend() == "sqlite" else None)
 		g_user_cache.on_read_error += on_user_cache_read_error
+		# pairings made while resolving players are lost if cache is loaded
+		# again, resolve the players again to restore them
+		g_player_resolutions = utils.PlayerResolutionCache()
+		g_user_cache.on_loaded += g_player_resolutions.invalidate
+		utils.g_arena_index.on_players_changed += g_player_resolutions.invalidate
 		g_user_cache.init()
 
-		event_loop = EventLoopAdapter()
+		g_event_loop = EventLoopAdapter()
 
-		g_http_client = HTTPClient(event_loop)
+		g_http_client = HTTPClient(g_event_loop)
 
-		g_talk_states = {}
+		g_talk_states = talk_states.TalkStateStore()
+		g_talk_states.on_changed += on_talk_states_changed
+		g_speak_stop_timers = utils.TimerQueue()
 		g_minimap_ctrl = utils.MinimapMarkersController()
-		g_ts = TS3Client(event_loop)
+		g_ts = TS3Client(g_event_loop)
 
 		g_positional_audio = positional_audio.PositionalAudio(
 			ts_users      = g_ts.users_in_my_channel,
@@ -96,21 +113,26 @@ def init():
 
 		load_settings()
 
-		event_loop.set_polling_interval(g_settings.get_client_query_interval())
+		g_event_loop.set_polling_interval(
+			g_settings.get_client_query_interval(),
+			g_settings.get_client_query_idle_interval()
+		)
 
-		g_ts.set_apikey(g_settings.get_client_query_apikey())
+		g_ts.set_apikey(get_client_query_apikey())
 		g_ts.connect()
 		g_ts.on_connected += on_connected_to_ts3
 		g_ts.on_disconnected += on_disconnected_from_ts3
 		g_ts.on_connected_to_server += on_connected_to_ts3_server
 		g_ts.on_disconnected_from_server += on_disconnected_from_ts3_server
 		g_ts.on_authenticate_error += on_ts3_authenticate_error
+		g_ts.users.on_modified += on_ts3_user_modified
 		g_ts.users_in_my_channel.on_added += on_ts3_user_in_my_channel_added
 		g_ts.users_in_my_channel.on_modified += on_ts3_user_in_my_channel_modified
-		g_ts_timer = utils.call_in_loop(g_settings.get_client_query_interval(), g_ts.check_events)
+		g_event_loop.on_tick += g_ts.check_events
 
 		g_playerEvents.onAvatarReady           += g_positional_audio.enable
 		g_playerEvents.onAvatarBecomeNonPlayer += g_positional_audio.disable
+		g_playerEvents.onAvatarBecomeNonPlayer += utils.g_arena_index.reset
 
 		# don't show system center notifications in battle
 		g_playerEvents.onAvatarBecomePlayer    += partial(notifications.set_notifications_enabled, False)
@@ -133,7 +155,7 @@ def init():
 		notifications.add_event_handler(notifications.TSPLUGIN_MOREINFO, on_tsplugin_moreinfo_clicked)
 		notifications.add_event_handler(notifications.SETTINGS_PATH, on_settings_path_clicked)
 
-		g_keyvaluestorage = KeyValueStorage(utils.get_states_dir_path())
+		g_keyvaluestorage = JournaledKeyValueStorage(states_path, legacy_storage_path=utils.get_states_dir_path())
 
 		g_settings_timer = utils.call_in_loop(g_settings.get_ini_check_interval(), sync_configs)
 		print("TessuMod version {0} ({1})".format(utils.get_mod_version(), utils.get_support_url()))
@@ -146,14 +168,17 @@ def fini():
 	is exiting. Main reason why this is done though is for fute test suite,
 	allowing cleanup of the mod after each test.'''
 	global g_ts, g_talk_states, g_minimap_ctrl, g_user_cache, g_positional_audio, g_keyvaluestorage
-	global g_authentication_error, g_settings, g_settings_timer, g_ts_timer
+	global g_authentication_error, g_settings, g_settings_timer, g_event_loop
+	global g_player_resolutions, g_file_watcher, g_file_writer, g_speak_stop_timers
 
 	g_playerEvents.onAvatarReady           -= g_positional_audio.enable
 	g_playerEvents.onAvatarBecomeNonPlayer -= g_positional_audio.disable
+	g_playerEvents.onAvatarBecomeNonPlayer -= utils.g_arena_index.reset
 
 	g_messengerEvents.voip.onPlayerSpeaking = g_messengerEvents.voip.onPlayerSpeaking.get_original_event()
 
 	g_authentication_error = None
+	g_keyvaluestorage.fini()
 	g_keyvaluestorage = None
 	g_minimap_ctrl.fini()
 	g_minimap_ctrl = None
@@ -162,54 +187,78 @@ def fini():
 	g_settings = None
 	g_settings_timer.fini()
 	g_settings_timer = None
+	g_talk_states.fini()
 	g_talk_states = None
-	g_ts_timer.stop()
-	g_ts_timer = None
+	g_speak_stop_timers.fini()
+	g_speak_stop_timers = None
+	g_event_loop.fini()
+	g_event_loop = None
 	g_ts.fini()
 	g_ts = None
+	g_user_cache.fini()
 	g_user_cache = None
+	utils.g_arena_index.on_players_changed -= g_player_resolutions.invalidate
+	g_player_resolutions = None
+	g_file_writer.fini()
+	g_file_writer = None
+	g_file_watcher.fini()
+	g_file_watcher = None
 
 	utils.fini()
 
 def on_speak_status_changed(user):
 	'''Called when TeamSpeak user's speak status changes.'''
-	g_user_cache.add_ts_user(user.nick, user.unique_id)
+	matcher = utils.get_player_matcher(in_battle=True, in_prebattle=True)
+
+	def resolve_player():
+		g_user_cache.add_ts_user(user.nick, user.unique_id)
+		player = utils.ts_user_to_player(user,
+			use_metadata = g_settings.get_wot_nick_from_ts_metadata(),
+			use_ts_nick_search = g_settings.is_ts_nick_search_enabled(),
+			extract_patterns = g_settings.get_nick_extract_patterns(),
+			mappings = g_settings.get_name_mappings(),
+			players = matcher
+		)
+		if player:
+			g_user_cache.add_player(player.name, player.id)
+			g_user_cache.pair(player_id=player.id, ts_user_id=user.unique_id)
+		return player
 
-	player = utils.ts_user_to_player(user,
-		use_metadata = g_settings.get_wot_nick_from_ts_metadata(),
-		use_ts_nick_search = g_settings.is_ts_nick_search_enabled(),
-		extract_patterns = g_settings.get_nick_extract_patterns(),
-		mappings = g_settings.get_name_mappings(),
-		players = utils.get_players(in_battle=True, in_prebattle=True)
-	)
-
-	if player:
-		g_user_cache.add_player(player.name, player.id)
-		g_user_cache.pair(player_id=player.id, ts_user_id=user.unique_id)
+	g_player_resolutions.resolve(user, matcher, resolve_player)
 
 	for player_id in g_user_cache.get_paired_player_ids(user.unique_id):
-		talk_status(player_id, user.speaking)
-		if user.speaking:
+		# player may be paired to several TS users, or the TS user connected
+		# more than once, the player talks while any of those clients does
+		speaking = is_player_speaking_in_ts(player_id)
+		talk_status(player_id, speaking)
+		if speaking:
 			# set speaking state immediately
+			g_speak_stop_timers.cancel(player_id)
 			update_player_speak_status(player_id)
 		else:
-			# keep speaking state for a little longer
-			BigWorld.callback(g_settings.get_speak_stop_delay(), utils.with_args(update_player_speak_status, player_id))
+			# keep speaking state for a little longer, restarting the delay
+			# if the user stops speaking again before the delay has passed
+			g_speak_stop_timers.call_later(player_id, g_settings.get_speak_stop_delay(),
+				utils.with_args(update_player_speak_status, player_id))
+
+def is_player_speaking_in_ts(player_id):
+	users = g_ts.users_in_my_channel
+	for ts_user_id in g_user_cache.get_paired_ts_user_ids(player_id):
+		for client_id in users.client_ids_by_unique_id(ts_user_id):
+			if users[client_id].speaking:
+				return True
+	return False
 
 def talk_status(player_id, talking=None):
 	if talking is not None:
-		g_talk_states[player_id] = talking
-	try:
-		return g_talk_states[player_id]
-	except:
-		return False
+		g_talk_states.set_talking(player_id, talking)
+	return g_talk_states.is_talking(player_id)
 
 def update_player_speak_status(player_id):
 	'''Updates given 'player_id's talking status to VOIP system and minimap.'''
 	try:
 		talking = talk_status(player_id)
-		on_player_speaking(player_id, talking)
-		g_messengerEvents.voip.onPlayerSpeaking.unfiltered_call(player_id, talking and is_voice_chat_speak_allowed(player_id))
+		g_talk_states.publish(player_id, talking, talking and is_voice_chat_speak_allowed(player_id))
 	except:
 		LOG_CURRENT_EXCEPTION()
 
@@ -231,6 +280,17 @@ def update_player_speak_status(player_id):
 	except:
 		LOG_CURRENT_EXCEPTION()
 
+def on_talk_states_changed(changes):
+	'''Called with players whose published talk state has changed, at most
+	once per frame.
+	'''
+	for player_id, talking, voice_chat_talking in changes:
+		try:
+			on_player_speaking(player_id, talking)
+			g_messengerEvents.voip.onPlayerSpeaking.unfiltered_call(player_id, voice_chat_talking)
+		except:
+			LOG_CURRENT_EXCEPTION()
+
 def is_voice_chat_speak_allowed(player_id):
 	if not g_settings.is_voice_chat_notifications_enabled():
 		return False
@@ -247,15 +307,9 @@ def is_minimap_speak_allowed(player_id):
 
 def clear_speak_statuses():
 	'''Clears speak status of all players.'''
-	players_speaking = [id for id in g_talk_states if g_talk_states[id]]
-	g_talk_states.clear()
+	g_speak_stop_timers.cancel_all()
 	g_minimap_ctrl.stop_all()
-
-	for id in players_speaking:
-		try:
-			g_messengerEvents.voip.onPlayerSpeaking.unfiltered_call(id, False)
-		except:
-			pass
+	g_talk_states.reset()
 
 def on_connected_to_ts3():
 	'''Called when TessuMod manages to connect TeamSpeak client. However, this
@@ -463,6 +517,9 @@ def on_ts3_authenticate_error():
 def on_ts3_user_in_my_channel_added(client_id):
 	on_speak_status_changed(g_ts.users[client_id])
 
+def on_ts3_user_modified(client_id):
+	g_player_resolutions.invalidate_user(g_ts.users[client_id])
+
 def on_ts3_user_in_my_channel_modified(client_id):
 	on_speak_status_changed(g_ts.users[client_id])
 
@@ -476,7 +533,18 @@ def load_settings():
 	utils.CURRENT_LOG_LEVEL = g_settings.get_log_level()
 	g_ts.HOST = g_settings.get_client_query_host()
 	g_ts.PORT = g_settings.get_client_query_port()
-	g_ts.set_apikey(g_settings.get_client_query_apikey())
+	g_ts.set_apikey(get_client_query_apikey())
+	g_ts.set_pipelined_commands(g_settings.is_client_query_pipelining_enabled())
+	g_user_cache.write_delay = g_settings.get_cache_write_delay()
+	g_player_resolutions.invalidate()
+
+def get_client_query_apikey():
+	apikey = g_settings.get_client_query_apikey()
+	if apikey is None:
+		# option missing from ini-file, authenticating with an empty key
+		# notifies user the same way as when the key is not filled in
+		return u""
+	return apikey
 
 def sync_configs():
 	g_user_cache.sync()
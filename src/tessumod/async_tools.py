@@ -20,6 +20,8 @@ Idea for API comes from Caolan McMahon's javascript library with same name:
 https://github.com/caolan/async
 '''
 
+import functools
+
 def series(actions, callback):
 	Series(actions, callback).call_next()
 
@@ -45,3 +47,40 @@ class Series(object):
 		elif data:
 			self._datas.append(data)
 		self.call_next()
+
+def parallel(actions, callback):
+	Parallel(actions, callback).call_all()
+
+class Parallel(object):
+
+	def __init__(self, actions, callback):
+		self._actions = actions
+		self._callback = callback
+		self._datas = [None] * len(actions)
+		self._pending_count = len(actions)
+		self._is_done = False
+
+	def call_all(self):
+		if not self._actions:
+			self._finish(None, None)
+		for index, action in enumerate(self._actions):
+			# stop dispatching once an action has failed
+			if self._is_done:
+				break
+			action(functools.partial(self._action_callback, index))
+
+	def _action_callback(self, index, err, data):
+		if self._is_done:
+			return
+		if err:
+			self._finish(err, data)
+		else:
+			self._datas[index] = data
+			self._pending_count -= 1
+			if self._pending_count == 0:
+				datas = [data for data in self._datas if data]
+				self._finish(None, datas if datas else None)
+
+	def _finish(self, err, data):
+		self._is_done = True
+		self._callback(err, data)
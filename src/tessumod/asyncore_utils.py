@@ -21,28 +21,109 @@ import collections
 import errno
 import socket
 
-from .utils import RepeatTimer, LOG_NOTE, LOG_WARNING, LOG_ERROR
+import BigWorld
+import Event
+
+from .utils import LOG_NOTE, LOG_WARNING, LOG_ERROR
+
+# Error codes which tell that non-blocking socket operation would block
+_WOULD_BLOCK_ERRORS = frozenset(getattr(errno, name) for name in
+	("EAGAIN", "EWOULDBLOCK", "WSAEWOULDBLOCK") if hasattr(errno, name))
+
+# Upper limit of socket reads done for a single socket per poll, keeps a
+# flooding peer from stalling the game
+_MAX_READS_PER_POLL = 64
+
+# Shortest polling interval used when backing off from zero interval
+_MIN_BACKOFF_INTERVAL = 0.01
+
+# Longest polling interval used when idle, first traffic after idle period
+# is noticed at latest after this many seconds
+MAX_IDLE_POLLING_INTERVAL = 0.1
 
 class EventLoopAdapter(object):
+	'''Runs asyncore's event loop in BigWorld's callbacks.
+
+	Sockets are polled with the polling interval as long as there is traffic
+	or some socket is busy (see AsynchatExtended.is_busy()). When idle, the
+	interval is doubled on each poll up to the idle polling interval, which is
+	capped to MAX_IDLE_POLLING_INTERVAL to keep speak notifications from
+	lagging after a quiet period. Any traffic brings the interval straight back to the polling interval.
+
+	Listeners of 'on_tick' event are called after each poll, so periodic work
+	related to the sockets can be done in the same scheduler.
+	'''
 
 	def __init__(self):
 		self.socket_map = SocketMapNotifier(self._on_socket_map_changed)
-		self._timer = None
+		self.on_tick = Event.Event()
+		self._polling_interval = None
+		self._idle_polling_interval = None
+		self._interval = None
+		self._callback_id = None
+		self._running = False
+		self._in_poll = False
+		self._activity = False
 
-	def set_polling_interval(self, interval):
-		self._timer = RepeatTimer(interval)
-		self._timer.on_timeout += self._call_asyncore_loop
+	def set_polling_interval(self, interval, idle_interval=None):
+		'''Sets polling interval and starts polling. If 'idle_interval' is
+		given and longer than 'interval', polling backs off up to it while
+		there is no traffic.
+		'''
+		self._polling_interval = interval
+		self._idle_polling_interval = max(interval, min(idle_interval or interval, MAX_IDLE_POLLING_INTERVAL))
+		self._interval = interval
+		self._running = True
+		self._schedule_poll()
 
-	def _on_socket_map_changed(self, count):
-		if not self._timer:
+	def fini(self):
+		self._running = False
+		self._cancel_poll()
+		self.on_tick.clear()
+
+	def notify_activity(self):
+		'''Tells that there is traffic in sockets. Tightens polling back to
+		the polling interval.
+		'''
+		self._activity = True
+		if self._in_poll or not self._running:
 			return
+		if self._interval > self._polling_interval:
+			self._interval = self._polling_interval
+			self._schedule_poll()
+
+	def _on_socket_map_changed(self, count):
 		if count:
-			self._timer.start()
-		else:
-			self._timer.stop()
+			self.notify_activity()
+
+	def _schedule_poll(self):
+		self._cancel_poll()
+		if self._running:
+			self._callback_id = BigWorld.callback(self._interval, self._poll)
 
-	def _call_asyncore_loop(self):
-		asyncore.loop(timeout=0, count=1, map=self.socket_map)
+	def _cancel_poll(self):
+		if self._callback_id is not None:
+			try:
+				BigWorld.cancelCallback(self._callback_id)
+			except ValueError:
+				pass
+			self._callback_id = None
+
+	def _poll(self):
+		self._callback_id = None
+		self._activity = False
+		self._in_poll = True
+		try:
+			if self.socket_map:
+				asyncore.loop(timeout=0, count=1, map=self.socket_map)
+			self.on_tick()
+			if self._activity or any(dispatcher.is_busy() for dispatcher in self.socket_map.values()):
+				self._interval = self._polling_interval
+			else:
+				self._interval = min(self._idle_polling_interval, max(self._interval * 2, _MIN_BACKOFF_INTERVAL))
+		finally:
+			self._in_poll = False
+			self._schedule_poll()
 
 class SocketMapNotifier(collections.MutableMapping):
 
@@ -67,25 +148,96 @@ class SocketMapNotifier(collections.MutableMapping):
 	def __len__(self):
 		return len(self._map)
 
+class LineFramer(object):
+	'''Splits received bytes to lines separated by 'terminator'.
+
+	Data is collected to a single bytearray and each line is decoded only
+	once it is complete, so lines arriving in many pieces are not
+	concatenated over and over again, and multi-byte characters split between
+	pieces are decoded correctly.
+	'''
+
+	def __init__(self, terminator, encoding="utf-8"):
+		self._terminator = terminator
+		self._encoding = encoding
+		self._buffer = bytearray()
+		self._search_start = 0
+
+	def feed(self, data):
+		'''Adds received 'data' and returns list of lines completed by it.'''
+		buffer = self._buffer
+		buffer.extend(data)
+		terminator = self._terminator
+		lines = []
+		start = 0
+		end = buffer.find(terminator, self._search_start)
+		while end != -1:
+			lines.append(buffer[start:end].decode(self._encoding))
+			start = end + len(terminator)
+			end = buffer.find(terminator, start)
+		if start:
+			del buffer[:start]
+		# terminator may be split between this and next data
+		self._search_start = max(0, len(buffer) - len(terminator) + 1)
+		return lines
+
+	def reset(self):
+		'''Discards any partially received line.'''
+		del self._buffer[:]
+		self._search_start = 0
+
 class AsynchatExtended(asynchat.async_chat):
 
 	def __init__(self, event_loop):
 		asynchat.async_chat.__init__(self, map=event_loop.socket_map)
+		self._event_loop = event_loop
+		self._would_block = False
+
+	def is_busy(self):
+		'''Returns True if traffic is expected soon, keeping event loop's
+		polling at full rate. Override in subclasses.
+		'''
+		return True
+
+	def handle_read(self):
+		'''Drains all data readable from the socket at once, instead of
+		reading just one buffer's worth per poll.
+		'''
+		self._would_block = False
+		for _ in range(_MAX_READS_PER_POLL):
+			asynchat.async_chat.handle_read(self)
+			if self._would_block or not self.connected:
+				break
+
+	def recv(self, buffer_size):
+		try:
+			data = asynchat.async_chat.recv(self, buffer_size)
+		except socket.error as err:
+			if err.args[0] in _WOULD_BLOCK_ERRORS:
+				self._would_block = True
+				return b""
+			raise
+		if data:
+			self._event_loop.notify_activity()
+		return data
 
 	def send(self, data):
 		try:
-			return asynchat.async_chat.send(self, data)
+			sent = asynchat.async_chat.send(self, data)
 		except socket.error as err:
-			if err.args[0] == errno.WSAEWOULDBLOCK:
+			if err.args[0] in _WOULD_BLOCK_ERRORS:
 				return 0
 			raise
+		if sent:
+			self._event_loop.notify_activity()
+		return sent
 
 	def connect(self, address):
 		try:
 			self._opened = True
 			return asynchat.async_chat.connect(self, address)
 		except socket.error as err:
-			if err.args[0] == errno.WSAEWOULDBLOCK:
+			if err.args[0] in _WOULD_BLOCK_ERRORS:
 				self.addr = address
 				return
 			raise
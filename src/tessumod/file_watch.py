@@ -0,0 +1,285 @@
+# TessuMod: Mod for integrating TeamSpeak into World of Tanks
+# Copyright (C) 2019  Janne Hakonen
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import errno
+import os
+import struct
+import sys
+import time
+
+from .py3compat import text_type
+from .utils import LOG_DEBUG
+
+# Changed file is reported only after it has not been modified for this many
+# seconds, so that an editor saving the file several times in a row causes
+# only one reload
+DEBOUNCE_DELAY = 0.5
+
+def create_file_watcher(debounce=DEBOUNCE_DELAY):
+	'''Returns file watcher with the best backend available on this platform.
+	Falls back to polling file stats if the platform has no supported
+	change notification API.
+	'''
+	if sys.platform.startswith("linux"):
+		try:
+			return FileWatcher(InotifyBackend(), debounce)
+		except Exception as error:
+			LOG_DEBUG("inotify not available, polling file stats instead: {0}".format(error))
+	return FileWatcher(StatPollingBackend(), debounce)
+
+class FileWatcher(object):
+	'''Tracks changes to a set of files.
+
+	Owners of watched files ask if their file has changed with
+	FileWatch.check(). With an event based backend this doesn't touch the
+	file system at all unless there has been a change.
+	'''
+
+	def __init__(self, backend=None, debounce=DEBOUNCE_DELAY):
+		self._backend = backend if backend is not None else StatPollingBackend()
+		self._debounce = debounce
+		self._pending = set()
+
+	def watch(self, path):
+		self._backend.add(path)
+		return FileWatch(self, path)
+
+	def unwatch(self, path):
+		self._backend.remove(path)
+		self._pending.discard(path)
+
+	def check(self, path):
+		'''Returns True if file in 'path' has changed since previous call
+		or acknowledge() and the change has settled.
+		'''
+		self._pending.update(self._backend.read_changes(path))
+		if path not in self._pending or not self._is_settled(path):
+			return False
+		self._pending.discard(path)
+		return True
+
+	def acknowledge(self, path):
+		'''Marks file in 'path' as up to date, e.g. after it has been read or
+		written by its owner.
+		'''
+		self._pending.update(self._backend.acknowledge(path))
+		self._pending.discard(path)
+
+	def _is_settled(self, path):
+		try:
+			age = time.time() - os.path.getmtime(path)
+		except OSError:
+			return True
+		# modification time in future (e.g. clock skew with network drive)
+		# cannot be waited out, consider such file settled
+		return age >= self._debounce or age < 0
+
+	def fini(self):
+		self._backend.fini()
+		self._pending.clear()
+
+class FileWatch(object):
+	'''Handle to a single file watched by FileWatcher.'''
+
+	def __init__(self, watcher, path):
+		self._watcher = watcher
+		self.path = path
+
+	def check(self):
+		return self._watcher.check(self.path)
+
+	def acknowledge(self):
+		self._watcher.acknowledge(self.path)
+
+	def close(self):
+		self._watcher.unwatch(self.path)
+
+class StatPollingBackend(object):
+	'''Detects changes by comparing file's modification time and size on
+	each check. Works everywhere, but costs a stat per check.
+	'''
+
+	def __init__(self):
+		self._signatures = {}
+
+	def add(self, path):
+		self._signatures[path] = self._get_signature(path)
+
+	def remove(self, path):
+		self._signatures.pop(path, None)
+
+	def read_changes(self, path):
+		if path not in self._signatures:
+			return ()
+		signature = self._get_signature(path)
+		if signature == self._signatures[path]:
+			return ()
+		self._signatures[path] = signature
+		return (path,)
+
+	def acknowledge(self, path):
+		if path in self._signatures:
+			self._signatures[path] = self._get_signature(path)
+		return ()
+
+	def fini(self):
+		self._signatures.clear()
+
+	def _get_signature(self, path):
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		return (stat.st_mtime, stat.st_size)
+
+# Flags from <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_NONBLOCK    = 0x00000800
+IN_CLOEXEC     = 0x00080000
+
+# Directories are watched instead of files so that editors which save by
+# renaming a temporary file over the original are noticed as well
+_INOTIFY_DIR_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+	| IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+_INOTIFY_EVENT = struct.Struct("iIII")
+_INOTIFY_READ_SIZE = 64 * 1024
+
+class InotifyBackend(object):
+	'''Receives file change notifications from Linux kernel's inotify API,
+	called with ctypes. Checking for changes is a single non-blocking read().
+	'''
+
+	def __init__(self):
+		import ctypes
+		import ctypes.util
+		self._libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+		self._get_errno = ctypes.get_errno
+		self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self._fd < 0:
+			self._raise_error()
+		self._paths = {}
+		self._dir_wds = {}
+		self._wd_files = {}
+		self._unwatched_dirs = set()
+
+	def add(self, path):
+		dir_path, name = os.path.split(os.path.abspath(path))
+		self._paths[path] = (dir_path, _encode_path(name))
+		wd = self._dir_wds.get(dir_path)
+		if wd is not None:
+			self._wd_files[wd].setdefault(self._paths[path][1], set()).add(path)
+		elif dir_path not in self._unwatched_dirs:
+			self._add_dir_watch(dir_path)
+
+	def remove(self, path):
+		dir_path, name = self._paths.pop(path, (None, None))
+		wd = self._dir_wds.get(dir_path)
+		if wd is None:
+			return
+		paths = self._wd_files[wd].get(name, set())
+		paths.discard(path)
+		if not paths:
+			self._wd_files[wd].pop(name, None)
+		if not self._wd_files[wd]:
+			self._libc.inotify_rm_watch(self._fd, wd)
+			del self._wd_files[wd]
+			del self._dir_wds[dir_path]
+
+	def read_changes(self, path):
+		changed = set()
+		for dir_path in list(self._unwatched_dirs):
+			if self._add_dir_watch(dir_path):
+				changed.update(self._get_paths_in_dir(dir_path))
+		while self._fd is not None:
+			try:
+				data = os.read(self._fd, _INOTIFY_READ_SIZE)
+			except OSError as error:
+				if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				raise
+			if not data:
+				break
+			self._parse_events(data, changed)
+		return changed
+
+	def acknowledge(self, path):
+		# drain events caused by the owner itself, changes to other files
+		# are returned so that they are not lost
+		return self.read_changes(path)
+
+	def fini(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+		self._paths.clear()
+		self._dir_wds.clear()
+		self._wd_files.clear()
+		self._unwatched_dirs.clear()
+
+	def _parse_events(self, data, changed):
+		offset = 0
+		while offset + _INOTIFY_EVENT.size <= len(data):
+			wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+			offset += _INOTIFY_EVENT.size
+			name = data[offset:offset + length].rstrip(b"\0")
+			offset += length
+			if mask & IN_Q_OVERFLOW:
+				# events were lost, anything may have changed
+				changed.update(self._paths)
+			elif mask & IN_IGNORED:
+				# watched directory was removed, try to watch it again later
+				for dir_path, dir_wd in list(self._dir_wds.items()):
+					if dir_wd == wd:
+						changed.update(self._get_paths_in_dir(dir_path))
+						del self._dir_wds[dir_path]
+						self._unwatched_dirs.add(dir_path)
+				self._wd_files.pop(wd, None)
+			else:
+				changed.update(self._wd_files.get(wd, {}).get(name, ()))
+
+	def _add_dir_watch(self, dir_path):
+		wd = self._libc.inotify_add_watch(self._fd, _encode_path(dir_path), _INOTIFY_DIR_MASK)
+		if wd < 0:
+			self._unwatched_dirs.add(dir_path)
+			return False
+		self._unwatched_dirs.discard(dir_path)
+		self._dir_wds[dir_path] = wd
+		files = self._wd_files.setdefault(wd, {})
+		for path in self._get_paths_in_dir(dir_path):
+			files.setdefault(self._paths[path][1], set()).add(path)
+		return True
+
+	def _get_paths_in_dir(self, dir_path):
+		return [path for path, (path_dir, _) in self._paths.items() if path_dir == dir_path]
+
+	def _raise_error(self):
+		error = self._get_errno()
+		raise OSError(error, os.strerror(error))
+
+def _encode_path(path):
+	if isinstance(path, text_type):
+		return path.encode(sys.getfilesystemencoding() or "utf8")
+	return path
@@ -0,0 +1,172 @@
+# TessuMod: Mod for integrating TeamSpeak into World of Tanks
+# Copyright (C) 2019  Janne Hakonen
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import collections
+import io
+import os
+import sys
+import threading
+
+from .py3compat import to_unicode
+from .utils import LOG_ERROR
+
+def replace_file(src_path, dst_path):
+	'''Moves file in 'src_path' over 'dst_path', replacing it atomically.'''
+	if hasattr(os, "replace"):
+		os.replace(src_path, dst_path)
+	elif sys.platform == "win32":
+		# Python 2's os.rename() refuses to replace existing files on Windows
+		import ctypes
+		MOVEFILE_REPLACE_EXISTING = 0x1
+		MOVEFILE_WRITE_THROUGH = 0x8
+		if not ctypes.windll.kernel32.MoveFileExW(to_unicode(src_path), to_unicode(dst_path),
+				MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+			raise ctypes.WinError()
+	else:
+		os.rename(src_path, dst_path)
+
+def write_file_atomically(path, contents):
+	'''Writes unicode 'contents' to file in 'path'. The file is written to a
+	temporary file first and then renamed over the original, so a crash in
+	middle of writing never leaves a partially written file behind.
+	'''
+	tmp_path = path + ".tmp"
+	try:
+		with io.open(tmp_path, "wt", encoding="utf8") as f:
+			f.write(contents)
+			f.flush()
+			os.fsync(f.fileno())
+		replace_file(tmp_path, path)
+	except:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+class FileWriter(object):
+	'''Renders and writes files immediately when write() is called.
+
+	Contents are produced by calling 'render' function with 'snapshot' given
+	to write(). The file is not touched if the rendered contents equal to
+	what was written previously.
+	'''
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._last_contents = {}
+		self._finished = []
+
+	def write(self, path, render, snapshot):
+		self.write_now(path, render, snapshot)
+
+	def write_now(self, path, render, snapshot):
+		'''Renders and writes file in 'path' in the calling thread.'''
+		self._render_and_write(path, render, snapshot)
+		with self._lock:
+			self._finished.append(path)
+
+	def is_writing(self, path):
+		'''Returns True if write to 'path' is still pending.'''
+		return False
+
+	def pop_finished(self):
+		'''Returns paths of files written since previous call.'''
+		with self._lock:
+			finished, self._finished = self._finished, []
+		return finished
+
+	def forget(self, path):
+		'''Forgets what was written to 'path', e.g. after the file has been
+		modified by someone else, so that the next write is not skipped.
+		'''
+		with self._lock:
+			self._last_contents.pop(path, None)
+
+	def fini(self):
+		pass
+
+	def _render_and_write(self, path, render, snapshot):
+		try:
+			contents = render(snapshot)
+			with self._lock:
+				if self._last_contents.get(path) == contents:
+					return
+			write_file_atomically(path, contents)
+			with self._lock:
+				self._last_contents[path] = contents
+		except Exception as error:
+			LOG_ERROR(u"Failed to write file '{0}', reason: {1}".format(path, to_unicode(error)))
+
+class BackgroundFileWriter(FileWriter):
+	'''Renders and writes files in a background thread, keeping file I/O
+	off the game thread. If a new write to a file is requested before the
+	previous one has started, only the latest one is done.
+	'''
+
+	def __init__(self):
+		super(BackgroundFileWriter, self).__init__()
+		self._condition = threading.Condition(self._lock)
+		self._jobs = collections.OrderedDict()
+		self._current_path = None
+		self._thread = None
+		self._stopping = False
+
+	def write(self, path, render, snapshot):
+		with self._condition:
+			if self._stopping:
+				return
+			self._jobs[path] = (render, snapshot)
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name="TessuModFileWriter")
+				self._thread.daemon = True
+				self._thread.start()
+			self._condition.notify()
+
+	def write_now(self, path, render, snapshot):
+		with self._condition:
+			# make sure that an older snapshot doesn't get written over this one
+			self._jobs.pop(path, None)
+			while self._current_path == path:
+				self._condition.wait()
+		super(BackgroundFileWriter, self).write_now(path, render, snapshot)
+
+	def is_writing(self, path):
+		with self._condition:
+			return path in self._jobs or path == self._current_path
+
+	def fini(self):
+		'''Writes all pending files and stops the background thread.'''
+		with self._condition:
+			self._stopping = True
+			self._condition.notify()
+			thread = self._thread
+		if thread is not None:
+			thread.join()
+
+	def _run(self):
+		while True:
+			with self._condition:
+				while not self._jobs and not self._stopping:
+					self._condition.wait()
+				if not self._jobs:
+					return
+				path, (render, snapshot) = self._jobs.popitem(last=False)
+				self._current_path = path
+			self._render_and_write(path, render, snapshot)
+			with self._condition:
+				self._current_path = None
+				self._finished.append(path)
+				self._condition.notify_all()
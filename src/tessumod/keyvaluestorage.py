@@ -16,9 +16,16 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 import collections
+import io
 import json
 import os
 
+import BigWorld
+
+from .file_writer import write_file_atomically
+from .py3compat import to_unicode
+from .utils import LOG_ERROR, LOG_NOTE
+
 class KeyValueStorage(collections.MutableMapping):
 
 	def __init__(self, storage_path):
@@ -58,3 +65,146 @@ class KeyValueStorage(collections.MutableMapping):
 
 	def __len__(self):
 		return len(self.__cache_mapping)
+
+class JournaledKeyValueStorage(collections.MutableMapping):
+	'''Stores all keys into a single journal file.
+
+	Each line in the journal is a JSON object with a key and either its value
+	or a deletion mark, and later lines override earlier ones. Changes are
+	collected and appended to the journal after 'flush_delay' seconds. When
+	the journal has grown enough it is compacted by writing one line per key
+	to a temporary file and renaming it over the journal.
+
+	If the journal doesn't exist yet, keys are migrated from
+	'legacy_storage_path' where earlier versions stored each key into its own
+	file, named after the key and containing the value as JSON (see
+	KeyValueStorage). The legacy files are left in place, so that an earlier
+	version of the mod still finds them. Until the migrated keys have been
+	written to the journal, the legacy files stay authoritative and are
+	migrated again on next start.
+
+	Appends to the journal are not synced to disk, a line partially written
+	when the game crashes is ignored when the journal is loaded.
+	'''
+
+	# journal is compacted when it has this many lines more than there are keys
+	COMPACT_THRESHOLD = 100
+
+	def __init__(self, file_path, legacy_storage_path=None, flush_delay=1.0):
+		self.__file_path = file_path
+		self.__flush_delay = flush_delay
+		self.__cache_mapping = {}
+		self.__dirty_lines = collections.OrderedDict()
+		self.__journal_length = 0
+		self.__compact_needed = False
+		self.__flush_callback_id = None
+		if os.path.isfile(file_path):
+			self.__load_journal()
+		elif legacy_storage_path is not None and os.path.isdir(legacy_storage_path):
+			self.__migrate(legacy_storage_path)
+
+	def __load_journal(self):
+		corrupted = False
+		with io.open(self.__file_path, "rt", encoding="utf8") as file:
+			for line in file:
+				try:
+					entry = json.loads(line)
+					if "deleted" in entry:
+						self.__cache_mapping.pop(entry["key"], None)
+					else:
+						self.__cache_mapping[entry["key"]] = entry["value"]
+				except (ValueError, KeyError, TypeError):
+					# e.g. partially written line if the game crashed while
+					# appending to the journal
+					corrupted = True
+				self.__journal_length += 1
+		if corrupted:
+			LOG_ERROR(u"Ignored invalid lines in file '{0}'".format(self.__file_path))
+			self.__compact_needed = True
+			self.__schedule_flush()
+
+	def __migrate(self, legacy_storage_path):
+		for filename in os.listdir(legacy_storage_path):
+			filepath = os.path.join(legacy_storage_path, filename)
+			if os.path.isfile(filepath):
+				with open(filepath, "r") as file:
+					self.__cache_mapping[filename] = json.loads(file.read())
+		try:
+			self.__compact()
+		except Exception as error:
+			LOG_ERROR(u"Failed to write file '{0}', reason: {1}".format(self.__file_path, to_unicode(error)))
+			# journal is not written at all before compaction succeeds
+			self.__compact_needed = True
+			self.__schedule_flush()
+			return
+		LOG_NOTE(u"Migrated {0} keys from '{1}' to '{2}'".format(
+			len(self.__cache_mapping), legacy_storage_path, self.__file_path))
+
+	def __getitem__(self, key):
+		return self.__cache_mapping[key]
+
+	def __setitem__(self, key, value):
+		# serialized right away, so that modifying the value afterwards
+		# doesn't change what gets stored
+		line = json.dumps({"key": key, "value": value})
+		self.__cache_mapping[key] = value
+		self.__set_dirty(key, line)
+
+	def __delitem__(self, key):
+		del self.__cache_mapping[key]
+		self.__set_dirty(key, json.dumps({"key": key, "deleted": True}))
+
+	def __iter__(self):
+		return iter(self.__cache_mapping)
+
+	def __len__(self):
+		return len(self.__cache_mapping)
+
+	def __set_dirty(self, key, line):
+		self.__dirty_lines.pop(key, None)
+		self.__dirty_lines[key] = line
+		self.__schedule_flush()
+
+	def __schedule_flush(self):
+		if self.__flush_callback_id is None:
+			self.__flush_callback_id = BigWorld.callback(self.__flush_delay, self.__on_flush_timeout)
+
+	def __on_flush_timeout(self):
+		self.__flush_callback_id = None
+		self.flush()
+
+	def flush(self):
+		'''Writes pending changes to the journal immediately.'''
+		if self.__flush_callback_id is not None:
+			BigWorld.cancelCallback(self.__flush_callback_id)
+			self.__flush_callback_id = None
+		if not self.__dirty_lines and not self.__compact_needed:
+			return
+		lines = list(self.__dirty_lines.values())
+		self.__dirty_lines.clear()
+		try:
+			if self.__compact_needed or \
+					self.__journal_length + len(lines) > len(self.__cache_mapping) + self.COMPACT_THRESHOLD:
+				self.__compact()
+			else:
+				self.__append(lines)
+		except Exception as error:
+			LOG_ERROR(u"Failed to write file '{0}', reason: {1}".format(self.__file_path, to_unicode(error)))
+			# journal may now have a partial line, rewrite it fully next time
+			self.__compact_needed = True
+			self.__schedule_flush()
+
+	def __append(self, lines):
+		with io.open(self.__file_path, "at", encoding="utf8") as file:
+			file.write(u"".join(to_unicode(line) + u"\n" for line in lines))
+		self.__journal_length += len(lines)
+
+	def __compact(self):
+		lines = [json.dumps({"key": key, "value": value}) for key, value in self.__cache_mapping.items()]
+		write_file_atomically(self.__file_path, u"".join(to_unicode(line) + u"\n" for line in lines))
+		self.__journal_length = len(lines)
+		self.__compact_needed = False
+
+	def fini(self):
+		'''Writes pending changes, call before exiting.'''
+		self.flush()
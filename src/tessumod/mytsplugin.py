@@ -85,15 +85,39 @@ class PositionalDataAPI(_SharedMemory):
 	SIZE = 1024
 	ACCESS_TYPE = mmap.ACCESS_WRITE
 
+	# offset of client count, followed by client slots
+	CLIENTS_OFFSET = 4 + 3*4 + 3*4
+	CLIENT_SLOT_SIZE = 2 + 3*4
+
 	def set_data(self, data):
+		self.set_camera(data.camera_position, data.camera_direction)
+		self.set_client_positions(data.client_positions)
+
+	def set_camera(self, camera_position, camera_direction):
+		'''Writes camera position and direction, together with timestamp of
+		the update.
+		'''
 		self.seek(0)
 		self.write(struct.pack("I", int(time.time())))
-		self.write(self.__pack_float_vector(data.camera_position))
-		self.write(self.__pack_float_vector(data.camera_direction))
-		self.write(struct.pack("B", len(data.client_positions)))
-		for client_id, position in data.client_positions:
-			self.write(struct.pack("h", client_id))
-			self.write(self.__pack_float_vector(position))
+		self.write(self.__pack_float_vector(camera_position))
+		self.write(self.__pack_float_vector(camera_direction))
+
+	def set_client_positions(self, client_positions):
+		'''Writes positions of all clients, replacing previous clients.'''
+		self.seek(self.CLIENTS_OFFSET)
+		self.write(struct.pack("B", len(client_positions)))
+		for client_id, position in client_positions:
+			self.write(self.__pack_client_slot(client_id, position))
+
+	def set_client_position(self, index, client_id, position):
+		'''Writes position of a single client to slot 'index', leaving other
+		slots untouched.
+		'''
+		self.seek(self.CLIENTS_OFFSET + 1 + index * self.CLIENT_SLOT_SIZE)
+		self.write(self.__pack_client_slot(client_id, position))
+
+	def __pack_client_slot(self, client_id, position):
+		return struct.pack("h", client_id) + self.__pack_float_vector(position)
 
 	def __pack_float_vector(self, vector):
 		return struct.pack("3f", vector.x, vector.y, vector.z)
@@ -23,19 +23,36 @@ import BigWorld
 import Event
 
 from . import mytsplugin
+from . import utils
 from .utils import RepeatTimer
 
 ENTITY_REFRESH_TIMEOUT = 1
 TS_UPDATE_TIMEOUT = 0.1
 
 class PositionalAudio(object):
+	'''Passes positions of vehicles driven by users in my TeamSpeak channel
+	to TessuMod TS plugin, so that it can position their voices in 3D.
 
-	def __init__(self, ts_users, user_cache):
+	Which vehicle each client in the channel is bound to is worked out only
+	when users, user cache or vehicles in the arena change. Each bound client
+	has a slot in the plugin's shared memory, and when vehicles move only the
+	slots of moved vehicles are written. A client keeps its slot for as long
+	as it stays bound, regardless of the order of players in the arena.
+	'''
+
+	def __init__(self, ts_users, user_cache, arena_index=None):
 		self._ts_users = ts_users
 		self._user_cache = user_cache
-		self._player_vehicle_ids = {}
+		self._arena_index = arena_index if arena_index is not None else utils.g_arena_index
+		# [(client_id, [vehicle_id, ...])]
+		self._client_bindings = []
+		self._bound_vehicle_ids = set()
+		self._bindings_changed = True
+		# [(client_id, vehicle_id)] in order written to the plugin
+		self._client_slots = []
+		self._slots_changed = True
 		self._vehicle_positions = {}
-		self._data_updated = False
+		self._moved_vehicle_ids = set()
 		self._camera_position = None
 		self._camera_direction = None
 		self.__positional_data_api = None
@@ -65,51 +82,36 @@ class PositionalAudio(object):
 		'''Called when battle starts.'''
 		self.__positional_data_api = mytsplugin.PositionalDataAPI()
 		self.__positional_data_api.open()
-		self._vehicle_positions.clear()
-		self._player_vehicle_ids.clear()
-		self._data_updated = True
-		self._arena().onNewVehicleListReceived += self.on_arena_vehicles_updated
-		self._arena().onVehicleAdded           += self.on_arena_vehicles_updated
-		self._arena().onVehicleUpdated         += self.on_arena_vehicles_updated
-		self._arena().onVehicleKilled          += self.on_arena_vehicles_updated
-		self._arena().onPositionsUpdated       += self.on_arena_positions_changed
+		self._clear_positions()
+		self._arena_index.on_updated     += self.on_arena_vehicles_updated
+		self._arena().onPositionsUpdated += self.on_arena_positions_changed
 		self._entity_positions_timer.start()
 		self._ts_update_timer.start()
-		self.on_arena_vehicles_updated()
+		self._arena_index.update()
+		self.on_arena_positions_changed()
 		self.on_refresh_entity_positions()
 		self.on_update_to_ts(forced=True)
 
 	def disable(self):
 		'''Called when battle ends.'''
+		self._arena_index.on_updated -= self.on_arena_vehicles_updated
 		if self._arena():
-			self._arena().onNewVehicleListReceived -= self.on_arena_vehicles_updated
-			self._arena().onVehicleAdded           -= self.on_arena_vehicles_updated
-			self._arena().onVehicleUpdated         -= self.on_arena_vehicles_updated
-			self._arena().onVehicleKilled          -= self.on_arena_vehicles_updated
-			self._arena().onPositionsUpdated       -= self.on_arena_positions_changed
+			self._arena().onPositionsUpdated -= self.on_arena_positions_changed
 		self._entity_positions_timer.stop()
 		self._ts_update_timer.stop()
-		self._player_vehicle_ids.clear()
-		self._vehicle_positions.clear()
+		self._clear_positions()
 		self.on_update_to_ts(forced=True)
 		if self.__positional_data_api:
 			self.__positional_data_api.close()
 			self.__positional_data_api = None
 
-	def on_arena_vehicles_updated(self, *args, **kwargs):
+	def on_arena_vehicles_updated(self):
 		'''Called when vehicles in the arena are updated.
 
-		Builds a lookup table for converting player ID to vehicle ID.
+		Player ID to vehicle ID lookups are served from the shared arena
+		index, which has just been rebuilt.
 		'''
-		self._player_vehicle_ids.clear()
-		if not self._arena():
-			return
-		for vehicle_id in self._arena().vehicles:
-			vehicle = self._arena().vehicles[vehicle_id]
-			if vehicle["isAlive"]:
-				player_id = vehicle["accountDBID"]
-				self._player_vehicle_ids[player_id] = vehicle_id
-		self._data_updated = True
+		self._bindings_changed = True
 
 	def on_arena_positions_changed(self):
 		'''Called when vehicle positions in the arena are updated.
@@ -119,9 +121,9 @@ class PositionalAudio(object):
 		'''
 		if not self._arena():
 			return
-		for vehicle_id in self._arena().positions:
-			self._vehicle_positions[vehicle_id] = mytsplugin.Vector(*self._arena().positions[vehicle_id])
-		self._data_updated = True
+		positions = self._arena().positions
+		for vehicle_id in positions:
+			self._set_vehicle_position(vehicle_id, tuple(positions[vehicle_id]))
 
 	def on_refresh_entity_positions(self):
 		'''Called every ENTITY_REFRESH_TIMEOUT intervals.
@@ -133,45 +135,126 @@ class PositionalAudio(object):
 			return
 		for vehicle_id in self._arena().vehicles:
 			if BigWorld.entities.has_key(vehicle_id):
-				self._vehicle_positions[vehicle_id] = BigWorld.entities[vehicle_id].position
-				self._data_updated = True
+				position = BigWorld.entities[vehicle_id].position
+				self._set_vehicle_position(vehicle_id, (position.x, position.y, position.z))
 
 	def on_ts_users_changed(self, *args, **kwargs):
-		self._data_updated = True
+		self._bindings_changed = True
 
 	def on_user_cache_updated(self):
-		self._data_updated = True
+		self._bindings_changed = True
 
 	def on_update_to_ts(self, forced=False):
-		if self.__positional_data_api and (forced or self._data_updated or self._is_camera_updated()):
-			self._data_updated = False
-			camera = BigWorld.camera()
-			self._camera_position = camera.position
-			self._camera_direction = camera.direction
-
-			data = mytsplugin.PositionalData()
-			data.camera_position = camera.position
-			data.camera_direction = camera.direction
-			data.client_positions = self._get_data_entries()
-			self.__positional_data_api.set_data(data)
-
-	def _get_data_entries(self):
-		entries = {}
-		for user in self._ts_users.itervalues():
-			for player_id in self._ts_user_to_player_ids(user):
-				position = self._get_vehicle_id_position(self._player_id_to_vehicle_id(player_id))
-				if position and user.client_id not in entries:
-					entries[user.client_id] = position
-		return entries.items()
-
-	def _ts_user_to_player_ids(self, ts_user):
-		return self._user_cache.get_paired_player_ids(ts_user.unique_id)
+		if not self.__positional_data_api:
+			return
+		if self._bindings_changed:
+			self._update_client_bindings()
+		if self._slots_changed:
+			self._update_client_slots()
+		if not (forced or self._slots_changed or self._moved_vehicle_ids or self._is_camera_updated()):
+			return
+		camera = BigWorld.camera()
+		self._camera_position = camera.position
+		self._camera_direction = camera.direction
+		self.__positional_data_api.set_camera(camera.position, camera.direction)
+		if forced or self._slots_changed:
+			self.__positional_data_api.set_client_positions([(client_id, self._get_vehicle_id_position(vehicle_id))
+				for client_id, vehicle_id in self._client_slots])
+		else:
+			for index, (client_id, vehicle_id) in enumerate(self._client_slots):
+				if vehicle_id in self._moved_vehicle_ids:
+					self.__positional_data_api.set_client_position(index, client_id,
+						self._get_vehicle_id_position(vehicle_id))
+		self._slots_changed = False
+		self._moved_vehicle_ids.clear()
+
+	def _update_client_bindings(self):
+		'''Works out which vehicles each client in my channel may be in.
+
+		Goes through players in the arena and finds their clients with TS
+		users' unique id index, so the cost follows the arena size instead of
+		the number of users in my channel.
+		'''
+		self._bindings_changed = False
+		vehicle_ids_by_client_id = {}
+		for player in self._arena_index.get_players():
+			vehicle_id = self._player_id_to_vehicle_id(player.id)
+			if vehicle_id is None:
+				continue
+			for client_id in self._player_id_to_client_ids(player.id):
+				vehicle_ids_by_client_id.setdefault(client_id, []).append(vehicle_id)
+		bindings = sorted((client_id, sorted(vehicle_ids)) for client_id, vehicle_ids in vehicle_ids_by_client_id.items())
+		if bindings != self._client_bindings:
+			self._client_bindings = bindings
+			self._bound_vehicle_ids = set(vehicle_id for _, vehicle_ids in bindings for vehicle_id in vehicle_ids)
+			self._slots_changed = True
+
+	def _update_client_slots(self):
+		'''Picks for each bound client a vehicle which has a known position,
+		preferring the vehicle the client already had. Clients which already
+		had a slot keep their order and new clients are added after them.
+		Slots are written again only if they have changed.
+		'''
+		vehicle_ids_by_client_id = dict(self._client_bindings)
+		slots = []
+		for client_id, vehicle_id in self._client_slots:
+			vehicle_ids = vehicle_ids_by_client_id.pop(client_id, None)
+			if vehicle_ids is None:
+				continue
+			if vehicle_id not in vehicle_ids or vehicle_id not in self._vehicle_positions:
+				vehicle_id = self._find_positioned_vehicle_id(vehicle_ids)
+			if vehicle_id is not None:
+				slots.append((client_id, vehicle_id))
+		for client_id, vehicle_ids in self._client_bindings:
+			if client_id in vehicle_ids_by_client_id:
+				vehicle_id = self._find_positioned_vehicle_id(vehicle_ids)
+				if vehicle_id is not None:
+					slots.append((client_id, vehicle_id))
+		self._slots_changed = slots != self._client_slots
+		self._client_slots = slots
+
+	def _find_positioned_vehicle_id(self, vehicle_ids):
+		for vehicle_id in vehicle_ids:
+			if vehicle_id in self._vehicle_positions:
+				return vehicle_id
+		return None
+
+	def _set_vehicle_position(self, vehicle_id, position):
+		previous = self._vehicle_positions.get(vehicle_id)
+		if previous == position:
+			return
+		self._vehicle_positions[vehicle_id] = position
+		if vehicle_id in self._bound_vehicle_ids:
+			if previous is None:
+				# vehicle may now take a slot
+				self._slots_changed = True
+			else:
+				self._moved_vehicle_ids.add(vehicle_id)
+
+	def _clear_positions(self):
+		self._vehicle_positions.clear()
+		self._moved_vehicle_ids.clear()
+		self._bindings_changed = True
+		self._slots_changed = True
+
+	def _player_id_to_client_ids(self, player_id):
+		client_ids = set()
+		for ts_user_id in self._user_cache.get_paired_ts_user_ids(player_id):
+			client_ids.update(self._ts_users.client_ids_by_unique_id(ts_user_id))
+		return client_ids
 
 	def _player_id_to_vehicle_id(self, player_id):
-		return self._player_vehicle_ids.get(player_id)
+		vehicle_id = self._arena_index.get_vehicle_id(player_id)
+		vehicle = self._arena_index.get_vehicle(vehicle_id)
+		if vehicle and vehicle["isAlive"]:
+			return vehicle_id
+		return None
 
 	def _get_vehicle_id_position(self, vehicle_id):
-		return self._vehicle_positions.get(vehicle_id)
+		position = self._vehicle_positions.get(vehicle_id)
+		if position is not None:
+			return mytsplugin.Vector(*position)
+		return None
 
 	def _arena(self):
 		if hasattr(BigWorld.player(), "arena"):
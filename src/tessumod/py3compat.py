@@ -20,6 +20,13 @@ import sys
 PY2 = sys.version_info[0] == 2
 PY3 = sys.version_info[0] == 3
 
+try:
+	from time import monotonic as monotonic_time
+except ImportError:
+	# Python 2 has no monotonic clock, BigWorld's game time is the closest
+	# thing as it is not affected by changes to system time
+	from BigWorld import time as monotonic_time
+
 if PY3:
 	string_types = str,
 	text_type = str
@@ -15,14 +15,21 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import collections
 import csv
 import io
 import os
 import re
 
+try:
+	from collections.abc import Mapping
+except ImportError:
+	from collections import Mapping
+
 import BigWorld
 import Event
 
+from .file_watch import FileWatcher
 from .py3compat import to_unicode
 from .unicode_aware import ConfigParser
 from .utils import LOG_ERROR
@@ -68,6 +75,19 @@ get_wot_nick_from_ts_metadata: on
 ; Changing this value requires game restart
 update_cache_in_replays: off
 
+; Time (in seconds) that new users, players and pairings are collected before
+; they are written to tessu_mod_cache.ini, avoiding rewriting the file after
+; each new pairing
+cache_write_delay: 10
+
+; Storage used for TeamSpeak users, players and pairings, possible values:
+;   ini:    stored only to tessu_mod_cache.ini
+;   sqlite: stored to tessu_mod_cache.db database which loads faster with
+;           large caches, tessu_mod_cache.ini is still kept up to date and
+;           changes done to it are loaded to the database
+; Changing this value requires game restart
+cache_backend: ini
+
 ; Enables or disables searching of WOT player nicknames from within speaking TS
 ; user's nickname. With this option enabled you usually do not need to define
 ; anything in 'nick_extract_patterns' as the mod tries automatically to do the
@@ -115,11 +135,25 @@ api_key:
 host: localhost
 port: 25639
 
-; Interval (as seconds) to poll clientquery's socket
+; Interval (as seconds) to poll clientquery's socket while there is traffic
 ;  - high value causes reaction delay to speak notifications
 ;  - low value may have negative impact to game performance
 ; Changing this value requires game restart
-polling_interval: 0.1
+polling_interval: 0.03
+
+; Longest interval (as seconds) to poll clientquery's socket when there is no
+; traffic, polling interval is lengthened gradually up to this value while idle
+; and returns to 'polling_interval' as soon as there is traffic
+;  - set equal to 'polling_interval' to poll always at same rate
+;  - values over 0.1 are treated as 0.1 to keep speak notifications responsive
+; Changing this value requires game restart
+idle_polling_interval: 0.1
+
+; Enables or disables sending of multiple commands to clientquery at once
+; without waiting for responses in between. Speeds up (re)connecting to
+; TeamSpeak. Disable if TessuMod has trouble communicating with your
+; TeamSpeak client.
+pipelined_commands: on
 
 [VoiceChatNotifications]
 ; Enable or disable speak notifications in player panels and showing of
@@ -168,11 +202,14 @@ repeat_interval: 2
 
 class Settings(object):
 
-	def __init__(self, ini_path):
+	def __init__(self, ini_path, file_watcher=None):
 		self.on_reloaded = Event.Event()
-		self._load_time = 0
 		self._parser = None
+		self._values = None
 		self._ini_path = ini_path
+		if file_watcher is None:
+			file_watcher = FileWatcher()
+		self._watch = file_watcher.watch(ini_path)
 		self._write_default_file()
 		self._load_parser()
 
@@ -182,39 +219,56 @@ class Settings(object):
 				f.write(DEFAULT_INI)
 
 	def _load_parser(self):
-		self._parser = ConfigParser()
-		self._parser.add_section(u"General")
-		self._parser.set(u"General", u"log_level", u"1")
-		self._parser.set(u"General", u"ini_check_interval", u"5")
-		self._parser.set(u"General", u"speak_stop_delay", u"1")
-		self._parser.set(u"General", u"get_wot_nick_from_ts_metadata", u"on")
-		self._parser.set(u"General", u"update_cache_in_replays", u"off")
-		self._parser.set(u"General", u"ts_nick_search_enabled", u"on")
-		self._parser.set(u"General", u"nick_extract_patterns", u"")
-		self._parser.add_section(u"NameMappings")
-		self._parser.add_section(u"TSClientQueryService")
-		self._parser.set(u"TSClientQueryService", u"host", u"localhost")
-		self._parser.set(u"TSClientQueryService", u"port", u"25639")
-		self._parser.set(u"TSClientQueryService", u"polling_interval", u"0.1")
-		self._parser.add_section(u"VoiceChatNotifications")
-		self._parser.set(u"VoiceChatNotifications", u"enabled", u"on")
-		self._parser.set(u"VoiceChatNotifications", u"self_enabled", u"on")
-		self._parser.add_section(u"MinimapNotifications")
-		self._parser.set(u"MinimapNotifications", u"enabled", u"on")
-		self._parser.set(u"MinimapNotifications", u"self_enabled", u"on")
-		self._parser.set(u"MinimapNotifications", u"action", u"attackSender")
-		self._parser.set(u"MinimapNotifications", u"repeat_interval", u"3.5")
-
+		self._parser = self._create_default_parser()
+		# acknowledge before reading so that changes done while reading are
+		# not missed
+		self._watch.acknowledge()
 		try:
 			with io.open(self._ini_path, "rt", encoding="utf8") as f:
 				self._parser.readfp(f)
-				self._load_time = self._get_modified_time()
 		except Exception as error:
 			LOG_ERROR(u"Failed to parse ini file '{0}', reason: {1}"
 				.format(self._ini_path, to_unicode(error)))
-
-	def _get_modified_time(self):
-		return os.path.getmtime(self._ini_path)
+		try:
+			values = _SettingsValues.from_parser(self._parser)
+		except Exception as error:
+			LOG_ERROR(u"Invalid value in ini file '{0}', reason: {1}"
+				.format(self._ini_path, to_unicode(error)))
+			if self._values is not None:
+				return
+			values = _SettingsValues.from_parser(self._create_default_parser())
+		# replace all values at once so that getters never see a mix of old
+		# and new settings
+		self._values = values
+
+	def _create_default_parser(self):
+		parser = ConfigParser()
+		parser.add_section(u"General")
+		parser.set(u"General", u"log_level", u"1")
+		parser.set(u"General", u"ini_check_interval", u"5")
+		parser.set(u"General", u"speak_stop_delay", u"1")
+		parser.set(u"General", u"get_wot_nick_from_ts_metadata", u"on")
+		parser.set(u"General", u"update_cache_in_replays", u"off")
+		parser.set(u"General", u"cache_write_delay", u"10")
+		parser.set(u"General", u"cache_backend", u"ini")
+		parser.set(u"General", u"ts_nick_search_enabled", u"on")
+		parser.set(u"General", u"nick_extract_patterns", u"")
+		parser.add_section(u"NameMappings")
+		parser.add_section(u"TSClientQueryService")
+		parser.set(u"TSClientQueryService", u"host", u"localhost")
+		parser.set(u"TSClientQueryService", u"port", u"25639")
+		parser.set(u"TSClientQueryService", u"polling_interval", u"0.03")
+		parser.set(u"TSClientQueryService", u"idle_polling_interval", u"0.1")
+		parser.set(u"TSClientQueryService", u"pipelined_commands", u"on")
+		parser.add_section(u"VoiceChatNotifications")
+		parser.set(u"VoiceChatNotifications", u"enabled", u"on")
+		parser.set(u"VoiceChatNotifications", u"self_enabled", u"on")
+		parser.add_section(u"MinimapNotifications")
+		parser.set(u"MinimapNotifications", u"enabled", u"on")
+		parser.set(u"MinimapNotifications", u"self_enabled", u"on")
+		parser.set(u"MinimapNotifications", u"action", u"attackSender")
+		parser.set(u"MinimapNotifications", u"repeat_interval", u"3.5")
+		return parser
 
 	def sync(self, force=False):
 		if force or self._is_modified():
@@ -226,65 +280,159 @@ class Settings(object):
 		return self._ini_path
 
 	def _is_modified(self):
-		return self._load_time < self._get_modified_time()
+		return self._watch.check()
 
 	def get_log_level(self):
-		return self._parser.getint(u"General", u"log_level")
+		return self._values.log_level
 
 	def get_ini_check_interval(self):
-		return self._parser.getfloat(u"General", u"ini_check_interval")
+		return self._values.ini_check_interval
 
 	def get_speak_stop_delay(self):
-		return self._parser.getfloat(u"General", u"speak_stop_delay")
+		return self._values.speak_stop_delay
 
 	def get_wot_nick_from_ts_metadata(self):
-		return self._parser.getboolean(u"General", u"get_wot_nick_from_ts_metadata")
+		return self._values.wot_nick_from_ts_metadata
 
 	def should_update_cache_in_replays(self):
-		return self._parser.getboolean(u"General", u"update_cache_in_replays")
+		return self._values.update_cache_in_replays
+
+	def get_cache_write_delay(self):
+		return self._values.cache_write_delay
+
+	def get_cache_backend(self):
+		return self._values.cache_backend
 
 	def is_ts_nick_search_enabled(self):
-		return self._parser.getboolean(u"General", u"ts_nick_search_enabled")
+		return self._values.ts_nick_search_enabled
 
 	def get_nick_extract_patterns(self):
-		patterns = []
-		for row in csv.reader([self._parser.get(u"General", u"nick_extract_patterns")]):
-			for pattern in row:
-				patterns.append(re.compile(pattern, re.IGNORECASE))
-		return patterns
+		return self._values.nick_extract_patterns
 
 	def get_name_mappings(self):
-		results = {}
-		for option in self._parser.options(u"NameMappings"):
-			results[option.lower()] = self._parser.get(u"NameMappings", option).lower()
-		return results
+		return self._values.name_mappings
 
 	def get_client_query_apikey(self):
-		return self._parser.get(u"TSClientQueryService", u"api_key")
+		'''Returns None if api_key option is missing from the ini-file.'''
+		return self._values.client_query_apikey
 
 	def get_client_query_host(self):
-		return self._parser.get(u"TSClientQueryService", u"host")
+		return self._values.client_query_host
 
 	def get_client_query_port(self):
-		return self._parser.getint(u"TSClientQueryService", u"port")
+		return self._values.client_query_port
 
 	def get_client_query_interval(self):
-		return self._parser.getfloat(u"TSClientQueryService", u"polling_interval")
+		return self._values.client_query_interval
+
+	def get_client_query_idle_interval(self):
+		return self._values.client_query_idle_interval
+
+	def is_client_query_pipelining_enabled(self):
+		return self._values.client_query_pipelining_enabled
 
 	def is_voice_chat_notifications_enabled(self):
-		return self._parser.getboolean(u"VoiceChatNotifications", u"enabled")
+		return self._values.voice_chat_notifications_enabled
 
 	def is_self_voice_chat_notifications_enabled(self):
-		return self._parser.getboolean(u"VoiceChatNotifications", u"self_enabled")
+		return self._values.self_voice_chat_notifications_enabled
 
 	def is_minimap_notifications_enabled(self):
-		return self._parser.getboolean(u"MinimapNotifications", u"enabled")
+		return self._values.minimap_notifications_enabled
 
 	def is_self_minimap_notifications_enabled(self):
-		return self._parser.getboolean(u"MinimapNotifications", u"self_enabled")
+		return self._values.self_minimap_notifications_enabled
 
 	def get_minimap_action(self):
-		return self._parser.get(u"MinimapNotifications", u"action")
+		return self._values.minimap_action
 
 	def get_minimap_action_interval(self):
-		return self._parser.getfloat(u"MinimapNotifications", u"repeat_interval")
+		return self._values.minimap_action_interval
+
+class _SettingsValues(collections.namedtuple("_SettingsValues", [
+	"log_level",
+	"ini_check_interval",
+	"speak_stop_delay",
+	"wot_nick_from_ts_metadata",
+	"update_cache_in_replays",
+	"cache_write_delay",
+	"cache_backend",
+	"ts_nick_search_enabled",
+	"nick_extract_patterns",
+	"name_mappings",
+	"client_query_apikey",
+	"client_query_host",
+	"client_query_port",
+	"client_query_interval",
+	"client_query_idle_interval",
+	"client_query_pipelining_enabled",
+	"voice_chat_notifications_enabled",
+	"self_voice_chat_notifications_enabled",
+	"minimap_notifications_enabled",
+	"self_minimap_notifications_enabled",
+	"minimap_action",
+	"minimap_action_interval",
+])):
+	'''
+	Immutable snapshot of settings values, converted to their final types
+	once per (re)load so that getters don't need to touch the parser.
+	Name mappings are stored as a read-only TS nick -> WoT nick mapping.
+	'''
+	__slots__ = ()
+
+	@classmethod
+	def from_parser(cls, parser):
+		patterns = []
+		for row in csv.reader([parser.get(u"General", u"nick_extract_patterns")]):
+			for pattern in row:
+				patterns.append(re.compile(pattern, re.IGNORECASE))
+		mappings = {}
+		for option in parser.options(u"NameMappings"):
+			mappings[option.lower()] = parser.get(u"NameMappings", option).lower()
+		if parser.has_option(u"TSClientQueryService", u"api_key"):
+			apikey = parser.get(u"TSClientQueryService", u"api_key")
+		else:
+			apikey = None
+		return cls(
+			log_level = parser.getint(u"General", u"log_level"),
+			ini_check_interval = parser.getfloat(u"General", u"ini_check_interval"),
+			speak_stop_delay = parser.getfloat(u"General", u"speak_stop_delay"),
+			wot_nick_from_ts_metadata = parser.getboolean(u"General", u"get_wot_nick_from_ts_metadata"),
+			update_cache_in_replays = parser.getboolean(u"General", u"update_cache_in_replays"),
+			cache_write_delay = parser.getfloat(u"General", u"cache_write_delay"),
+			cache_backend = parser.get(u"General", u"cache_backend").strip().lower(),
+			ts_nick_search_enabled = parser.getboolean(u"General", u"ts_nick_search_enabled"),
+			nick_extract_patterns = tuple(patterns),
+			name_mappings = _ReadOnlyDict(mappings),
+			client_query_apikey = apikey,
+			client_query_host = parser.get(u"TSClientQueryService", u"host"),
+			client_query_port = parser.getint(u"TSClientQueryService", u"port"),
+			client_query_interval = parser.getfloat(u"TSClientQueryService", u"polling_interval"),
+			client_query_idle_interval = parser.getfloat(u"TSClientQueryService", u"idle_polling_interval"),
+			client_query_pipelining_enabled = parser.getboolean(u"TSClientQueryService", u"pipelined_commands"),
+			voice_chat_notifications_enabled = parser.getboolean(u"VoiceChatNotifications", u"enabled"),
+			self_voice_chat_notifications_enabled = parser.getboolean(u"VoiceChatNotifications", u"self_enabled"),
+			minimap_notifications_enabled = parser.getboolean(u"MinimapNotifications", u"enabled"),
+			self_minimap_notifications_enabled = parser.getboolean(u"MinimapNotifications", u"self_enabled"),
+			minimap_action = parser.get(u"MinimapNotifications", u"action"),
+			minimap_action_interval = parser.getfloat(u"MinimapNotifications", u"repeat_interval")
+		)
+
+class _ReadOnlyDict(Mapping):
+	'''Read-only view to a dict, shared by all callers without copying.'''
+	__slots__ = ("_data",)
+
+	def __init__(self, data):
+		self._data = data
+
+	def __getitem__(self, key):
+		return self._data[key]
+
+	def __iter__(self):
+		return iter(self._data)
+
+	def __len__(self):
+		return len(self._data)
+
+	def __repr__(self):
+		return repr(self._data)
@@ -0,0 +1,107 @@
+# TessuMod: Mod for integrating TeamSpeak into World of Tanks
+# Copyright (C) 2019  Janne Hakonen
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import collections
+
+import BigWorld
+import Event
+
+from .utils import LOG_CURRENT_EXCEPTION
+
+class TalkStateStore(object):
+	'''Keeps track of players' talk states and publishes changes to them.
+
+	Published states are collected during a frame and sent out in one go
+	with on_changed event in the next frame. A state is sent out only if it
+	differs from what was previously sent out for the player, so GUI is not
+	updated for nothing.
+
+	A published state is a tuple of (talking, voice_chat_talking), where
+	'voice_chat_talking' is what is shown in the game's voice chat
+	indicators.
+	'''
+
+	NOT_TALKING = (False, False)
+
+	def __init__(self):
+		self.on_changed = Event.Event()
+		self._talk_states = {}
+		self._published_states = {}
+		self._pending_states = collections.OrderedDict()
+		self._callback_id = None
+
+	def fini(self):
+		self._cancel_callback()
+		self._talk_states.clear()
+		self._published_states.clear()
+		self._pending_states.clear()
+		self.on_changed.clear()
+
+	def set_talking(self, player_id, talking):
+		self._talk_states[player_id] = talking
+
+	def is_talking(self, player_id):
+		return self._talk_states.get(player_id, False)
+
+	def publish(self, player_id, talking, voice_chat_talking):
+		'''Publishes player's talk state in the next frame, if it differs from
+		the previously published state.
+		'''
+		self._pending_states[player_id] = (talking, voice_chat_talking)
+		if self._callback_id is None:
+			self._callback_id = BigWorld.callback(0, self._on_flush)
+
+	def flush(self):
+		'''Sends out pending changes immediately.'''
+		self._cancel_callback()
+		changes = []
+		for player_id, state in self._pending_states.items():
+			if self._published_states.get(player_id, self.NOT_TALKING) != state:
+				changes.append((player_id,) + state)
+				if state == self.NOT_TALKING:
+					self._published_states.pop(player_id, None)
+				else:
+					self._published_states[player_id] = state
+		self._pending_states.clear()
+		if changes:
+			self.on_changed(changes)
+
+	def reset(self):
+		'''Clears talk states of all players. Players who were published as
+		talking are published as not talking immediately, in one event.
+		'''
+		self._talk_states.clear()
+		self._pending_states.clear()
+		for player_id in self._published_states:
+			self._pending_states[player_id] = self.NOT_TALKING
+		self.flush()
+
+	def get_pending_count(self):
+		'''Returns number of players with changes waiting to be sent out.'''
+		return len(self._pending_states)
+
+	def _on_flush(self):
+		self._callback_id = None
+		try:
+			self.flush()
+		except:
+			LOG_CURRENT_EXCEPTION()
+
+	def _cancel_callback(self):
+		if self._callback_id is not None:
+			BigWorld.cancelCallback(self._callback_id)
+			self._callback_id = None
@@ -25,19 +25,19 @@ The main entry point is TS3Client class. After instancing call connect() to
 connect to the TeamSpeak client. The TS3Client will continue to connect until
 connection to the client is succesfully made.
 The TS3Client has check_events() method which implements event handling
-mechanism and it needs to be called periodically, e.g. with
-BigWorld.callback().
+mechanism and it needs to be called periodically, e.g. from event loop's
+on_tick event.
 
 The class provides several functions for querying information from TS client in
 a non-blocking asyncronous manner.
 '''
 
+import collections
 import errno
 import functools
 import re
 import socket
 import sys
-import time
 import weakref
 
 import BigWorld
@@ -45,7 +45,7 @@ import Event
 
 from . import async_tools
 from . import clientquery
-from .asyncore_utils import AsynchatExtended
+from .asyncore_utils import AsynchatExtended, LineFramer
 from .statemachine import StateMachine
 from .utils import (
 	noop,
@@ -56,7 +56,8 @@ from .utils import (
 	LOG_WARNING,
 	LOG_ERROR,
 	LOG_CURRENT_EXCEPTION,
-	RepeatTimer
+	RepeatTimer,
+	TimerQueue
 )
 
 _RETRY_TIMEOUT = 10
@@ -64,6 +65,23 @@ _COMMAND_WAIT_TIMEOUT = 30
 _UNREGISTER_WAIT_TIMEOUT = 5
 _API_NOT_CONNECTED_TO_SERVER = 1794
 _API_INVALID_SCHANDLER_ID = 1799
+_MAX_PIPELINED_COMMANDS = 16
+# Event which is registered from all server connection handlers
+_SERVER_CONNECTION_CHANGED_EVENT = "notifycurrentserverconnectionchanged"
+# Events which are registered from the selected server connection handler
+_SCHANDLER_EVENTS = (
+	"notifytalkstatuschange",
+	"notifyclientupdated",
+	"notifycliententerview",
+	"notifyclientleftview",
+	"notifyclientmoved",
+	"notifyconnectstatuschange"
+)
+# Events which carry complete state of a client, of these only the latest
+# event per key parameters needs to be handled from a batch of received lines
+_STATE_EVENT_KEYS = {
+	"notifytalkstatuschange": ("schandlerid", "clid")
+}
 
 class TS3Client(object):
 	'''Main entry point for access to TeamSpeak's client query interface.'''
@@ -82,10 +100,7 @@ class TS3Client(object):
 
 		# public models
 		self.users = UserModel()
-		self.users_in_my_channel = UserFilterProxy(
-			source      = self.users,
-			filter_func = lambda user: user.channel_id == self._my_channel_id
-		)
+		self.users_in_my_channel = ChannelFilterProxy(source=self.users)
 		self.users_in_my_channel.on_added += self.on_user_entered_my_channel
 
 		self._ping_timer = RepeatTimer(_RETRY_TIMEOUT)
@@ -93,13 +108,17 @@ class TS3Client(object):
 
 		self._wot_nickname = None
 		self._my_client_id = None
-		self._my_channel_id = None
 		self._schandler_id = None
+		# events handled by subclasses or added with add_event_handler()
+		self._extra_events = [name for name in get_event_handler_names(type(self))
+			if name not in _SCHANDLER_EVENTS and name != _SERVER_CONNECTION_CHANGED_EVENT]
 		self.__apikey = None
 
 		self._protocol = _ClientQueryProtocol(self, event_loop)
 		self._protocol.on_ready += functools.partial(self._send_sm_event, "protocol_ready")
 		self._protocol.on_closed += functools.partial(self._send_sm_event, "protocol_closed")
+		self._protocol.on_batch_started += self.users.begin_batch
+		self._protocol.on_batch_finished += self.users.end_batch
 
 		self._sm = StateMachine()
 
@@ -142,12 +161,34 @@ class TS3Client(object):
 		'''Sets API key for ClientQuery.'''
 		self.__apikey = apikey
 
+	def set_pipelined_commands(self, enabled):
+		'''Enables or disables sending of multiple commands to ClientQuery
+		without waiting for earlier commands to finish.
+		'''
+		self._protocol.pipelined = enabled
+
 	def connect(self):
 		'''Starts connect attempt and continues to try until succesfully
 		connected.
 		'''
 		self._send_sm_event("connect")
 
+	def add_event_handler(self, event_name, handler):
+		'''Adds 'handler' to be called with each received ClientQuery event
+		line of 'event_name' (e.g. "notifytextmessage"). Events which are not
+		handled by TS3Client itself are registered to ClientQuery from the
+		selected server connection handler.
+		'''
+		self._protocol.add_event_handler(event_name, handler)
+		if event_name not in _SCHANDLER_EVENTS + (_SERVER_CONNECTION_CHANGED_EVENT,) and event_name not in self._extra_events:
+			self._extra_events.append(event_name)
+			if self._schandler_id is not None:
+				self._send_command("clientnotifyregister", kwargs={"schandlerid": self._schandler_id, "event": event_name})
+
+	def remove_event_handler(self, event_name, handler):
+		'''Removes 'handler' added with add_event_handler().'''
+		self._protocol.remove_event_handler(event_name, handler)
+
 	def check_events(self):
 		'''Event handler method. Call this periodically.'''
 		self._protocol.handle_out_commands()
@@ -161,7 +202,7 @@ class TS3Client(object):
 	def _on_connect_failed_state(self):
 		BigWorld.callback(_RETRY_TIMEOUT, functools.partial(self._send_sm_event, "connect_retry"))
 
-	def _send_command(self, command, args=[], kwargs={}, callback=noop, timeout=_COMMAND_WAIT_TIMEOUT):
+	def _send_command(self, command, args=[], kwargs={}, callback=noop, timeout=_COMMAND_WAIT_TIMEOUT, response_optional=False):
 		def on_command_finish(err, lines):
 			if err:
 				LOG_DEBUG(type(err).__name__ + ": " + str(err))
@@ -172,7 +213,7 @@ class TS3Client(object):
 			callback(err, lines)
 
 		assert " " not in command, "Spaces are not allowed in the command, use args or kwargs instead"
-		self._protocol.send_command(build_command_string(command, args, kwargs), on_command_finish, timeout)
+		self._protocol.send_command(build_command_string(command, args, kwargs), on_command_finish, timeout, response_optional)
 
 	def _on_authenticate_state(self):
 		'''Authenticates to client query, required with TeamSpeak 3.1.3 or newer.'''
@@ -190,35 +231,30 @@ class TS3Client(object):
 
 	def _on_connected_to_ts_state(self):
 		self._my_client_id = None
-		self._my_channel_id = None
 		self._schandler_id = None
 		self.users.clear()
-		self.users_in_my_channel.invalidate()
+		self.users_in_my_channel.set_channel_id(None)
 
 		def unregister(callback):
-			self._send_command("clientnotifyunregister", callback=callback, timeout=_UNREGISTER_WAIT_TIMEOUT)
+			# client query doesn't answer if there is nothing to unregister
+			self._send_command("clientnotifyunregister", callback=callback,
+				timeout=_UNREGISTER_WAIT_TIMEOUT, response_optional=True)
 		def register_connection_change(callback):
-			self._send_command("clientnotifyregister", kwargs={"schandlerid": 0, "event": "notifycurrentserverconnectionchanged"}, callback=callback)
+			self._send_command("clientnotifyregister", kwargs={"schandlerid": 0, "event": _SERVER_CONNECTION_CHANGED_EVENT}, callback=callback)
 		def get_currentschandlerid(callback):
 			def on_finish(err, lines):
 				if not err:
 					self._schandler_id = int(parse_client_query_parameter(lines[0], "schandlerid"))
 				callback(err, lines)
 			self._send_command("currentschandlerid", callback=on_finish)
-		def register_talk_status_change(callback):
-			self._send_command("clientnotifyregister", kwargs={"schandlerid": self._schandler_id, "event": "notifytalkstatuschange"}, callback=callback)
-		def register_client_update(callback):
-			self._send_command("clientnotifyregister", kwargs={"schandlerid": self._schandler_id, "event": "notifyclientupdated"}, callback=callback)
-		def register_client_enter_view(callback):
-			self._send_command("clientnotifyregister", kwargs={"schandlerid": self._schandler_id, "event": "notifycliententerview"}, callback=callback)
-		def register_client_left_view(callback):
-			self._send_command("clientnotifyregister", kwargs={"schandlerid": self._schandler_id, "event": "notifyclientleftview"}, callback=callback)
-		def register_client_moved(callback):
-			self._send_command("clientnotifyregister", kwargs={"schandlerid": self._schandler_id, "event": "notifyclientmoved"}, callback=callback)
-		def register_connect_status_change(callback):
-			self._send_command("clientnotifyregister", kwargs={"schandlerid": self._schandler_id, "event": "notifyconnectstatuschange"}, callback=callback)
+		def register_event(event_name, callback):
+			self._send_command("clientnotifyregister", kwargs={"schandlerid": self._schandler_id, "event": event_name}, callback=callback)
 		def use_schandler_id(callback):
 			self._send_command("use", kwargs={"schandlerid": self._schandler_id}, callback=callback)
+		def register_schandler_events(callback):
+			actions = [functools.partial(register_event, event_name)
+				for event_name in _SCHANDLER_EVENTS + tuple(self._extra_events)]
+			async_tools.parallel(actions + [use_schandler_id], callback)
 		def start_pinging(callback):
 			self._start_pinging()
 			callback(None, None)
@@ -229,13 +265,7 @@ class TS3Client(object):
 			unregister,
 			register_connection_change,
 			get_currentschandlerid,
-			register_talk_status_change,
-			register_client_update,
-			register_client_enter_view,
-			register_client_left_view,
-			register_client_moved,
-			register_connect_status_change,
-			use_schandler_id,
+			register_schandler_events,
 			start_pinging
 		], on_finish)
 
@@ -294,12 +324,9 @@ class TS3Client(object):
 	def _update_my_client_id(self, callback=noop):
 		def on_whoami(err, lines):
 			if not err and lines:
-				[entry] = parse_client_query_parameters(lines[0])
-				self._my_client_id = int(entry.get("clid"))
-				new_channel_id = int(entry.get("cid"))
-				if new_channel_id != self._my_channel_id:
-					self._my_channel_id = new_channel_id
-					self.users_in_my_channel.invalidate()
+				client_id, channel_id = parse_client_query_values(lines[0], "clid", "cid")
+				self._my_client_id = int(client_id)
+				self.users_in_my_channel.set_channel_id(int(channel_id))
 			callback(err, None)
 		self._send_command("whoami", callback=on_whoami)
 
@@ -377,9 +404,9 @@ class TS3Client(object):
 		self._send_sm_event("tab_changed")
 
 	def on_notifytalkstatuschange_ts3_event(self, line):
-		[entry] = parse_client_query_parameters(line)
-		client_id = int(entry.get("clid"))
-		speaking = int(entry.get("status")) == 1
+		client_id, status = parse_client_query_values(line, "clid", "status")
+		client_id = int(client_id)
+		speaking = int(status) == 1
 		if client_id not in self.users:
 			return
 		user = self.users[client_id]
@@ -428,9 +455,9 @@ class TS3Client(object):
 
 	def on_notifyclientmoved_ts3_event(self, line):
 		'''This event handler is called when a TS user moves from one channel to another.'''
-		[entry] = parse_client_query_parameters(line)
-		client_id = int(entry.get("clid"))
-		channel_id = int(entry.get("ctid"))
+		client_id, channel_id = parse_client_query_values(line, "clid", "ctid")
+		client_id = int(client_id)
+		channel_id = int(channel_id)
 		if client_id not in self.users:
 			return
 		self.users.add(
@@ -454,17 +481,25 @@ class _ClientQueryProtocol(AsynchatExtended):
 		self.on_connected = Event.Event()
 		self.on_closed = Event.Event()
 		self.on_ready = Event.Event()
+		self.on_batch_started = Event.Event()
+		self.on_batch_finished = Event.Event()
 
 		self._data_in_handler = noop
 		self._event_handlers = {}
-		for attr in dir(event_receiver):
-			matches = re.match("on_(.+)_ts3_event", attr)
-			if matches:
-				name = matches.group(1)
-				self._event_handlers[name] = getattr(event_receiver, attr)
-		self.set_terminator(b"\n\r")
+		for name, attr in get_event_handler_names(type(event_receiver)).items():
+			self._event_handlers[name] = (getattr(event_receiver, attr),)
+		# lines are split from received data by the line framer
+		self.set_terminator(None)
+		self._line_framer = LineFramer(b"\n\r")
 		self._commands = []
+		self._timeouts = TimerQueue()
 		self._opened = False
+		self._in_lines = None
+		self.pipelined = False
+
+	def is_busy(self):
+		'''Returns True while handshaking or waiting responses to commands.'''
+		return self._data_in_handler != self._handle_in_data_actions or bool(self._commands)
 
 	def close(self):
 		'''Closes connection.'''
@@ -475,6 +510,7 @@ class _ClientQueryProtocol(AsynchatExtended):
 			self._opened = False
 			self._data_in_handler = noop
 			self.on_closed()
+			self._timeouts.cancel_all()
 			for command in self._commands:
 				command.closed()
 			del self._commands[:]
@@ -484,7 +520,8 @@ class _ClientQueryProtocol(AsynchatExtended):
 		established. Initializes variables and prepares for protocol testing.
 		'''
 		del self._commands[:]
-		self._in_line = ""
+		self._timeouts.cancel_all()
+		self._line_framer.reset()
 		self._data_in_handler = self._handle_in_data_proto_test
 		self.on_connected()
 
@@ -504,23 +541,54 @@ class _ClientQueryProtocol(AsynchatExtended):
 		# calls handle_close(), so I think we should do that as well
 		self.handle_close()
 
-	@LOG_CALL(msg="<< {data}")
 	def collect_incoming_data(self, data):
 		'''Hook method which is called by async_chat to provide incoming data.
-		Data is provided just enough until terminator is found.
+		Splits the data to lines, which may span over several calls.
+		'''
+		for line in self._line_framer.feed(data):
+			self._on_line_received(line)
+
+	def handle_read(self):
+		'''Hook method which is called by asyncore when there is data to
+		read. Collects all lines received in one read and handles them as a
+		single batch.
 		'''
-		self._in_line += data.decode('utf-8')
+		self._in_lines = []
+		try:
+			AsynchatExtended.handle_read(self)
+		finally:
+			lines = self._in_lines
+			self._in_lines = None
+		if lines:
+			self._handle_in_lines(lines)
+
+	@LOG_CALL(msg="<< {line}")
+	def _on_line_received(self, line):
+		'''Feeds received line to data handling, or to current batch of lines
+		if one is being collected.
+		'''
+		if self._in_lines is None:
+			self._handle_in_line(line)
+		else:
+			self._in_lines.append(line)
 
-	def found_terminator(self):
-		'''Hook method which is called by async_chat to indicate end-of-line.
-		Feeds collected line to data handling.
+	def _handle_in_lines(self, lines):
+		'''Handles a batch of lines, dropping state events which are
+		superseded by later events in the same batch.
 		'''
+		self.on_batch_started()
 		try:
-			self._data_in_handler(self._in_line)
+			for line in coalesce_state_events(lines):
+				self._handle_in_line(line)
+		finally:
+			self.on_batch_finished()
+
+	def _handle_in_line(self, line):
+		try:
+			self._data_in_handler(line)
 		except:
 			LOG_CURRENT_EXCEPTION()
 			self.close()
-		self._in_line = ""
 
 	@LOG_CALL(msg=">> {data}")
 	def push(self, data):
@@ -542,25 +610,60 @@ class _ClientQueryProtocol(AsynchatExtended):
 			self._data_in_handler = self._handle_in_data_actions
 			self.on_ready()
 
+	def add_event_handler(self, event_name, handler):
+		'''Adds 'handler' to be called with lines of event 'event_name'.'''
+		# handlers are kept in tuples so that dispatching can iterate them
+		# while handlers are added or removed
+		self._event_handlers[event_name] = self._event_handlers.get(event_name, ()) + (handler,)
+
+	def remove_event_handler(self, event_name, handler):
+		handlers = list(self._event_handlers.get(event_name, ()))
+		if handler in handlers:
+			handlers.remove(handler)
+			if handlers:
+				self._event_handlers[event_name] = tuple(handlers)
+			else:
+				del self._event_handlers[event_name]
+
 	def _handle_in_data_actions(self, line):
 		'''Handles received events and responses to commands.'''
-		first_word = line.split(None, 1)[0]
+		# look up only the first word, no need to split the whole line
+		end = line.find(" ")
+		first_word = line if end == -1 else line[:end]
+		handlers = self._event_handlers.get(first_word)
 		# maybe an event?
-		if first_word in self._event_handlers:
-			self._event_handlers[first_word](line)
+		if handlers is not None:
+			for handler in handlers:
+				handler(line)
 		# if not, then maybe a response to command?
 		else:
 			try:
-				self._commands[0].handle_line(line)
+				cmd = self._commands[0]
 			except IndexError:
-				pass
+				return
+			cmd.handle_line(line)
+			if self.pipelined and cmd.is_done:
+				self._finish_command(cmd)
+				self._send_pipelined_commands()
 
 	def handle_out_commands(self):
-		'''Sends commands to client query (if any) in a serialized manner, not
-		sending more than one command at once. This so that we know which
-		response is meant for which command.
+		'''Sends commands to client query (if any) and finishes commands which
+		are done.
+
+		By default commands are sent in a serialized manner, not sending more
+		than one command at once. This so that we know which response is meant
+		for which command.
+
+		In pipelined mode commands are sent back to back as soon as they are
+		queued, and responses are matched to commands in the order the
+		commands were sent, each response ending to an 'error id=' line.
 		'''
 		if self._data_in_handler == self._handle_in_data_actions:
+			if self.pipelined:
+				while self._commands and self._commands[0].is_done:
+					self._finish_command(self._commands[0])
+				self._send_pipelined_commands()
+				return
 			try:
 				cmd = self._commands[0]
 				if not cmd.is_sent:
@@ -568,51 +671,150 @@ class _ClientQueryProtocol(AsynchatExtended):
 					cmd.is_sent = True
 				if cmd.is_done:
 					self._commands.remove(cmd)
+					self._timeouts.cancel(cmd)
 					cmd.finish()
 			except IndexError:
 				pass
 
-	def send_command(self, command, callback, timeout):
-		'''Queues command for sending to client query.'''
+	def send_command(self, command, callback, timeout, response_optional=False):
+		'''Queues command for sending to client query. If 'response_optional'
+		is True, client query may leave the command unanswered and reaching
+		the timeout is not an error.
+		'''
 		if self._data_in_handler == self._handle_in_data_actions:
-			self._commands.append(_ClientQueryCommand(command, callback, timeout))
+			cmd = _ClientQueryCommand(command, callback, response_optional)
+			self._commands.append(cmd)
+			self._timeouts.call_later(cmd, timeout, with_args(self._on_timeout, cmd))
+			if self.pipelined:
+				self._send_pipelined_commands()
 		else:
 			callback(CommandIgnoredError("Cannot send command '{0}', wrong state".format(command)), None)
 
+	def _send_pipelined_commands(self):
+		for cmd in self._commands[:_MAX_PIPELINED_COMMANDS]:
+			if cmd.response_optional:
+				# a response which may never come can't be told apart from
+				# responses to other commands, so the command is sent alone
+				# and later commands wait until it has finished
+				if cmd is self._commands[0] and not cmd.is_sent:
+					self.push(cmd.command + "\n\r")
+					cmd.is_sent = True
+				return
+			if not cmd.is_sent:
+				self.push(cmd.command + "\n\r")
+				cmd.is_sent = True
+
+	def _finish_command(self, cmd):
+		self._commands.remove(cmd)
+		self._timeouts.cancel(cmd)
+		try:
+			cmd.finish()
+		except:
+			LOG_CURRENT_EXCEPTION()
+
+	def _on_timeout(self, cmd):
+		'''Times out command whose deadline has passed, its callback is
+		called with CommandTimeoutError. A command which has not been sent yet
+		is dropped from the queue. A sent command stays in the queue until its
+		response has been received in full, so that the late response is not
+		matched to the next command.
+		'''
+		if cmd.is_finished:
+			return
+		cmd.time_out()
+		if not cmd.is_sent and cmd in self._commands:
+			self._commands.remove(cmd)
+		try:
+			cmd.finish()
+		except:
+			LOG_CURRENT_EXCEPTION()
+		self.handle_out_commands()
+
+_EVENT_HANDLER_NAMES = {}
+
+def get_event_handler_names(cls):
+	'''Returns a dict of event names mapped to names of the event handler
+	methods in class 'cls'. Event handler methods are named as
+	'on_<event name>_ts3_event'. The dict is built once per class.
+	'''
+	try:
+		return _EVENT_HANDLER_NAMES[cls]
+	except KeyError:
+		names = {}
+		for attr in dir(cls):
+			if attr.startswith("on_") and attr.endswith("_ts3_event"):
+				name = attr[len("on_"):-len("_ts3_event")]
+				if name:
+					names[name] = attr
+		_EVENT_HANDLER_NAMES[cls] = names
+		return names
+
+def coalesce_state_events(lines):
+	'''Returns given lines without state events which are followed by
+	another event of same type and for same client later in the lines.
+	Order of the remaining lines is preserved.
+	'''
+	result = []
+	seen_keys = set()
+	for line in reversed(lines):
+		name, _, parameters_str = line.partition(" ")
+		if name in _STATE_EVENT_KEYS:
+			key = (name,) + parse_client_query_values(parameters_str, *_STATE_EVENT_KEYS[name])
+			if key in seen_keys:
+				continue
+			seen_keys.add(key)
+		result.append(line)
+	result.reverse()
+	return result
+
 class _ClientQueryCommand(object):
 	'''Container for a single command, handles receiving response lines and
 	calling a callback provided by the caller with the response, or error.
 	'''
 
-	def __init__(self, command, callback, timeout):
+	def __init__(self, command, callback, response_optional=False):
 		self.command = command
+		self.response_optional = response_optional
 		self.is_sent = False
-		self._is_done = False
+		self.is_done = False
+		self.is_finished = False
 		self._callback = callback
 		self._response_lines = []
-		self._start_time = time.time()
 		self._err = None
-		self._timeout = timeout
-
-	@property
-	def is_done(self):
-		return self._is_done or (time.time() - self._start_time) >= self._timeout
 
 	def handle_line(self, line):
 		'''Handles a single line received from client query.'''
 		# last response line, if contains error status
 		if line.startswith("error "):
-			self._err = clientquery.checkError([line])
-			self._is_done = True
+			if not self.is_finished:
+				self._err = clientquery.checkError([line])
+			self.is_done = True
 		# collect lines before error status line
 		else:
 			self._response_lines.append(line)
 
+	def time_out(self):
+		'''Fails the command with a timeout error. A command which has been
+		sent is done only once rest of its response has been received.
+		Command whose response is optional is simply done.
+		'''
+		if self.response_optional:
+			self.is_done = True
+			return
+		self._err = CommandTimeoutError("Command timed out: {0}".format(self.command))
+		if not self.is_sent:
+			self.is_done = True
+
 	def finish(self):
-		self._callback(self._err, self._response_lines)
+		'''Calls the callback with the response, only once.'''
+		if not self.is_finished:
+			self.is_finished = True
+			self._callback(self._err, self._response_lines)
 
 	def closed(self):
-		self._callback(ProtocolClosed("Command discarded: {0}".format(self.command)), None)
+		if not self.is_finished:
+			self.is_finished = True
+			self._callback(ProtocolClosed("Command discarded: {0}".format(self.command)), None)
 
 class ProtocolClosed(Exception):
 	pass
@@ -620,10 +822,33 @@ class ProtocolClosed(Exception):
 class CommandIgnoredError(Exception):
 	pass
 
+class CommandTimeoutError(Exception):
+	pass
+
 class User(object):
+	'''A TeamSpeak user in UserModel. Uses slots as there may be hundreds of
+	users in view on large servers.
+
+	The 'model' should be a weak proxy to the UserModel to avoid reference
+	cycles, UserModel shares a single proxy between all of its users.
+	'''
+
+	__slots__ = (
+		"__model",
+		"__nick",
+		"__wot_nick",
+		"__client_id",
+		"__unique_id",
+		"__channel_id",
+		"__speaking"
+	)
+
+	FIELDS = ("nick", "wot_nick", "client_id", "unique_id", "channel_id", "speaking")
+	# fields which UserModel keeps indexes for
+	INDEXED_FIELDS = ("wot_nick", "unique_id", "channel_id")
 
 	def __init__(self, model):
-		self.__model = weakref.proxy(model)
+		self.__model = model
 		self.__nick = None
 		self.__wot_nick = None
 		self.__client_id = None
@@ -646,7 +871,9 @@ class User(object):
 	@wot_nick.setter
 	def wot_nick(self, wot_nick):
 		if wot_nick is not None and self.__wot_nick != wot_nick:
+			old_wot_nick = self.__wot_nick
 			self.__wot_nick = wot_nick
+			self.__notify_field_changed("wot_nick", old_wot_nick, wot_nick)
 			self.__notify_modified()
 
 	@property
@@ -664,7 +891,9 @@ class User(object):
 	@unique_id.setter
 	def unique_id(self, unique_id):
 		if unique_id is not None and self.__unique_id != unique_id:
+			old_unique_id = self.__unique_id
 			self.__unique_id = unique_id
+			self.__notify_field_changed("unique_id", old_unique_id, unique_id)
 			self.__notify_modified()
 
 	@property
@@ -673,7 +902,9 @@ class User(object):
 	@channel_id.setter
 	def channel_id(self, channel_id):
 		if channel_id is not None and self.__channel_id != channel_id:
+			old_channel_id = self.__channel_id
 			self.__channel_id = channel_id
+			self.__notify_field_changed("channel_id", old_channel_id, channel_id)
 			self.__notify_modified()
 
 	@property
@@ -685,9 +916,35 @@ class User(object):
 			self.__speaking = speaking
 			self.__notify_modified()
 
+	def update(self, **fields):
+		'''Sets values of given fields at once, ignoring None values. Notifies
+		the model at most once. Returns True if any value was changed.
+		'''
+		changes = []
+		for name, value in fields.items():
+			if name not in self.FIELDS:
+				raise TypeError("Unknown user field: {0}".format(name))
+			if value is None:
+				continue
+			attr = "_User__" + name
+			old_value = getattr(self, attr)
+			if old_value != value:
+				setattr(self, attr, value)
+				changes.append((name, old_value, value))
+		if changes:
+			for name, old_value, value in changes:
+				if name in self.INDEXED_FIELDS:
+					self.__notify_field_changed(name, old_value, value)
+			self.__notify_modified()
+		return bool(changes)
+
+	def __notify_field_changed(self, name, old_value, new_value):
+		if self.__client_id is not None and self.__client_id in self.__model:
+			self.__model.notify_field_changed(self.__client_id, name, old_value, new_value)
+
 	def __notify_modified(self):
 		if self.__client_id is not None and self.__client_id in self.__model:
-			self.__model.on_modified(self.__client_id)
+			self.__model.notify_modified(self.__client_id)
 
 	def __hash__(self):
 		return (
@@ -715,10 +972,62 @@ class UserModel(object):
 
 	def __init__(self):
 		self._users = {}
+		self._proxy = weakref.proxy(self)
+		self._indexes = {
+			"channel_id": _UserIndex(),
+			"unique_id": _UserIndex(),
+			# WoT nicknames are matched case insensitively
+			"wot_nick": _UserIndex(key_func=lambda wot_nick: wot_nick.lower() if wot_nick else None)
+		}
+		self._batch_depth = 0
+		self._modified_client_ids = collections.OrderedDict()
 		self.on_added = Event.Event()
 		self.on_removed = Event.Event()
 		self.on_modified = Event.Event()
 
+	def begin_batch(self):
+		'''Starts a batch of changes. Until end_batch() is called,
+		modification notifications are collected and each modified user is
+		notified only once when the batch ends. Batches can be nested.
+		'''
+		self._batch_depth += 1
+
+	def end_batch(self):
+		'''Ends a batch of changes and notifies collected modifications.'''
+		self._batch_depth -= 1
+		if self._batch_depth == 0:
+			while self._modified_client_ids:
+				client_id, _ = self._modified_client_ids.popitem(last=False)
+				self.on_modified(client_id)
+
+	def notify_field_changed(self, client_id, name, old_value, new_value):
+		index = self._indexes.get(name)
+		if index is not None:
+			index.remove(client_id, old_value)
+			index.add(client_id, new_value)
+
+	def client_ids_in_channel(self, channel_id):
+		'''Returns set of ids of clients in channel 'channel_id'.'''
+		return self._indexes["channel_id"].get(channel_id)
+
+	def client_ids_by_unique_id(self, unique_id):
+		'''Returns set of ids of clients with unique id 'unique_id'. There
+		can be several if the same user is connected more than once.
+		'''
+		return self._indexes["unique_id"].get(unique_id)
+
+	def client_ids_by_wot_nick(self, wot_nick):
+		'''Returns set of ids of clients with WoT nickname 'wot_nick',
+		compared case insensitively.
+		'''
+		return self._indexes["wot_nick"].get(wot_nick)
+
+	def notify_modified(self, client_id):
+		if self._batch_depth:
+			self._modified_client_ids[client_id] = True
+		else:
+			self.on_modified(client_id)
+
 	def fini(self):
 		self.on_added.clear()
 		self.on_removed.clear()
@@ -728,24 +1037,32 @@ class UserModel(object):
 		if client_id is None:
 			return
 
-		user = self._users.get(client_id, User(self))
-		user.client_id = client_id
-		user.nick = nick
-		user.wot_nick = wot_nick
-		user.unique_id = unique_id
-		user.channel_id = channel_id
-
-		if client_id not in self._users:
+		user = self._users.get(client_id)
+		if user is None:
+			user = User(self._proxy)
+			user.update(client_id=client_id, nick=nick, wot_nick=wot_nick, unique_id=unique_id, channel_id=channel_id)
 			self._users[client_id] = user
+			for name, index in self._indexes.items():
+				index.add(client_id, getattr(user, name))
 			self.on_added(client_id)
+		else:
+			user.update(nick=nick, wot_nick=wot_nick, unique_id=unique_id, channel_id=channel_id)
 
 	def remove(self, client_id):
 		self._users[client_id].speaking = False
-		del self._users[client_id]
+		# listeners must see pending modifications before the user is gone
+		if self._modified_client_ids.pop(client_id, None):
+			self.on_modified(client_id)
+		user = self._users.pop(client_id)
+		for name, index in self._indexes.items():
+			index.remove(client_id, getattr(user, name))
 		self.on_removed(client_id)
 
 	def clear(self):
-		client_ids = self._users.keys()
+		client_ids = list(self._users.keys())
+		self._modified_client_ids.clear()
+		for index in self._indexes.values():
+			index.clear()
 		self._users.clear()
 		for client_id in client_ids:
 			self.on_removed(client_id)
@@ -763,6 +1080,56 @@ class UserModel(object):
 	def __len__(self):
 		return len(self._users)
 
+class _UserIndex(object):
+	'''Maps values of a user field to client ids. Most values belong to a
+	single client, so a lone client id is stored as is and a set is created
+	only when a value is shared by several clients.
+	'''
+
+	def __init__(self, key_func=None):
+		self._key_func = key_func
+		self._client_ids = {}
+
+	def add(self, client_id, value):
+		key = self.__get_key(value)
+		if key is None:
+			return
+		client_ids = self._client_ids.get(key)
+		if client_ids is None:
+			self._client_ids[key] = client_id
+		elif isinstance(client_ids, set):
+			client_ids.add(client_id)
+		elif client_ids != client_id:
+			self._client_ids[key] = set([client_ids, client_id])
+
+	def remove(self, client_id, value):
+		key = self.__get_key(value)
+		client_ids = self._client_ids.get(key)
+		if client_ids is None:
+			return
+		if isinstance(client_ids, set):
+			client_ids.discard(client_id)
+			if len(client_ids) == 1:
+				self._client_ids[key] = next(iter(client_ids))
+		elif client_ids == client_id:
+			del self._client_ids[key]
+
+	def get(self, value):
+		client_ids = self._client_ids.get(self.__get_key(value))
+		if client_ids is None:
+			return set()
+		if isinstance(client_ids, set):
+			return set(client_ids)
+		return set([client_ids])
+
+	def clear(self):
+		self._client_ids.clear()
+
+	def __get_key(self, value):
+		if value is not None and self._key_func:
+			return self._key_func(value)
+		return value
+
 class UserFilterProxy(object):
 
 	def __init__(self, source, filter_func):
@@ -784,16 +1151,38 @@ class UserFilterProxy(object):
 		self.on_modified.clear()
 
 	def invalidate(self):
-		for client_id in self._client_ids:
-			self.on_removed(client_id)
-		self._client_ids.clear()
-		for client_id in self._source:
-			self._on_source_added(client_id)
+		'''Re-evaluates the filter, e.g. after the filter function's
+		criteria has changed. Notifies removals and additions only for
+		clients whose inclusion actually changed.
+		'''
+		new_client_ids = self._get_included_client_ids()
+		removed_client_ids = self._client_ids - new_client_ids
+		added_client_ids = new_client_ids - self._client_ids
+		for client_id in removed_client_ids:
+			self.__remove_client(client_id)
+		for client_id in added_client_ids:
+			self.__add_client(client_id)
 
 	def itervalues(self):
 		for client_id in self._client_ids:
 			yield self._source[client_id]
 
+	def client_ids_by_unique_id(self, unique_id):
+		'''Returns set of ids of included clients with unique id 'unique_id'.'''
+		return self._source.client_ids_by_unique_id(unique_id) & self._client_ids
+
+	def client_ids_by_wot_nick(self, wot_nick):
+		'''Returns set of ids of included clients with WoT nickname
+		'wot_nick', compared case insensitively.
+		'''
+		return self._source.client_ids_by_wot_nick(wot_nick) & self._client_ids
+
+	def _get_included_client_ids(self):
+		'''Returns set of ids of source's clients which pass the filter.'''
+		filter_func = self._filter_func
+		source = self._source
+		return set(client_id for client_id in source if filter_func(source[client_id]))
+
 	def __getitem__(self, client_id):
 		return self._source[client_id]
 
@@ -833,18 +1222,69 @@ class UserFilterProxy(object):
 			self._client_ids.remove(client_id)
 			self.on_removed(client_id)
 
+class ChannelFilterProxy(UserFilterProxy):
+	'''Filter proxy which includes users of a single channel. Uses source
+	UserModel's channel index, so changing the channel costs in proportion to
+	populations of the channels instead of the whole server.
+	'''
+
+	def __init__(self, source, channel_id=None):
+		self._channel_id = channel_id
+		UserFilterProxy.__init__(self,
+			source      = source,
+			filter_func = lambda user: self._channel_id is not None and user.channel_id == self._channel_id
+		)
+
+	@property
+	def channel_id(self):
+		return self._channel_id
+
+	def set_channel_id(self, channel_id):
+		'''Changes the channel, notifying only users whose inclusion changes.'''
+		if channel_id != self._channel_id:
+			self._channel_id = channel_id
+			self.invalidate()
+
+	def _get_included_client_ids(self):
+		return self._source.client_ids_in_channel(self._channel_id)
+
 def parse_client_query_parameter(parameters_str, parameter):
-	# NOTE: this can raise error (too many values to unpack) if 'parameters_str'
-	# contains a list (separated with '|'), in such case the
+	# NOTE: only the first entry is looked at if 'parameters_str' contains a
+	# list (separated with '|'), in such case the
 	# parse_client_query_parameters() function should be used
-	[entry] = parse_client_query_parameters(parameters_str)
-	return entry.get(parameter)
+	[value] = parse_client_query_values(parameters_str, parameter)
+	return value
 
-def parse_client_query_parameters(parameters_str):
-	return ParamsParser().parse(parameters_str)
+def parse_client_query_values(parameters_str, *parameters):
+	'''Returns values of given 'parameters' from the first entry of
+	'parameters_str' as a tuple, with None for parameters which are missing.
 
-class LineEnd(object):
-	pass
+	Unlike parse_client_query_parameters() this does not split the whole
+	string, it only looks up the requested parameters and unescapes just their
+	values. Use this for frequent events where few parameters are needed.
+	'''
+	entry_str = parameters_str.partition("|")[0]
+	values = []
+	for parameter in parameters:
+		key_str = parameter + "="
+		if entry_str.startswith(key_str):
+			start = len(key_str)
+		else:
+			start = entry_str.find(" " + key_str)
+			if start == -1:
+				# parameter might still be present without a value
+				values.append("" if parameter in entry_str.split(" ") else None)
+				continue
+			start += len(key_str) + 1
+		end = entry_str.find(" ", start)
+		value = entry_str[start:end] if end != -1 else entry_str[start:]
+		if "\\" in value:
+			value = _PARAMS_PARSER.unescape(value)
+		values.append(value)
+	return tuple(values)
+
+def parse_client_query_parameters(parameters_str):
+	return _PARAMS_PARSER.parse(parameters_str)
 
 class ParamsParser(object):
 
@@ -893,57 +1333,31 @@ class ParamsParser(object):
 		"v": "\v"
 	}
 
-	def parse(self, parameter_str):
-		self._entry = {}
-		self._entries = []
-		self._change_parse_state(self._parse_key)
-		for char in parameter_str:
-			self._char_parser(char)
-		self._char_parser(LineEnd)
-		# Remove reference to itself to allow ParamsParser to delete
-		self._char_parser = None
-		return self._entries
-
-	def _parse_common(self, char):
-		if char == " ":
-			self._entry[self._key_name] = self._key_value
-			self._change_parse_state(self._parse_key)
-			return True
-		if char == LineEnd:
-			self._entry[self._key_name] = self._key_value
-			self._entries.append(self._entry)
-			return True
-		if char == "|":
-			self._entry[self._key_name] = self._key_value
-			self._entries.append(self._entry)
-			self._entry = {}
-			self._change_parse_state(self._parse_key)
-			return True
-		return False
+	_ESCAPE_PATTERN = re.compile(r"\\(.?)", re.DOTALL)
 
-	def _parse_key(self, char):
-		if not self._parse_common(char):
-			if char == "=":
-				self._change_parse_state(self._parse_value)
-			else:
-				self._key_name += char
-
-	def _parse_value(self, char):
-		if not self._parse_common(char):
-			if char == "\\" and not self._escaping:
-				self._escaping = True
-			elif self._escaping:
-				self._key_value += self._ESCAPE_LOOKUP[char]
-				self._escaping = False
-			else:
-				self._key_value += char
-
-	def _change_parse_state(self, parse_func):
-		if parse_func == self._parse_key:
-			self._key_name = ""
-			self._key_value = ""
-			self._escaping = False
-		self._char_parser = parse_func
+	def parse(self, parameter_str):
+		entries = []
+		for entry_str in parameter_str.split("|"):
+			entry = {}
+			for param_str in entry_str.split(" "):
+				key, _, value = param_str.partition("=")
+				entry[key] = self.unescape(value)
+			entries.append(entry)
+		return entries
+
+	def unescape(self, value):
+		if "\\" not in value:
+			return value
+		return self._ESCAPE_PATTERN.sub(self._unescape_match, value)
+
+	def _unescape_match(self, match):
+		char = match.group(1)
+		# A lone backslash at the end of a value has nothing to escape, drop it
+		if not char:
+			return ""
+		return self._ESCAPE_LOOKUP[char]
+
+_PARAMS_PARSER = ParamsParser()
 
 def build_command_string(command, args, kwargs):
 	fragments = [command]
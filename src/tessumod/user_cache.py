@@ -16,6 +16,7 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 from .unicode_aware import ConfigParser
+import collections
 import csv
 import io
 import os
@@ -23,7 +24,15 @@ import re
 
 import Event
 
-from .py3compat import PY2, to_unicode
+try:
+	import sqlite3
+except ImportError:
+	# not all Python builds include sqlite3
+	sqlite3 = None
+
+from .file_watch import FileWatcher
+from .file_writer import FileWriter
+from .py3compat import PY2, monotonic_time, to_unicode
 from .utils import LOG_ERROR, LOG_NOTE, iteritems
 
 _GENERAL_HELP = u"""
@@ -79,22 +88,37 @@ _PAIRINGS_HELP = u"""
 
 class UserCache(object):
 
-	def __init__(self, ini_path):
+	def __init__(self, ini_path, file_watcher=None, file_writer=None, db_path=None):
+		'''If 'db_path' is given, the cache is stored into SQLite database in
+		that path and the ini-file is kept only as import/export format for
+		hand editing. Falls back to ini-file if sqlite3 is not available.
+		'''
 		self.on_updated = Event.Event()
+		self.on_loaded = Event.Event()
 		self.on_read_error = Event.Event()
 		self._ts_users = {}
 		self._players = {}
+		# ts_user_id -> player ids and player_id -> ts user ids, both as
+		# insertion ordered sets (OrderedDicts with None values)
 		self._pairings = {}
-		self._ini_cache = INICache(ini_path)
-		self._ini_cache.on_init_cleanup = self._on_init_cleanup
-		self._ini_cache.on_read += self._on_read
-		self._ini_cache.on_write += self._on_write
-		self._ini_cache.on_write_io += self._on_write_io
+		self._player_pairings = {}
+		if db_path is not None and sqlite3 is None:
+			LOG_NOTE(u"sqlite3 is not available, storing user cache to ini-file")
+			db_path = None
+		if db_path is not None:
+			self._storage = SQLiteCache(db_path, ini_path, file_watcher, file_writer)
+			self._storage.on_load += self._on_load
+		else:
+			self._storage = INICache(ini_path, file_watcher, file_writer)
+		self._storage.on_init_cleanup = self._on_init_cleanup
+		self._storage.on_read += self._on_read
+		self._storage.get_snapshot = self._get_snapshot
+		self._storage.render = _render_cache_file
 		self._read_error = False
 		self._write_enabled = True
 
 	def init(self):
-		self._ini_cache.init()
+		self._storage.init()
 
 	def _on_read(self, parser):
 		error_message = None
@@ -103,7 +127,7 @@ class UserCache(object):
 			players       = {nick.lower(): id for nick, id in parser.items(u"GamePlayers")}
 			nick_pairings = {ts_nick.lower(): csv_split(p_nicks.lower()) \
 								for ts_nick, p_nicks in parser.items(u"UserPlayerPairings")}
-			id_pairings   = {}
+			id_pairings   = []
 
 			for ts_nick in nick_pairings:
 				try:
@@ -112,63 +136,64 @@ class UserCache(object):
 					error_message = u"Player {0} is not defined".format(error)
 					raise
 				try:
-					id_pairings[ts_users[ts_nick]] = player_ids
+					ts_user_id = ts_users[ts_nick]
 				except KeyError as error:
 					error_message = u"TeamSpeak user {0} is not defined".format(error)
 					raise
+				id_pairings.append((ts_user_id, player_ids))
 
-			self._ts_users = {id: nick for nick, id in iteritems(ts_users)}
-			self._players = {id: nick for nick, id in iteritems(players)}
-			self._pairings = id_pairings
+			self._on_load(
+				{id: nick for nick, id in iteritems(ts_users)},
+				{id: nick for nick, id in iteritems(players)},
+				((ts_user_id, player_id) for ts_user_id, player_ids in id_pairings for player_id in player_ids),
+				ts_user_ids = (ts_user_id for ts_user_id, _ in id_pairings)
+			)
 			self._read_error = False
 			self._update_write_allowed()
-			self.on_updated()
 		except Exception as error:
 			self._read_error = True
 			self._update_write_allowed()
 			self.on_read_error(error_message if error_message else error)
 			raise
 
+	def _on_load(self, ts_users, players, pairings, ts_user_ids=()):
+		'''Replaces cached data with 'ts_users' and 'players' dicts (id ->
+		nick) and 'pairings' sequence of (ts_user_id, player_id) tuples.
+		Users in 'ts_user_ids' are considered paired even without players.
+		'''
+		id_pairings = {ts_user_id: collections.OrderedDict() for ts_user_id in ts_user_ids}
+		player_pairings = {}
+		for ts_user_id, player_id in pairings:
+			id_pairings.setdefault(ts_user_id, collections.OrderedDict())[player_id] = None
+			player_pairings.setdefault(player_id, collections.OrderedDict())[ts_user_id] = None
+		self._ts_users = ts_users
+		self._players = players
+		self._pairings = id_pairings
+		self._player_pairings = player_pairings
+		self.on_loaded()
+		self.on_updated()
+
 	def _on_init_cleanup(self):
 		'''Removes TeamSpeak user and WOT players who do not appear in the pairings.'''
-		cleanup_ts_ids = [id for id in self._ts_users]
-		cleanup_player_ids = [id for id in self._players]
-		for ts_id, player_ids in iteritems(self._pairings):
-			cleanup_ts_ids.remove(ts_id)
-			for player_id in self._pairings[ts_id]:
-				try:
-					cleanup_player_ids.remove(player_id)
-				except:
-					pass
+		cleanup_ts_ids = [id for id in self._ts_users if id not in self._pairings]
+		cleanup_player_ids = [id for id in self._players if id not in self._player_pairings]
 		for id in cleanup_ts_ids:
 			del self._ts_users[id]
 		for id in cleanup_player_ids:
 			del self._players[id]
 		if cleanup_ts_ids or cleanup_player_ids:
+			self._storage.removed(cleanup_ts_ids, cleanup_player_ids)
 			self.on_updated()
 
-	def _on_write(self, parser):
-		parser.add_section(u"TeamSpeakUsers")
-		parser.add_section(u"GamePlayers")
-		parser.add_section(u"UserPlayerPairings")
-		for id, nick in iteritems(self._ts_users):
-			parser.set(u"TeamSpeakUsers", ini_escape(nick), id)
-		for id, nick in iteritems(self._players):
-			parser.set(u"GamePlayers", ini_escape(nick), id)
-		for ts_id, player_ids in iteritems(self._pairings):
-			parser.set(u"UserPlayerPairings",
-				ini_escape(self._ts_users[ts_id]),
-				ini_escape(csv_join([self._players[player_id] for player_id in player_ids]))
-			)
-
-	def _on_write_io(self, string_io):
-		ini_contents = string_io.getvalue()
-		ini_contents = ini_contents.replace(u"[TeamSpeakUsers]",     _TS_USERS_HELP + u"\n[TeamSpeakUsers]", 1)
-		ini_contents = ini_contents.replace(u"[GamePlayers]",        _PLAYERS_HELP  + u"\n[GamePlayers]", 1)
-		ini_contents = ini_contents.replace(u"[UserPlayerPairings]", _PAIRINGS_HELP + u"\n[UserPlayerPairings]", 1)
-		string_io.truncate(0)
-		string_io.seek(0)
-		string_io.write(_GENERAL_HELP + "\n\n\n" + ini_contents)
+	def _get_snapshot(self):
+		'''Returns copy of cached data for rendering the cache file. Called in
+		game thread while the rendering may happen in another thread.
+		'''
+		return (
+			dict(self._ts_users),
+			dict(self._players),
+			{ts_id: list(player_ids) for ts_id, player_ids in iteritems(self._pairings)}
+		)
 
 	@property
 	def is_write_enabled(self):
@@ -180,33 +205,43 @@ class UserCache(object):
 		self._update_write_allowed()
 
 	def _update_write_allowed(self):
-		self._ini_cache.is_write_allowed = self._write_enabled and not self._read_error
+		self._storage.is_write_allowed = self._write_enabled and not self._read_error
+
+	@property
+	def write_delay(self):
+		'''Time (in seconds) that changes are collected before writing them
+		to the cache file.'''
+		return self._storage.write_delay
+
+	@write_delay.setter
+	def write_delay(self, value):
+		self._storage.write_delay = value
 
 	@property
 	def ini_path(self):
-		return self._ini_cache.ini_path
+		return self._storage.ini_path
 
 	def add_ts_user(self, name, id):
 		if id not in self._ts_users:
 			self._ts_users[to_unicode(id)] = to_unicode(name).lower()
-			self._ini_cache.write_needed()
+			self._storage.ts_user_added(to_unicode(id), self._ts_users[to_unicode(id)])
 			self.on_updated()
 
 	def add_player(self, name, id):
 		id = to_unicode(id)
 		if id not in self._players:
 			self._players[id] = to_unicode(name).lower()
-			self._ini_cache.write_needed()
+			self._storage.player_added(id, self._players[id])
 			self.on_updated()
 
 	def pair(self, player_id, ts_user_id):
 		player_id = to_unicode(player_id)
 		ts_user_id = to_unicode(ts_user_id)
-		if ts_user_id not in self._pairings:
-			self._pairings[ts_user_id] = []
-		if player_id not in self._pairings[ts_user_id]:
-			self._pairings[ts_user_id].append(player_id)
-			self._ini_cache.write_needed()
+		player_ids = self._pairings.setdefault(ts_user_id, collections.OrderedDict())
+		if player_id not in player_ids:
+			player_ids[player_id] = None
+			self._player_pairings.setdefault(player_id, collections.OrderedDict())[ts_user_id] = None
+			self._storage.paired(ts_user_id, player_id)
 			self.on_updated()
 
 	def get_paired_player_ids(self, ts_user_id):
@@ -215,21 +250,37 @@ class UserCache(object):
 			for player_id in self._pairings[ts_user_id]:
 				yield int(player_id)
 
+	def get_paired_ts_user_ids(self, player_id):
+		player_id = to_unicode(player_id)
+		if player_id in self._player_pairings:
+			for ts_user_id in self._player_pairings[player_id]:
+				yield ts_user_id
+
 	def sync(self, force=False):
-		self._ini_cache.sync(force)
+		self._storage.sync(force)
+
+	def fini(self):
+		self._storage.fini()
 
 class INICache(object):
 
-	def __init__(self, ini_path):
-		self._sync_time = 0
+	def __init__(self, ini_path, file_watcher=None, file_writer=None):
 		self._parser = None
 		self._write_needed = False
+		self._write_needed_time = None
 		self.ini_path = ini_path
+		if file_watcher is None:
+			file_watcher = FileWatcher()
+		self._watch = file_watcher.watch(ini_path)
+		self._writer = file_writer if file_writer is not None else FileWriter()
 		self.on_init_cleanup = Event.Event()
 		self.on_read = Event.Event()
-		self.on_write = Event.Event()
-		self.on_write_io = Event.Event()
+		# returns data to write, called in game thread
+		self.get_snapshot = None
+		# renders snapshot into file contents, may be called in another thread
+		self.render = None
 		self.is_write_allowed = True
+		self.write_delay = 0
 		self._initialized = False
 
 	def init(self):
@@ -237,16 +288,33 @@ class INICache(object):
 			return
 		self._read_cache_file()
 		self.on_init_cleanup()
-		self._write_cache_file()
+		# written immediately, an external modification right after init must
+		# not get overwritten by a write still in progress
+		self._write_cache_file(immediate=True)
 		self.sync()
 		self._initialized = True
 
 	def write_needed(self):
-		self._write_needed = True
+		if not self._write_needed:
+			self._write_needed = True
+			self._write_needed_time = monotonic_time()
+
+	def ts_user_added(self, id, nick):
+		self.write_needed()
+
+	def player_added(self, id, nick):
+		self.write_needed()
+
+	def paired(self, ts_user_id, player_id):
+		self.write_needed()
+
+	def removed(self, ts_user_ids, player_ids):
+		self.write_needed()
 
 	def _read_cache_file(self):
+		'''Reads the cache file, returns True if reading succeeded.'''
 		if not os.path.isfile(self.ini_path):
-			return
+			return False
 		parser = ConfigParser()
 
 		try:
@@ -255,39 +323,227 @@ class INICache(object):
 		except Exception as error:
 			LOG_ERROR(u"Failed to parse ini file '{0}', reason: {1}"
 				.format(self.ini_path, to_unicode(error)))
-			return
+			return False
 		self.on_read(parser)
-		self._update_sync_time()
+		self._watch.acknowledge()
+		# file contents are no longer what was written last time
+		self._writer.forget(self.ini_path)
+		return True
 
-	def _update_sync_time(self):
-		self._sync_time = self._get_modified_time()
+	def _reload_cache_file(self):
+		self._read_cache_file()
 
-	def _write_cache_file(self):
+	def _write_cache_file(self, immediate=False):
 		if self.is_write_allowed:
-			parser = ConfigParser()
-			self.on_write(parser)
-			with io.open(self.ini_path, "wt", encoding="utf8") as f:
-				string_io = io.StringIO()
-				parser.write(string_io)
-				self.on_write_io(string_io)
-				f.write(string_io.getvalue())
-			self._update_sync_time()
+			write = self._writer.write_now if immediate else self._writer.write
+			write(self.ini_path, self.render, self.get_snapshot())
+			self._acknowledge_finished_writes()
 		self._write_needed = False
 
+	def _acknowledge_finished_writes(self):
+		if self.ini_path in self._writer.pop_finished():
+			self._watch.acknowledge()
+
 	def sync(self, force=False):
-		if force or self._is_cache_file_modified():
-			self._read_cache_file()
-		elif self._should_write_cache_file():
+		self._acknowledge_finished_writes()
+		# don't mistake own write in progress for modification by someone else
+		if force or (not self._writer.is_writing(self.ini_path) and self._watch.check()):
+			if os.path.isfile(self.ini_path):
+				self._reload_cache_file()
+				return
+			# cache file was removed, write it back
+			self._writer.forget(self.ini_path)
+			self._write_cache_file()
+		elif self._write_needed and self._is_write_delay_elapsed():
+			self._write_cache_file()
+
+	def _is_write_delay_elapsed(self):
+		return monotonic_time() - self._write_needed_time >= self.write_delay
+
+	def fini(self):
+		'''Writes pending changes to the cache file, ignoring write delay.'''
+		if self._write_needed:
 			self._write_cache_file()
 
-	def _get_modified_time(self):
-		return os.path.getmtime(self.ini_path)
+class SQLiteCache(INICache):
+	'''Stores cached data into SQLite database. Changes are written to the
+	database as inserts and deletes instead of rewriting everything, and
+	loading at startup needs no ini-parsing.
+
+	The ini-file is still exported after each delayed write so that it
+	stays up to date and can be edited by hand. When the ini-file is
+	modified, its contents are imported to the database.
+	'''
+
+	_SCHEMA = [
+		u"CREATE TABLE IF NOT EXISTS ts_users (id TEXT PRIMARY KEY, nick TEXT NOT NULL)",
+		u"CREATE TABLE IF NOT EXISTS players (id TEXT PRIMARY KEY, nick TEXT NOT NULL)",
+		u"CREATE TABLE IF NOT EXISTS pairings (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+			u"ts_user_id TEXT NOT NULL, player_id TEXT NOT NULL, UNIQUE (ts_user_id, player_id))",
+		u"CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+	]
+
+	def __init__(self, db_path, ini_path, file_watcher=None, file_writer=None):
+		super(SQLiteCache, self).__init__(ini_path, file_watcher, file_writer)
+		self.db_path = db_path
+		self.on_load = Event.Event()
+		self._connection = None
+		self._pending_statements = []
+		self._export_needed = False
 
-	def _is_cache_file_modified(self):
-		return self._sync_time < self._get_modified_time()
+	def init(self):
+		if self._initialized:
+			return
+		self._connection = sqlite3.connect(self.db_path)
+		self._connection.execute(u"PRAGMA journal_mode=WAL")
+		self._connection.execute(u"PRAGMA synchronous=NORMAL")
+		with self._connection:
+			for statement in self._SCHEMA:
+				self._connection.execute(statement)
+		# ini-file modified while the game was not running, or database is new
+		if not os.path.isfile(self.ini_path) or not self._import_cache_file():
+			self._load_database()
+		self.on_init_cleanup()
+		self._write_database()
+		if not os.path.isfile(self.ini_path):
+			self.export_cache_file(immediate=True)
+		self._watch.acknowledge()
+		self._initialized = True
 
-	def _should_write_cache_file(self):
-		return self._write_needed or not os.path.isfile(self.ini_path)
+	def _import_cache_file(self, force=False):
+		'''Replaces database contents with the ini-file's contents, if it
+		has changed since it was last imported or exported. Returns True
+		if the import was done.
+		'''
+		if not force and self._get_ini_signature() == self._get_meta(u"ini_signature"):
+			return False
+		if not self._read_cache_file():
+			return False
+		# contents were invalid (reported by owner with on_read_error) or
+		# writing is disabled, leave the database as it is
+		if not self.is_write_allowed:
+			return False
+		ts_users, players, pairings = self.get_snapshot()
+		with self._connection:
+			self._connection.execute(u"DELETE FROM ts_users")
+			self._connection.execute(u"DELETE FROM players")
+			self._connection.execute(u"DELETE FROM pairings")
+			self._connection.executemany(u"INSERT INTO ts_users VALUES (?, ?)", iteritems(ts_users))
+			self._connection.executemany(u"INSERT INTO players VALUES (?, ?)", iteritems(players))
+			self._connection.executemany(u"INSERT INTO pairings (ts_user_id, player_id) VALUES (?, ?)",
+				((ts_user_id, player_id) for ts_user_id, player_ids in iteritems(pairings) for player_id in player_ids))
+			self._set_meta(u"ini_signature", self._get_ini_signature())
+		del self._pending_statements[:]
+		self._export_needed = False
+		return True
+
+	def _load_database(self):
+		self.on_load(
+			dict(self._connection.execute(u"SELECT id, nick FROM ts_users")),
+			dict(self._connection.execute(u"SELECT id, nick FROM players")),
+			self._connection.execute(u"SELECT ts_user_id, player_id FROM pairings ORDER BY seq")
+		)
+
+	def _reload_cache_file(self):
+		self._import_cache_file(force=True)
+
+	def ts_user_added(self, id, nick):
+		self._add_statement(u"INSERT OR REPLACE INTO ts_users VALUES (?, ?)", (id, nick))
+
+	def player_added(self, id, nick):
+		self._add_statement(u"INSERT OR REPLACE INTO players VALUES (?, ?)", (id, nick))
+
+	def paired(self, ts_user_id, player_id):
+		self._add_statement(u"INSERT OR IGNORE INTO pairings (ts_user_id, player_id) VALUES (?, ?)",
+			(ts_user_id, player_id))
+
+	def removed(self, ts_user_ids, player_ids):
+		for id in ts_user_ids:
+			self._add_statement(u"DELETE FROM ts_users WHERE id = ?", (id,))
+		for id in player_ids:
+			self._add_statement(u"DELETE FROM players WHERE id = ?", (id,))
+
+	def _add_statement(self, statement, parameters):
+		self._pending_statements.append((statement, parameters))
+		self.write_needed()
+
+	def _write_cache_file(self, immediate=False):
+		self.export_cache_file(immediate)
+
+	def export_cache_file(self, immediate=False):
+		'''Writes database contents to the ini-file.'''
+		self._write_database()
+		super(SQLiteCache, self)._write_cache_file(immediate)
+		self._export_needed = False
+
+	def _write_database(self):
+		if self.is_write_allowed and self._pending_statements:
+			with self._connection:
+				for statement, parameters in self._pending_statements:
+					self._connection.execute(statement, parameters)
+			self._export_needed = True
+		del self._pending_statements[:]
+
+	def _acknowledge_finished_writes(self):
+		if self.ini_path in self._writer.pop_finished():
+			self._watch.acknowledge()
+			# exported ini-file matches the database, no need to import it
+			# on next startup
+			with self._connection:
+				self._set_meta(u"ini_signature", self._get_ini_signature())
+
+	def _get_ini_signature(self):
+		try:
+			stat = os.stat(self.ini_path)
+		except OSError:
+			return u""
+		return u"{0!r}:{1}".format(stat.st_mtime, stat.st_size)
+
+	def _get_meta(self, key):
+		row = self._connection.execute(u"SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+		return row[0] if row else None
+
+	def _set_meta(self, key, value):
+		self._connection.execute(u"INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+	def fini(self):
+		'''Writes pending changes, exports the ini-file and closes the
+		database.'''
+		if self._connection is None:
+			return
+		self._write_database()
+		if self._export_needed or self._writer.is_writing(self.ini_path):
+			self.export_cache_file(immediate=True)
+		self._acknowledge_finished_writes()
+		self._connection.close()
+		self._connection = None
+
+def _render_cache_file(snapshot):
+	ts_users, players, pairings = snapshot
+	parser = ConfigParser()
+	parser.add_section(u"TeamSpeakUsers")
+	parser.add_section(u"GamePlayers")
+	parser.add_section(u"UserPlayerPairings")
+	# sorted so that equal data always renders equal file contents
+	for id, nick in sorted(iteritems(ts_users), key=_by_value):
+		parser.set(u"TeamSpeakUsers", ini_escape(nick), id)
+	for id, nick in sorted(iteritems(players), key=_by_value):
+		parser.set(u"GamePlayers", ini_escape(nick), id)
+	for ts_id, player_ids in sorted(iteritems(pairings), key=lambda item: ts_users[item[0]]):
+		parser.set(u"UserPlayerPairings",
+			ini_escape(ts_users[ts_id]),
+			ini_escape(csv_join([players[player_id] for player_id in player_ids]))
+		)
+	string_io = io.StringIO()
+	parser.write(string_io)
+	ini_contents = string_io.getvalue()
+	ini_contents = ini_contents.replace(u"[TeamSpeakUsers]",     _TS_USERS_HELP + u"\n[TeamSpeakUsers]", 1)
+	ini_contents = ini_contents.replace(u"[GamePlayers]",        _PLAYERS_HELP  + u"\n[GamePlayers]", 1)
+	ini_contents = ini_contents.replace(u"[UserPlayerPairings]", _PAIRINGS_HELP + u"\n[UserPlayerPairings]", 1)
+	return _GENERAL_HELP + u"\n\n\n" + ini_contents
+
+def _by_value(item):
+	return item[1]
 
 def csv_split(string_value):
 	return [to_unicode(value) for value in next(csv.reader([string_value]))]
@@ -16,9 +16,12 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 from __future__ import print_function
+import collections
 import os
 import functools
+import heapq
 import inspect
+import itertools
 import time
 from datetime import datetime
 
@@ -35,6 +38,8 @@ from messenger.storage import storage_getter
 import ResMgr
 from skeletons.gui.battle_session import IBattleSessionProvider
 
+from .py3compat import monotonic_time
+
 def iteritems(value):
 	try:
 		# Python 2
@@ -71,18 +76,6 @@ def benchmark(func):
 	functools.update_wrapper(wrapper, func)
 	return wrapper
 
-def find_vehicle_id(matcher):
-	'''Finds 'vehicle_id' using given 'matcher' function.'''
-	try:
-		vehicles = BigWorld.player().arena.vehicles
-		for id in vehicles:
-			vehicle = vehicles[id]
-			if matcher(vehicle):
-				return id
-	except AttributeError:
-		pass
-	return None
-
 def get_vehicle(vehicle_id):
 	'''Returns vehicle info with matching 'vehicle_id' if available.
 	Returns None if not.
@@ -128,10 +121,10 @@ def get_player_info_by_dbid(dbid):
 	various locations. Returns 'player_name' and 'vehicle_id' in a dict if
 	available, returns empty dict if nothing found.
 	'''
-	vehicle_id = find_vehicle_id(lambda v: v["accountDBID"] == dbid)
+	vehicle_id = g_arena_index.get_vehicle_id(dbid)
 	if vehicle_id is not None:
 		return {
-			"player_name": get_vehicle(vehicle_id)["name"],
+			"player_name": g_arena_index.get_vehicle(vehicle_id)["name"],
 			"vehicle_id": vehicle_id
 		}
 	info = find_prebattle_account_info(lambda i: i["id"] == dbid)
@@ -178,13 +171,12 @@ def get_support_url():
 		return "undefined"
 
 def ts_user_to_player(ts_user, extract_patterns=[], mappings={}, players=[], use_metadata=False, use_ts_nick_search=False):
-	players = list(players)
-
-	def find_player(nick, comparator=lambda a, b: a == b):
-		if hasattr(nick, "lower"):
-			for player in players:
-				if comparator(player.name.lower(), nick.lower()):
-					return player
+	'''Finds player matching to given TS user. The 'players' can be either
+	an iterable of players or a PlayerMatcher built from them. Using a
+	PlayerMatcher is faster when matching several TS users to same players.
+	'''
+	matcher = players if isinstance(players, PlayerMatcher) else PlayerMatcher(players)
+	find_player = matcher.find_by_name
 
 	def map_nick(nick):
 		if hasattr(nick, "lower"):
@@ -225,7 +217,7 @@ def ts_user_to_player(ts_user, extract_patterns=[], mappings={}, players=[], use
 	# still no match, as a last straw, try find player by searching each known
 	# WOT nickname from the TS nickname
 	if use_ts_nick_search:
-		player = find_player(ts_user.nick, comparator=lambda a, b: a in b)
+		player = matcher.find_contained_in(ts_user.nick)
 		if player:
 			LOG_DEBUG("Matched TS user to player with TS nick search", ts_user, player)
 			return player
@@ -240,14 +232,8 @@ def ts_user_to_player(ts_user, extract_patterns=[], mappings={}, players=[], use
 
 def get_players(in_battle=False, in_prebattle=False, clanmembers=False, friends=False):
 	if in_battle:
-		try:
-			vehicles = BigWorld.player().arena.vehicles
-			for id in vehicles:
-				vehicle = vehicles[id]
-				LOG_DEBUG("Found player from battle", vehicle["name"])
-				yield Player(vehicle["name"], vehicle["accountDBID"])
-		except AttributeError:
-			pass
+		for player in g_arena_index.get_players():
+			yield player
 
 	if in_prebattle:
 		for player in g_prebattleListener.get_players():
@@ -266,6 +252,30 @@ def get_players(in_battle=False, in_prebattle=False, clanmembers=False, friends=
 			LOG_DEBUG("Found friend", friend.getName())
 			yield Player(friend.getName(), friend.getID())
 
+# (in_battle, in_prebattle) --> PlayerMatcher
+_player_matchers = {}
+
+def get_player_matcher(in_battle=False, in_prebattle=False, clanmembers=False, friends=False):
+	'''Returns a PlayerMatcher of players returned by get_players() with
+	same arguments. Matchers of battle and prebattle players are kept until
+	the arena or prebattle roster changes. Clan members and friends have no
+	such change notifications, so with them the matcher is always built.
+	'''
+	if clanmembers or friends:
+		return PlayerMatcher(get_players(in_battle, in_prebattle, clanmembers, friends))
+	if in_battle:
+		# notices if player has moved to another arena
+		g_arena_index.update()
+	key = (in_battle, in_prebattle)
+	matcher = _player_matchers.get(key)
+	if matcher is None:
+		matcher = _player_matchers[key] = PlayerMatcher(get_players(in_battle, in_prebattle))
+	return matcher
+
+def invalidate_player_matchers(*args, **kwargs):
+	'''Discards matchers returned by get_player_matcher().'''
+	_player_matchers.clear()
+
 class Player(object):
 
 	def __init__(self, name, id):
@@ -283,6 +293,255 @@ class Player(object):
 	def __repr__(self):
 		return "Player(name={0}, id={1})".format(self._name, self._id)
 
+class PlayerMatcher(object):
+	'''Finds players by their names, compared case insensitively. Build
+	once per set of players (e.g. arena or prebattle roster) and use for
+	matching any number of names. If several players match, the one which
+	is first in the given players wins.
+	'''
+
+	def __init__(self, players):
+		self._players = list(players)
+		self._names = [player.name.lower() for player in self._players]
+		self._by_name = {}
+		for name, player in zip(self._names, self._players):
+			self._by_name.setdefault(name, player)
+		self._name_search = None
+
+	def __len__(self):
+		return len(self._players)
+
+	def __iter__(self):
+		return iter(self._players)
+
+	def find_by_name(self, name):
+		'''Returns player with given name, or None.'''
+		if hasattr(name, "lower"):
+			return self._by_name.get(name.lower())
+
+	def find_contained_in(self, text):
+		'''Returns player whose name is contained in given text, or None.'''
+		if hasattr(text, "lower"):
+			if self._name_search is None:
+				self._name_search = _SubstringSearch(self._names)
+			index = self._name_search.find_first(text.lower())
+			if index is not None:
+				return self._players[index]
+
+class PlayerResolutionCache(object):
+	'''Caches players resolved for TS users (e.g. with ts_user_to_player()).
+
+	A result is used only while TS user's nick and WoT nick, and the
+	PlayerMatcher the result was resolved with, remain the same. Call
+	invalidate_user() when a TS user is modified, and invalidate() when
+	anything else affecting the resolution changes, e.g. settings. Counts
+	cache hits and misses.
+	'''
+
+	def __init__(self):
+		# unique id --> (nick, wot nick, resolved player)
+		self._results = {}
+		self._matcher = None
+		self.hits = 0
+		self.misses = 0
+
+	def resolve(self, ts_user, matcher, resolve_func):
+		'''Returns cached player for 'ts_user', or if there is none, calls
+		'resolve_func' to resolve it and caches the result.
+		'''
+		if matcher is not self._matcher:
+			self._results.clear()
+			self._matcher = matcher
+		result = self._results.get(ts_user.unique_id)
+		if result is not None and result[0] == ts_user.nick and result[1] == ts_user.wot_nick:
+			self.hits += 1
+			return result[2]
+		self.misses += 1
+		player = resolve_func()
+		self._results[ts_user.unique_id] = (ts_user.nick, ts_user.wot_nick, player)
+		return player
+
+	def invalidate_user(self, ts_user):
+		'''Discards cached result of 'ts_user' if its nick or WoT nick has
+		changed since it was resolved. Results of other users are kept.
+		'''
+		result = self._results.get(ts_user.unique_id)
+		if result is not None and (result[0] != ts_user.nick or result[1] != ts_user.wot_nick):
+			del self._results[ts_user.unique_id]
+
+	def invalidate(self, *args, **kwargs):
+		'''Discards all cached results.'''
+		self._results.clear()
+		self._matcher = None
+
+class _SubstringSearch(object):
+	'''Aho-Corasick automaton which finds which of given patterns occur in
+	a text, with a single pass over the text regardless of number of
+	patterns.
+	'''
+
+	def __init__(self, patterns):
+		no_match = len(patterns)
+		self._no_match = no_match
+		# trie of the patterns, each node has transitions, a failure link and
+		# lowest index of patterns which end to the node (or its suffixes)
+		self._transitions = [{}]
+		self._failures = [0]
+		self._first_index = [no_match]
+		for index, pattern in enumerate(patterns):
+			node = 0
+			for char in pattern:
+				next_node = self._transitions[node].get(char)
+				if next_node is None:
+					next_node = len(self._transitions)
+					self._transitions.append({})
+					self._failures.append(0)
+					self._first_index.append(no_match)
+					self._transitions[node][char] = next_node
+				node = next_node
+			self._first_index[node] = min(self._first_index[node], index)
+		# empty pattern is contained in every text
+		self._empty_index = self._first_index[0]
+		queue = collections.deque(self._transitions[0].values())
+		while queue:
+			node = queue.popleft()
+			for char, child in self._transitions[node].items():
+				queue.append(child)
+				failure = self._failures[node]
+				while failure and char not in self._transitions[failure]:
+					failure = self._failures[failure]
+				if node:
+					self._failures[child] = self._transitions[failure].get(char, 0)
+				self._first_index[child] = min(self._first_index[child], self._first_index[self._failures[child]])
+
+	def find_first(self, text):
+		'''Returns lowest index of patterns which occur in 'text', or None.'''
+		transitions = self._transitions
+		failures = self._failures
+		first_index = self._first_index
+		best = self._empty_index
+		node = 0
+		for char in text:
+			while node and char not in transitions[node]:
+				node = failures[node]
+			node = transitions[node].get(char, 0)
+			if first_index[node] < best:
+				best = first_index[node]
+				if best == 0:
+					break
+		if best < self._no_match:
+			return best
+		return None
+
+class ArenaIndex(object):
+	'''Lookup tables for vehicles in current arena.
+
+	Tables are built when arena's vehicle list is received, instead of
+	scanning the vehicles on each lookup, and when a single vehicle is added,
+	updated or killed only its entries are updated. The index follows
+	BigWorld.player().arena, attaching to a new arena on first lookup after
+	the arena has changed. Call reset() when leaving the arena so that the
+	old arena's events are no longer listened to.
+
+	Event 'on_updated' is notified on any change to the vehicles, and
+	'on_players_changed' only when the players in the arena change.
+	'''
+
+	def __init__(self):
+		self.on_updated = Event.Event()
+		self.on_players_changed = Event.Event()
+		self._arena = None
+		self._vehicle_ids = {}
+		self._vehicles = {}
+		self._players = ()
+
+	def get_vehicle_id(self, dbid):
+		'''Returns id of vehicle driven by player with account 'dbid', or
+		None if no such player is in the arena.
+		'''
+		self.update()
+		return self._vehicle_ids.get(dbid)
+
+	def get_vehicle(self, vehicle_id):
+		'''Returns vehicle info with matching 'vehicle_id', or None.'''
+		self.update()
+		return self._vehicles.get(vehicle_id)
+
+	def get_players(self):
+		'''Returns Player objects of all players in the arena.'''
+		self.update()
+		return self._players
+
+	def update(self):
+		'''Attaches to current arena if it differs from the indexed one.'''
+		try:
+			arena = BigWorld.player().arena
+		except AttributeError:
+			arena = None
+		if arena is not self._arena:
+			self._detach()
+			self._arena = arena
+			if arena is not None:
+				arena.onNewVehicleListReceived += self.on_arena_vehicles_updated
+				arena.onVehicleAdded           += self.on_arena_vehicle_updated
+				arena.onVehicleUpdated         += self.on_arena_vehicle_updated
+				arena.onVehicleKilled          += self.on_arena_vehicle_updated
+			self.on_arena_vehicles_updated()
+
+	def on_arena_vehicles_updated(self, *args, **kwargs):
+		self._vehicle_ids.clear()
+		self._vehicles.clear()
+		players = []
+		if self._arena is not None:
+			vehicles = self._arena.vehicles
+			for vehicle_id in vehicles:
+				vehicle = vehicles[vehicle_id]
+				self._vehicles[vehicle_id] = vehicle
+				if vehicle["accountDBID"] not in self._vehicle_ids:
+					self._vehicle_ids[vehicle["accountDBID"]] = vehicle_id
+					players.append(Player(vehicle["name"], vehicle["accountDBID"]))
+		self._players = tuple(players)
+		self.on_updated()
+		self.on_players_changed()
+
+	def on_arena_vehicle_updated(self, vehicle_id, *args, **kwargs):
+		vehicle = self._arena.vehicles.get(vehicle_id)
+		if vehicle is None:
+			return
+		self._vehicles[vehicle_id] = vehicle
+		players_changed = vehicle["accountDBID"] not in self._vehicle_ids
+		if players_changed:
+			self._vehicle_ids[vehicle["accountDBID"]] = vehicle_id
+			self._players += (Player(vehicle["name"], vehicle["accountDBID"]),)
+		self.on_updated()
+		if players_changed:
+			self.on_players_changed()
+
+	def reset(self, *args, **kwargs):
+		'''Detaches from current arena and forgets its vehicles.'''
+		self._detach()
+		self._arena = None
+		self._vehicle_ids.clear()
+		self._vehicles.clear()
+		players_changed = bool(self._players)
+		self._players = ()
+		if players_changed:
+			self.on_updated()
+			self.on_players_changed()
+
+	def fini(self):
+		self.reset()
+
+	def _detach(self):
+		if self._arena is not None:
+			self._arena.onNewVehicleListReceived -= self.on_arena_vehicles_updated
+			self._arena.onVehicleAdded           -= self.on_arena_vehicle_updated
+			self._arena.onVehicleUpdated         -= self.on_arena_vehicle_updated
+			self._arena.onVehicleKilled          -= self.on_arena_vehicle_updated
+
+g_arena_index = ArenaIndex()
+g_arena_index.on_players_changed += invalidate_player_matchers
+
 class EventFilter(object):
 	def __init__(self, orig_event, filter_func):
 		self._orig_event = orig_event
@@ -308,71 +567,207 @@ class EventFilter(object):
 	def get_original_event(self):
 		return self._orig_event
 
+# Minimap markers due within this many seconds from each other are shown in
+# the same tick
+MINIMAP_MARKER_BATCH_WINDOW = 0.05
+
 class MinimapMarkersController(object):
 	'''MinimapMarkersController class repeatably starts given marker 'action' every
 	'interval' seconds in minimap over given 'vehicle_id', effectively creating
 	continuous animation until the marker action is stopped.
+
+	All animations are driven by a TimerQueue, so a single BigWorld callback
+	is scheduled for the earliest marker which is due, and markers which are
+	due at the same time are shown in one go.
 	'''
 
 	def __init__(self):
-		self._running_animations = {}
+		self._markers = {}
+		self._timers = TimerQueue(batch_window=MINIMAP_MARKER_BATCH_WINDOW)
+		self._timers.on_dispatched += self._show_due_markers
+		# markers which have fallen due in current timer callback
+		self._due_markers = []
+		# times before which stopped markers may not be shown again, so that
+		# stopping and starting again doesn't restart the animation early
+		self._resting_markers = {}
 
 	def fini(self):
-		self._running_animations = None
+		self.stop_all()
 
 	def start(self, vehicle_id, action, interval):
 		'''Starts playing action marker for given 'vehicle_id'.'''
-		if vehicle_id not in self._running_animations:
-			self._running_animations[vehicle_id] = MinimapMarkerAnimation(
-				vehicle_id, interval, action, self._on_done)
-		self._running_animations[vehicle_id].start()
+		marker = self._markers.get(vehicle_id)
+		if marker is not None:
+			marker.action = action
+			marker.interval = interval
+			return
+		now = monotonic_time()
+		marker = _MinimapMarker(action, interval, self._resting_markers.pop(vehicle_id, now))
+		if marker.next_time <= now:
+			self._show_markers([(vehicle_id, action)])
+			marker.next_time = now + interval
+		self._markers[vehicle_id] = marker
+		self._schedule_marker(vehicle_id, marker)
 
 	def stop(self, vehicle_id):
 		'''Stops playing action marker for given 'vehicle_id'.'''
-		if vehicle_id in self._running_animations:
-			self._running_animations[vehicle_id].stop()
+		marker = self._markers.pop(vehicle_id, None)
+		if marker is None:
+			return
+		self._timers.cancel(vehicle_id)
+		now = monotonic_time()
+		self._prune_resting_markers(now)
+		if marker.next_time > now:
+			self._resting_markers[vehicle_id] = marker.next_time
 
 	def stop_all(self):
 		'''Stops all marker animations.'''
-		for vehicle_id in self._running_animations:
-			self._running_animations[vehicle_id].stop()
+		self._markers.clear()
+		self._resting_markers.clear()
+		self._timers.cancel_all()
+
+	def get_running_count(self):
+		'''Returns number of running marker animations.'''
+		return len(self._markers)
+
+	def _prune_resting_markers(self, now):
+		'''Forgets stopped markers which could already be shown again.'''
+		for vehicle_id, next_time in list(self._resting_markers.items()):
+			if next_time <= now:
+				del self._resting_markers[vehicle_id]
+
+	def _schedule_marker(self, vehicle_id, marker):
+		self._timers.call_at(vehicle_id, marker.next_time, with_args(self._on_marker_due, vehicle_id))
+
+	def _on_marker_due(self, vehicle_id):
+		marker = self._markers.get(vehicle_id)
+		if marker is None:
+			return
+		now = monotonic_time()
+		self._due_markers.append((vehicle_id, marker.action))
+		marker.next_time += marker.interval
+		if marker.next_time <= now:
+			# fell behind, e.g. game was paused, don't try to catch up
+			marker.next_time = now + marker.interval
+		self._schedule_marker(vehicle_id, marker)
+
+	def _show_due_markers(self):
+		due_markers, self._due_markers = self._due_markers, []
+		if due_markers:
+			self._show_markers(due_markers)
+		self._prune_resting_markers(monotonic_time())
+
+	def _show_markers(self, markers):
+		try:
+			feedback = g_sessionProvider.shared.feedback
+			if feedback:
+				for vehicle_id, action in markers:
+					feedback.onMinimapFeedbackReceived(
+						FEEDBACK_EVENT_ID.MINIMAP_SHOW_MARKER, vehicle_id, action)
+		except AttributeError:
+			LOG_CURRENT_EXCEPTION()
 
-	def _on_done(self, vehicle_id):
-		del self._running_animations[vehicle_id]
+class _MinimapMarker(object):
 
-class MinimapMarkerAnimation(object):
+	__slots__ = ("action", "interval", "next_time")
 
-	def __init__(self, vehicle_id, interval, action, on_done):
-		self._interval   = interval
-		self._action     = action
-		self._vehicle_id = vehicle_id
-		self._on_done    = on_done
-		self._is_started = False
-		self._is_running = False
+	def __init__(self, action, interval, next_time):
+		self.action    = action
+		self.interval  = interval
+		self.next_time = next_time
 
-	def start(self):
-		self._is_started = True
-		if not self._is_running:
-			self._repeat()
+class TimerQueue(object):
+	'''Calls functions after a delay, keeping at most one pending call per
+	key. Scheduling a call with a key which already has one pending replaces
+	the earlier call and its deadline.
 
-	def stop(self):
-		self._is_started = False
+	Deadlines are kept in a heap and only a single BigWorld callback is
+	scheduled, for the earliest deadline. Calls whose deadline is within
+	'batch_window' seconds from the callback are made in the same callback,
+	after which event 'on_dispatched' is notified.
+	'''
 
-	def _repeat(self):
-		self._is_running = self._is_started
-		if self._is_started:
-			self._updateMinimap()
-			BigWorld.callback(self._interval, self._repeat)
-		else:
-			self._on_done(self._vehicle_id)
+	def __init__(self, batch_window=0):
+		self._batch_window = batch_window
+		self._entries = {}
+		self._heap = []
+		self._counter = itertools.count()
+		self._callback_id = None
+		self._callback_time = None
+		self._dispatching = False
+		self.on_dispatched = Event.Event()
 
-	def _updateMinimap(self):
+	def fini(self):
+		self.cancel_all()
+
+	def call_later(self, key, delay, func):
+		'''Calls 'func' after 'delay' seconds unless cancelled or replaced
+		before that.
+		'''
+		self.call_at(key, monotonic_time() + delay, func)
+
+	def call_at(self, key, deadline, func):
+		'''Calls 'func' at 'deadline' (in monotonic_time()) unless cancelled
+		or replaced before that.
+		'''
+		entry = (deadline, func)
+		self._entries[key] = entry
+		heapq.heappush(self._heap, (deadline, next(self._counter), key, entry))
+		# while dispatching, callback is scheduled once all calls are done
+		if not self._dispatching and (self._callback_time is None or deadline < self._callback_time):
+			self._schedule_callback()
+
+	def cancel(self, key):
+		'''Cancels pending call with given 'key', if any.'''
+		if self._entries.pop(key, None) is not None and not self._entries:
+			self.cancel_all()
+
+	def cancel_all(self):
+		self._entries.clear()
+		del self._heap[:]
+		self._cancel_callback()
+
+	def get_pending_count(self):
+		'''Returns number of calls waiting for their deadline.'''
+		return len(self._entries)
+
+	def _schedule_callback(self):
+		self._cancel_callback()
+		# drop calls which have been cancelled or replaced
+		while self._heap and self._entries.get(self._heap[0][2]) is not self._heap[0][3]:
+			heapq.heappop(self._heap)
+		if self._heap:
+			self._callback_time = self._heap[0][0]
+			self._callback_id = BigWorld.callback(max(0, self._callback_time - monotonic_time()), self._on_timeout)
+
+	def _cancel_callback(self):
+		if self._callback_id is not None:
+			BigWorld.cancelCallback(self._callback_id)
+			self._callback_id = None
+			self._callback_time = None
+
+	def _on_timeout(self):
+		self._callback_id = None
+		self._callback_time = None
+		now = monotonic_time()
+		due = []
+		while self._heap and self._heap[0][0] <= now + self._batch_window:
+			_, _, key, entry = heapq.heappop(self._heap)
+			if self._entries.get(key) is entry:
+				del self._entries[key]
+				due.append(entry[1])
+		self._dispatching = True
 		try:
-			if g_sessionProvider.shared.feedback:
-				g_sessionProvider.shared.feedback.onMinimapFeedbackReceived(
-					FEEDBACK_EVENT_ID.MINIMAP_SHOW_MARKER, self._vehicle_id, self._action)
-		except AttributeError:
-			LOG_CURRENT_EXCEPTION()
+			for func in due:
+				try:
+					func()
+				except:
+					LOG_CURRENT_EXCEPTION()
+			if due:
+				self.on_dispatched()
+		finally:
+			self._dispatching = False
+		self._schedule_callback()
 
 class RepeatTimer(object):
 
@@ -414,6 +809,7 @@ class RepeatTimer(object):
 class PrebattleListener(IGlobalListener):
 
 	def __init__(self):
+		self.on_updated = Event.Event()
 		self.__players = {}
 
 	def get_players(self):
@@ -421,9 +817,11 @@ class PrebattleListener(IGlobalListener):
 
 	def onPrbFunctionalFinished(self):
 		self.__players.clear()
+		self.on_updated()
 
 	def onUnitFunctionalFinished(self):
 		self.__players.clear()
+		self.on_updated()
 
 	def onPlayerAdded(self, functional, info):
 		self.__add_player_info(info)
@@ -436,6 +834,7 @@ class PrebattleListener(IGlobalListener):
 
 	def __add_player_info(self, info):
 		self.__players[info.dbID] = dict(id=info.dbID, name=info.name)
+		self.on_updated()
 
 def PrbControlLoader_onAccountShowGUI(original):
 	def decorator(self, ctx):
@@ -496,11 +895,15 @@ def init():
 	global g_prebattleListener
 	g_sessionProvider = dependency.instance(IBattleSessionProvider)
 	g_prebattleListener = PrebattleListener()
+	g_prebattleListener.on_updated += invalidate_player_matchers
 	_PrbControlLoader.onAccountShowGUI = PrbControlLoader_onAccountShowGUI(_PrbControlLoader.onAccountShowGUI)
 
 def fini():
 	global g_sessionProvider
 	global g_prebattleListener
 	g_sessionProvider = None
+	g_prebattleListener.on_updated -= invalidate_player_matchers
 	g_prebattleListener = None
+	_player_matchers.clear()
+	g_arena_index.fini()
 	_PrbControlLoader.onAccountShowGUI = _PrbControlLoader.onAccountShowGUI.original
@@ -107,6 +107,7 @@ class GameFixture:
 						"name":        player["name"],
 						"isAlive":     True
 					}
+					BigWorld.player().arena.onVehicleAdded(vehicle_id)
 					if vehicle_id not in BigWorld.entities:
 						BigWorld.entities[vehicle_id] = BigWorld.Entity()
 					if "position" in player:
@@ -215,6 +216,7 @@ class TessuModFixture:
 		self.mod_tessumod = None
 		self._events = []
 		self._ts_speak_state = {}
+		self._initial_settings = {}
 
 	def load(self):
 		assert not self.mod_tessumod, "The mod has already been loaded"
@@ -228,6 +230,7 @@ class TessuModFixture:
 				"polling_interval": "0" # makes tests execute faster
 			}
 		)
+		self.change_settings(**self._initial_settings)
 		self.mod_tessumod.init()
 
 		del self._events[:]
@@ -241,6 +244,14 @@ class TessuModFixture:
 		if self.mod_tessumod:
 			self.mod_tessumod.fini()
 
+	def set_initial_settings(self, **groups):
+		'''Sets settings which are applied when the mod is loaded.'''
+		assert not self.mod_tessumod, "The mod has already been loaded"
+		self._initial_settings = groups
+
+	def clear_events(self):
+		del self._events[:]
+
 	def change_settings(self, **groups):
 		assert self.mod_tessumod, "Mod has not been loaded, please start the game first!"
 		for group_name, variables in groups.items():
@@ -262,6 +273,12 @@ class TessuModFixture:
 			self.mod_tessumod.g_user_cache.sync(force=True)
 
 	def change_state_variables(self, **variables):
+		if self.mod_tessumod and self.mod_tessumod.g_keyvaluestorage is not None:
+			self.mod_tessumod.g_keyvaluestorage.update(variables)
+			self.mod_tessumod.g_keyvaluestorage.flush()
+			return
+		# before the game is started the variables are written in the old
+		# format, one file per variable, which the mod then migrates
 		states_dirpath = os.path.join(INI_DIRPATH, "states")
 		if not os.path.exists(states_dirpath):
 			os.makedirs(states_dirpath)
@@ -270,11 +287,17 @@ class TessuModFixture:
 				file.write(json.dumps(value))
 
 	def get_state_variable(self, key):
-		states_dirpath = os.path.join(INI_DIRPATH, "states")
-		key_path = os.path.join(states_dirpath, key)
-		if os.path.exists(key_path):
-			with open(key_path, "r") as file:
-				return json.load(file)
+		if self.mod_tessumod and self.mod_tessumod.g_keyvaluestorage is not None:
+			self.mod_tessumod.g_keyvaluestorage.flush()
+		value = None
+		states_path = os.path.join(INI_DIRPATH, "tessu_mod_states.jsonl")
+		if os.path.exists(states_path):
+			with open(states_path, "r") as file:
+				for line in file:
+					entry = json.loads(line)
+					if entry["key"] == key:
+						value = entry.get("value")
+		return value
 
 	async def wait_until_connected_to_ts_client(self, timeout=5):
 		assert self.mod_tessumod, "Mod has not been loaded, please start the game first!"
@@ -326,6 +349,13 @@ class CQTSPluginFixture:
 			await self._service.stop()
 			self._service = None
 
+	async def drop_connection(self):
+		'''Closes current client connection, the plugin keeps listening for
+		new connections.
+		'''
+		assert self._service, "Client query plugin must be loaded first"
+		await self._service.handler.close()
+
 	def get_user(self, **kwargs):
 		assert self._service, "Client query plugin must be loaded first"
 		return self._model.get_user(**kwargs)
@@ -0,0 +1,43 @@
+import pytest
+
+from .test_helpers.tools import *
+
+'''
+These futes test how fast TessuMod gets back to working order after connection
+to TeamSpeak client is lost.
+'''
+
+pytestmark = [pytest.mark.asyncio]
+
+POLLING_INTERVAL = 0.1
+# Reconnect budgets in polling intervals; each command sent when connection to
+# TS client is (re)established costs at least one interval when not pipelined,
+# and there are over 20 of them before the mod is connected to a TS server
+SERIAL_RECONNECT_BUDGET = 60 * POLLING_INTERVAL
+PIPELINED_RECONNECT_BUDGET = 20 * POLLING_INTERVAL
+
+async def measure_reconnect(tessumod, cq_tsplugin, pipelined):
+	tessumod.change_settings(TSClientQueryService={"pipelined_commands": pipelined})
+	tessumod.clear_events()
+	with ExecTimer() as timer:
+		await cq_tsplugin.drop_connection()
+		await tessumod.wait_until_connected_to_ts_server(timeout=SERIAL_RECONNECT_BUDGET * 2)
+	return timer.end - timer.start
+
+@pytest.mark.slow
+async def test_reconnect_to_ready_latency(game, tessumod, cq_tsplugin, record_property):
+	await cq_tsplugin.load(connected_to_server=True)
+	tessumod.set_initial_settings(
+		TSClientQueryService = {
+			"polling_interval": str(POLLING_INTERVAL)
+		}
+	)
+	game.start(mode="lobby")
+	await tessumod.wait_until_connected_to_ts_server()
+	serial_time = await measure_reconnect(tessumod, cq_tsplugin, "off")
+	pipelined_time = await measure_reconnect(tessumod, cq_tsplugin, "on")
+	record_property("serial_reconnect_time", serial_time)
+	record_property("pipelined_reconnect_time", pipelined_time)
+	assert serial_time < SERIAL_RECONNECT_BUDGET
+	assert pipelined_time < PIPELINED_RECONNECT_BUDGET
+	assert pipelined_time < serial_time
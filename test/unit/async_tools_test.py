@@ -0,0 +1,55 @@
+# TessuMod: Mod for integrating TeamSpeak into World of Tanks
+# Copyright (C) 2019  Janne Hakonen
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+import unittest.mock
+
+from tessumod import async_tools
+
+class TestParallel(unittest.TestCase):
+
+	def test_calls_back_with_all_results(self):
+		callback = unittest.mock.Mock()
+		async_tools.parallel([
+			lambda cb: cb(None, "first"),
+			lambda cb: cb(None, "second")
+		], callback)
+		callback.assert_called_once_with(None, ["first", "second"])
+
+	def test_calls_back_without_actions(self):
+		callback = unittest.mock.Mock()
+		async_tools.parallel([], callback)
+		callback.assert_called_once_with(None, None)
+
+	def test_stops_calling_actions_after_error(self):
+		callback = unittest.mock.Mock()
+		third = unittest.mock.Mock()
+		async_tools.parallel([
+			lambda cb: cb(None, "first"),
+			lambda cb: cb("first error", None),
+			third
+		], callback)
+		assert not third.called
+		callback.assert_called_once_with("first error", None)
+
+	def test_reports_only_first_error(self):
+		callback = unittest.mock.Mock()
+		callbacks = []
+		async_tools.parallel([callbacks.append, callbacks.append], callback)
+		callbacks[1]("first error", None)
+		callbacks[0]("second error", None)
+		callback.assert_called_once_with("first error", None)
@@ -0,0 +1,198 @@
+# TessuMod: Mod for integrating TeamSpeak into World of Tanks
+# Copyright (C) 2019  Janne Hakonen
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import random
+import socket
+import unittest
+import unittest.mock
+
+from tessumod import asyncore_utils
+
+class LineReceiver(asyncore_utils.AsynchatExtended):
+
+	def __init__(self, event_loop, sock):
+		asyncore_utils.AsynchatExtended.__init__(self, event_loop)
+		self.set_socket(sock)
+		self.connected = True
+		self.ac_in_buffer_size = 1024
+		self.set_terminator(b"\n")
+		self.lines = []
+		self._line = b""
+
+	def collect_incoming_data(self, data):
+		self._line += data
+
+	def found_terminator(self):
+		self.lines.append(self._line)
+		self._line = b""
+
+class TestEventLoopAdapter(unittest.TestCase):
+
+	def setUp(self):
+		patcher = unittest.mock.patch("tessumod.asyncore_utils.BigWorld")
+		self.bigworld = patcher.start()
+		self.addCleanup(patcher.stop)
+		self.event_loop = asyncore_utils.EventLoopAdapter()
+		self.addCleanup(self.event_loop.fini)
+
+	def get_scheduled_interval(self):
+		return self.bigworld.callback.call_args[0][0]
+
+	def poll(self):
+		self.bigworld.callback.call_args[0][1]()
+
+	def test_polls_with_polling_interval_when_idle_interval_not_given(self):
+		self.event_loop.set_polling_interval(0.1)
+		for _ in range(3):
+			self.poll()
+			assert self.get_scheduled_interval() == 0.1
+
+	def test_backs_off_up_to_idle_interval_when_idle(self):
+		self.event_loop.set_polling_interval(0.01, 0.08)
+		intervals = []
+		for _ in range(5):
+			self.poll()
+			intervals.append(self.get_scheduled_interval())
+		assert intervals == [0.02, 0.04, 0.08, 0.08, 0.08]
+
+	def test_caps_idle_interval(self):
+		self.event_loop.set_polling_interval(0.05, 0.8)
+		for _ in range(5):
+			self.poll()
+		assert self.get_scheduled_interval() == asyncore_utils.MAX_IDLE_POLLING_INTERVAL
+
+	def test_polls_with_long_polling_interval_even_when_over_cap(self):
+		self.event_loop.set_polling_interval(0.3, 0.8)
+		self.poll()
+		assert self.get_scheduled_interval() == 0.3
+
+	def test_backs_off_from_zero_polling_interval(self):
+		self.event_loop.set_polling_interval(0, 0.5)
+		self.poll()
+		assert 0 < self.get_scheduled_interval() <= 0.5
+
+	def test_tightens_polling_on_activity(self):
+		self.event_loop.set_polling_interval(0.01, 0.08)
+		self.poll()
+		self.poll()
+		self.event_loop.notify_activity()
+		assert self.get_scheduled_interval() == 0.01
+		assert self.bigworld.cancelCallback.called
+
+	def test_keeps_polling_interval_on_activity_during_tick(self):
+		self.event_loop.set_polling_interval(0.1, 0.8)
+		self.event_loop.on_tick += self.event_loop.notify_activity
+		for _ in range(3):
+			self.poll()
+			assert self.get_scheduled_interval() == 0.1
+
+	def test_calls_on_tick_on_each_poll(self):
+		on_tick = unittest.mock.Mock()
+		self.event_loop.on_tick += on_tick
+		self.event_loop.set_polling_interval(0.1, 0.8)
+		self.poll()
+		self.poll()
+		assert on_tick.call_count == 2
+
+	def test_stops_polling_on_fini(self):
+		self.event_loop.set_polling_interval(0.1, 0.8)
+		self.event_loop.fini()
+		self.bigworld.callback.reset_mock()
+		self.event_loop.notify_activity()
+		assert not self.bigworld.callback.called
+
+class TestAsynchatExtended(unittest.TestCase):
+
+	def setUp(self):
+		patcher = unittest.mock.patch("tessumod.asyncore_utils.BigWorld")
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.event_loop = asyncore_utils.EventLoopAdapter()
+		sock, self.peer = socket.socketpair()
+		sock.setblocking(False)
+		self.addCleanup(self.peer.close)
+		self.receiver = LineReceiver(self.event_loop, sock)
+		self.addCleanup(self.receiver.close)
+
+	def test_drains_all_readable_data_in_one_read(self):
+		lines = [("line %d" % index).encode("ascii") * 10 for index in range(100)]
+		self.peer.sendall(b"\n".join(lines) + b"\n")
+		self.receiver.handle_read()
+		assert self.receiver.lines == lines
+		assert self.receiver.connected
+
+	def test_read_is_activity(self):
+		self.event_loop.notify_activity = unittest.mock.Mock()
+		self.peer.sendall(b"data\n")
+		self.receiver.handle_read()
+		assert self.event_loop.notify_activity.called
+
+	def test_read_handles_peer_close(self):
+		self.peer.sendall(b"data\n")
+		self.peer.close()
+		self.receiver.handle_read()
+		assert self.receiver.lines == [b"data"]
+		assert not self.receiver.connected
+
+class TestLineFramer(unittest.TestCase):
+
+	def setUp(self):
+		self.framer = asyncore_utils.LineFramer(b"\n\r")
+
+	def test_returns_complete_lines(self):
+		assert self.framer.feed(b"first\n\rsecond\n\r") == ["first", "second"]
+
+	def test_keeps_partial_line_until_completed(self):
+		assert self.framer.feed(b"first\n\rsec") == ["first"]
+		assert self.framer.feed(b"ond") == []
+		assert self.framer.feed(b"\n\r") == ["second"]
+
+	def test_finds_terminator_split_between_data(self):
+		assert self.framer.feed(b"first\n") == []
+		assert self.framer.feed(b"\rsecond\n") == ["first"]
+		assert self.framer.feed(b"\r") == ["second"]
+
+	def test_decodes_character_split_between_data(self):
+		data = u"\u00e4\u20ac\U0001d11e\n\r".encode("utf-8")
+		lines = []
+		for index in range(len(data)):
+			lines.extend(self.framer.feed(data[index:index+1]))
+		assert lines == [u"\u00e4\u20ac\U0001d11e"]
+
+	def test_returns_empty_lines(self):
+		assert self.framer.feed(b"\n\r\n\r") == ["", ""]
+
+	def test_reset_discards_partial_line(self):
+		self.framer.feed(b"partial")
+		self.framer.reset()
+		assert self.framer.feed(b"line\n\r") == ["line"]
+
+	def test_stress_with_long_lines_in_random_pieces(self):
+		rnd = random.Random(1234)
+		alphabet = u"abcXYZ019 =|\\\u00e4\u00f6\u00e5\u20ac\u0416\U0001d11e"
+		lines = [
+			u"".join(rnd.choice(alphabet) for _ in range(rnd.randint(1000, 20000)))
+			for _ in range(50)
+		]
+		data = b"".join(line.encode("utf-8") + b"\n\r" for line in lines)
+		received = []
+		position = 0
+		while position < len(data):
+			size = rnd.randint(1, 4096)
+			received.extend(self.framer.feed(data[position:position+size]))
+			position += size
+		assert received == lines
@@ -0,0 +1,121 @@
+# TessuMod: Mod for integrating TeamSpeak into World of Tanks
+# Copyright (C) 2019  Janne Hakonen
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+from tessumod import file_watch
+
+class FileWatcherTestMixin(object):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.tmp_dir)
+		self.path = os.path.join(self.tmp_dir, "tessu_mod.ini")
+		self.write_file("initial", age=10)
+		self.watcher = file_watch.FileWatcher(self.create_backend(), debounce=0.5)
+		self.addCleanup(self.watcher.fini)
+		self.watch = self.watcher.watch(self.path)
+
+	def write_file(self, contents, age=10, path=None):
+		path = path or self.path
+		with open(path, "w") as f:
+			f.write(contents)
+		modified_time = time.time() - age
+		os.utime(path, (modified_time, modified_time))
+
+	def test_no_change_initially(self):
+		assert not self.watch.check()
+
+	def test_reports_change_once(self):
+		self.write_file("changed")
+		assert self.watch.check()
+		assert not self.watch.check()
+
+	def test_does_not_report_acknowledged_change(self):
+		self.write_file("own write")
+		self.watch.acknowledge()
+		assert not self.watch.check()
+
+	def test_waits_until_change_has_settled(self):
+		self.write_file("first save", age=0)
+		assert not self.watch.check()
+		self.write_file("second save", age=0)
+		assert not self.watch.check()
+		modified_time = time.time() - 10
+		os.utime(self.path, (modified_time, modified_time))
+		assert self.watch.check()
+		assert not self.watch.check()
+
+	def test_reports_removed_file(self):
+		os.remove(self.path)
+		assert self.watch.check()
+
+	def test_reports_file_replaced_by_rename(self):
+		temp_path = os.path.join(self.tmp_dir, "tessu_mod.ini.tmp")
+		self.write_file("replaced", path=temp_path)
+		os.rename(temp_path, self.path)
+		assert self.watch.check()
+
+	def test_keeps_changes_of_other_files_on_acknowledge(self):
+		other_path = os.path.join(self.tmp_dir, "tessu_mod_cache.ini")
+		self.write_file("initial", path=other_path)
+		other_watch = self.watcher.watch(other_path)
+		self.write_file("changed", path=other_path)
+		self.write_file("own write")
+		self.watch.acknowledge()
+		assert other_watch.check()
+
+	def test_does_not_report_unrelated_files(self):
+		self.write_file("unrelated", path=os.path.join(self.tmp_dir, "other.ini"))
+		assert not self.watch.check()
+
+class TestStatPollingFileWatcher(FileWatcherTestMixin, unittest.TestCase):
+
+	def create_backend(self):
+		return file_watch.StatPollingBackend()
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is available only on Linux")
+class TestInotifyFileWatcher(FileWatcherTestMixin, unittest.TestCase):
+
+	def create_backend(self):
+		return file_watch.InotifyBackend()
+
+	def test_does_not_stat_files_without_changes(self):
+		with unittest.mock.patch("os.stat") as stat, unittest.mock.patch("os.path.getmtime") as getmtime:
+			for _ in range(10):
+				assert not self.watch.check()
+		assert not stat.called
+		assert not getmtime.called
+
+	def test_reports_all_files_on_queue_overflow(self):
+		data = file_watch._INOTIFY_EVENT.pack(-1, file_watch.IN_Q_OVERFLOW, 0, 0)
+		changed = set()
+		self.watcher._backend._parse_events(data, changed)
+		assert changed == set([self.path])
+
+class TestCreateFileWatcher(unittest.TestCase):
+
+	def test_falls_back_to_stat_polling(self):
+		with unittest.mock.patch.object(file_watch, "InotifyBackend", side_effect=OSError("not supported")):
+			watcher = file_watch.create_file_watcher()
+		assert isinstance(watcher._backend, file_watch.StatPollingBackend)
@@ -0,0 +1,162 @@
+# TessuMod: Mod for integrating TeamSpeak into World of Tanks
+# Copyright (C) 2019  Janne Hakonen
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+from tessumod import file_writer
+
+def read_file(path):
+	with open(path, "r") as f:
+		return f.read()
+
+class TestWriteFileAtomically(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.tmp_dir)
+		self.path = os.path.join(self.tmp_dir, "file.ini")
+
+	def test_writes_new_file(self):
+		file_writer.write_file_atomically(self.path, u"contents")
+		assert read_file(self.path) == "contents"
+
+	def test_replaces_existing_file(self):
+		file_writer.write_file_atomically(self.path, u"old")
+		file_writer.write_file_atomically(self.path, u"new")
+		assert read_file(self.path) == "new"
+		assert os.listdir(self.tmp_dir) == ["file.ini"]
+
+	def test_keeps_original_file_on_failure(self):
+		file_writer.write_file_atomically(self.path, u"original")
+		with unittest.mock.patch.object(file_writer, "replace_file", side_effect=OSError("failed")):
+			with self.assertRaises(OSError):
+				file_writer.write_file_atomically(self.path, u"new")
+		assert read_file(self.path) == "original"
+		assert os.listdir(self.tmp_dir) == ["file.ini"]
+
+class TestFileWriter(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.tmp_dir)
+		self.path = os.path.join(self.tmp_dir, "file.ini")
+		self.writer = self.create_writer()
+		self.addCleanup(self.writer.fini)
+		self.render = unittest.mock.Mock(side_effect=lambda snapshot: u"value: %s" % snapshot)
+
+	def create_writer(self):
+		return file_writer.FileWriter()
+
+	def wait_until_written(self):
+		pass
+
+	def test_writes_rendered_snapshot(self):
+		self.writer.write(self.path, self.render, 1)
+		self.wait_until_written()
+		assert read_file(self.path) == "value: 1"
+		assert self.writer.pop_finished() == [self.path]
+		assert self.writer.pop_finished() == []
+
+	def test_skips_write_when_contents_not_changed(self):
+		self.writer.write(self.path, self.render, 1)
+		self.wait_until_written()
+		os.remove(self.path)
+		self.writer.write(self.path, self.render, 1)
+		self.wait_until_written()
+		assert not os.path.exists(self.path)
+
+	def test_writes_unchanged_contents_after_forget(self):
+		self.writer.write(self.path, self.render, 1)
+		self.wait_until_written()
+		os.remove(self.path)
+		self.writer.forget(self.path)
+		self.writer.write(self.path, self.render, 1)
+		self.wait_until_written()
+		assert read_file(self.path) == "value: 1"
+
+	def test_logs_render_error(self):
+		self.render.side_effect = ValueError("broken")
+		with unittest.mock.patch.object(file_writer, "LOG_ERROR") as log_error:
+			self.writer.write(self.path, self.render, 1)
+			self.wait_until_written()
+		assert log_error.called
+		assert not os.path.exists(self.path)
+
+class TestBackgroundFileWriter(TestFileWriter):
+
+	def create_writer(self):
+		return file_writer.BackgroundFileWriter()
+
+	def wait_until_written(self):
+		for _ in range(1000):
+			if not self.writer.is_writing(self.path):
+				return
+			threading.Event().wait(0.001)
+		assert False, "Write did not finish"
+
+	def test_renders_in_another_thread(self):
+		threads = []
+		self.render.side_effect = lambda snapshot: threads.append(threading.current_thread()) or u""
+		self.writer.write(self.path, self.render, 1)
+		self.wait_until_written()
+		assert threads and threads[0] is not threading.current_thread()
+
+	def test_writes_only_latest_pending_snapshot(self):
+		started = threading.Event()
+		release = threading.Event()
+		def render(snapshot):
+			if snapshot == "blocker":
+				started.set()
+				release.wait(5)
+			return u"value: %s" % snapshot
+		other_path = os.path.join(self.tmp_dir, "other.ini")
+		self.writer.write(other_path, render, "blocker")
+		assert started.wait(5)
+		self.render.side_effect = render
+		for snapshot in range(10):
+			self.writer.write(self.path, self.render, snapshot)
+		release.set()
+		self.wait_until_written()
+		assert read_file(self.path) == "value: 9"
+		assert self.render.call_count == 1
+
+	def test_fini_writes_pending_files(self):
+		self.writer.write(self.path, self.render, 1)
+		self.writer.fini()
+		assert read_file(self.path) == "value: 1"
+
+	def test_write_now_replaces_pending_write(self):
+		started = threading.Event()
+		release = threading.Event()
+		def render(snapshot):
+			if snapshot == "blocker":
+				started.set()
+				release.wait(5)
+			return u"value: %s" % snapshot
+		other_path = os.path.join(self.tmp_dir, "other.ini")
+		self.writer.write(other_path, render, "blocker")
+		assert started.wait(5)
+		self.writer.write(self.path, render, "old")
+		release.set()
+		self.writer.write_now(self.path, render, "new")
+		self.wait_until_written()
+		assert read_file(self.path) == "value: new"
@@ -0,0 +1,170 @@
+# TessuMod: Mod for integrating TeamSpeak into World of Tanks
+# Copyright (C) 2019  Janne Hakonen
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from tessumod.keyvaluestorage import KeyValueStorage, JournaledKeyValueStorage
+
+class TestKeyValueStorage(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.tmp_dir)
+		self.storage_path = os.path.join(self.tmp_dir, "states")
+
+	def test_stores_each_key_to_own_file(self):
+		storage = KeyValueStorage(self.storage_path)
+		storage["key1"] = [1, 2]
+		storage["key2"] = 3
+		del storage["key2"]
+		assert os.listdir(self.storage_path) == ["key1"]
+		assert dict(KeyValueStorage(self.storage_path)) == {"key1": [1, 2]}
+
+class TestJournaledKeyValueStorage(unittest.TestCase):
+
+	def setUp(self):
+		patcher = unittest.mock.patch("tessumod.keyvaluestorage.BigWorld")
+		self.bigworld = patcher.start()
+		self.addCleanup(patcher.stop)
+		self.tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.tmp_dir)
+		self.file_path = os.path.join(self.tmp_dir, "states.jsonl")
+		self.legacy_path = os.path.join(self.tmp_dir, "states")
+
+	def create_storage(self):
+		return JournaledKeyValueStorage(self.file_path, legacy_storage_path=self.legacy_path)
+
+	def fire_flush_timeout(self):
+		self.bigworld.callback.call_args[0][1]()
+
+	def read_lines(self):
+		with open(self.file_path, "r") as file:
+			return [json.loads(line) for line in file]
+
+	def test_values_are_stored_over_restart(self):
+		storage = self.create_storage()
+		storage["key1"] = [1, 2]
+		storage["key2"] = {"a": "b"}
+		storage.fini()
+		storage = self.create_storage()
+		assert dict(storage) == {"key1": [1, 2], "key2": {"a": "b"}}
+
+	def test_deleted_values_are_not_restored(self):
+		storage = self.create_storage()
+		storage["key1"] = 1
+		storage["key2"] = 2
+		storage.flush()
+		del storage["key1"]
+		storage.fini()
+		assert dict(self.create_storage()) == {"key2": 2}
+
+	def test_writes_are_deferred_and_batched(self):
+		storage = self.create_storage()
+		storage["key"] = 1
+		storage["key"] = 2
+		storage["other"] = 3
+		assert not os.path.exists(self.file_path)
+		assert self.bigworld.callback.call_count == 1
+		self.fire_flush_timeout()
+		assert self.read_lines() == [{"key": "key", "value": 2}, {"key": "other", "value": 3}]
+
+	def test_stores_value_as_it_was_when_set(self):
+		storage = self.create_storage()
+		value = [1]
+		storage["key"] = value
+		value.append(2)
+		storage.fini()
+		assert self.create_storage()["key"] == [1]
+
+	def test_flush_cancels_deferred_write(self):
+		storage = self.create_storage()
+		storage["key"] = 1
+		storage.flush()
+		assert self.bigworld.cancelCallback.called
+
+	def test_appends_changes_to_journal(self):
+		storage = self.create_storage()
+		storage["key"] = 1
+		storage.flush()
+		storage["key"] = 2
+		storage.flush()
+		assert self.read_lines() == [{"key": "key", "value": 1}, {"key": "key", "value": 2}]
+
+	def test_compacts_journal_when_grown(self):
+		storage = self.create_storage()
+		for value in range(JournaledKeyValueStorage.COMPACT_THRESHOLD + 10):
+			storage["key"] = value
+			storage.flush()
+		assert len(self.read_lines()) < JournaledKeyValueStorage.COMPACT_THRESHOLD
+		assert self.create_storage()["key"] == JournaledKeyValueStorage.COMPACT_THRESHOLD + 9
+
+	def test_ignores_partially_written_line(self):
+		storage = self.create_storage()
+		storage["key"] = 1
+		storage.flush()
+		with open(self.file_path, "a") as file:
+			file.write('{"key": "key", "val')
+		with unittest.mock.patch("tessumod.keyvaluestorage.LOG_ERROR"):
+			storage = self.create_storage()
+		assert dict(storage) == {"key": 1}
+		storage["other"] = 2
+		storage.flush()
+		assert dict(self.create_storage()) == {"key": 1, "other": 2}
+
+	def test_migrates_legacy_per_key_files(self):
+		os.makedirs(self.legacy_path)
+		for key, value in [("ignored_plugin_versions", [1, 2]), ("plugin_info_timestamp", 123.5)]:
+			with open(os.path.join(self.legacy_path, key), "w") as file:
+				file.write(json.dumps(value))
+		storage = self.create_storage()
+		assert dict(storage) == {"ignored_plugin_versions": [1, 2], "plugin_info_timestamp": 123.5}
+		assert dict(self.create_storage()) == dict(storage)
+
+	def test_keeps_legacy_files_authoritative_until_migration_is_written(self):
+		os.makedirs(self.legacy_path)
+		with open(os.path.join(self.legacy_path, "key"), "w") as file:
+			file.write(json.dumps(1))
+		with unittest.mock.patch("tessumod.keyvaluestorage.write_file_atomically", side_effect=IOError("disk full")), \
+				unittest.mock.patch("tessumod.keyvaluestorage.LOG_ERROR"):
+			storage = self.create_storage()
+			storage["other"] = 2
+			storage.flush()
+		assert not os.path.exists(self.file_path)
+		assert dict(self.create_storage()) == {"key": 1}
+		storage.flush()
+		assert sorted(line["key"] for line in self.read_lines()) == ["key", "other"]
+
+	def test_leaves_legacy_files_in_place(self):
+		os.makedirs(self.legacy_path)
+		with open(os.path.join(self.legacy_path, "key"), "w") as file:
+			file.write(json.dumps(1))
+		self.create_storage()
+		assert os.listdir(self.legacy_path) == ["key"]
+
+	def test_does_not_migrate_when_journal_exists(self):
+		storage = self.create_storage()
+		storage["key"] = 1
+		storage.fini()
+		os.makedirs(self.legacy_path)
+		with open(os.path.join(self.legacy_path, "key"), "w") as file:
+			file.write(json.dumps(2))
+		assert self.create_storage()["key"] == 1
@@ -0,0 +1,184 @@
+# TessuMod: Mod for integrating TeamSpeak into World of Tanks
+# Copyright (C) 2019  Janne Hakonen
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+import unittest.mock
+
+import Avatar
+import BigWorld
+import Event
+from tessumod import positional_audio, utils
+
+class FakeUsers(dict):
+
+	def __init__(self):
+		self.on_added = Event.Event()
+		self.on_removed = Event.Event()
+		self.on_modified = Event.Event()
+
+	def itervalues(self):
+		return iter(self.values())
+
+	def client_ids_by_unique_id(self, unique_id):
+		return set(client_id for client_id, user in self.items() if user.unique_id == unique_id)
+
+class FakeUserCache(object):
+
+	def __init__(self):
+		self.on_updated = Event.Event()
+		self.pairings = {}
+
+	def get_paired_ts_user_ids(self, player_id):
+		return iter(sorted(ts_user_id for ts_user_id, player_ids in self.pairings.items() if player_id in player_ids))
+
+class TestPositionalAudio(unittest.TestCase):
+
+	def setUp(self):
+		self.bigworld = unittest.mock.Mock()
+		self.bigworld.entities = BigWorld.Entitites()
+		for module in ("tessumod.positional_audio", "tessumod.utils"):
+			patcher = unittest.mock.patch(module + ".BigWorld", self.bigworld)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+		patcher = unittest.mock.patch("tessumod.positional_audio.mytsplugin.PositionalDataAPI")
+		self.api = patcher.start().return_value
+		self.addCleanup(patcher.stop)
+		self.arena = Avatar.TestArena()
+		self.bigworld.player.return_value = unittest.mock.Mock(arena=self.arena)
+		self.camera = self.bigworld.camera.return_value
+		self.camera.position = (0, 0, 0)
+		self.camera.direction = (0, 0, 1)
+
+		self.users = FakeUsers()
+		self.user_cache = FakeUserCache()
+		self.arena_index = utils.ArenaIndex()
+		self.addCleanup(self.arena_index.fini)
+		self.audio = positional_audio.PositionalAudio(self.users, self.user_cache, self.arena_index)
+		self.addCleanup(self.audio.fini)
+
+		self.add_player(client_id=1, player_id=100, vehicle_id=1000, position=(1, 2, 3))
+		self.add_player(client_id=2, player_id=200, vehicle_id=2000, position=(4, 5, 6))
+		self.audio.enable()
+		self.api.reset_mock()
+
+	def add_player(self, client_id, player_id, vehicle_id, position):
+		self.users[client_id] = unittest.mock.Mock(client_id=client_id, unique_id="uid%d" % client_id)
+		self.user_cache.pairings["uid%d" % client_id] = [player_id]
+		self.arena.vehicles[vehicle_id] = {"accountDBID": player_id, "name": "Player%d" % player_id, "isAlive": True}
+		self.arena.positions[vehicle_id] = position
+
+	def get_written_clients(self, call):
+		return [(client_id, (position.x, position.y, position.z)) for client_id, position in call[0][0]]
+
+	def test_writes_all_clients_on_enable(self):
+		self.audio.disable()
+		self.audio.enable()
+		assert self.get_written_clients(self.api.set_client_positions.call_args) == [
+			(1, (1, 2, 3)), (2, (4, 5, 6))]
+
+	def test_writes_nothing_when_nothing_changed(self):
+		self.audio.on_update_to_ts()
+		self.arena.onPositionsUpdated()
+		self.audio.on_update_to_ts()
+		assert not self.api.method_calls
+
+	def test_writes_only_moved_vehicle_slots(self):
+		self.arena.positions[2000] = (7, 8, 9)
+		self.arena.onPositionsUpdated()
+		self.audio.on_update_to_ts()
+		assert not self.api.set_client_positions.called
+		self.api.set_client_position.assert_called_once_with(1, 2, unittest.mock.ANY)
+		position = self.api.set_client_position.call_args[0][2]
+		assert (position.x, position.y, position.z) == (7, 8, 9)
+
+	def test_writes_camera_when_it_moves(self):
+		self.camera.position = (10, 10, 10)
+		self.audio.on_update_to_ts()
+		self.api.set_camera.assert_called_once_with((10, 10, 10), (0, 0, 1))
+		assert not self.api.set_client_positions.called
+		assert not self.api.set_client_position.called
+
+	def test_does_not_rebind_on_position_updates(self):
+		self.user_cache.get_paired_ts_user_ids = unittest.mock.Mock(wraps=self.user_cache.get_paired_ts_user_ids)
+		for index in range(10):
+			self.arena.positions[1000] = (index, 0, 0)
+			self.arena.onPositionsUpdated()
+			self.audio.on_update_to_ts()
+		assert not self.user_cache.get_paired_ts_user_ids.called
+		assert self.api.set_client_position.call_count == 10
+
+	def test_rewrites_clients_when_user_leaves(self):
+		del self.users[1]
+		self.users.on_removed()
+		self.audio.on_update_to_ts()
+		assert self.get_written_clients(self.api.set_client_positions.call_args) == [(2, (4, 5, 6))]
+
+	def test_does_not_rewrite_clients_when_bindings_stay_same(self):
+		self.users.on_modified()
+		self.user_cache.on_updated()
+		self.audio.on_update_to_ts()
+		assert not self.api.method_calls
+
+	def test_rewrites_clients_when_vehicle_is_killed(self):
+		self.arena.vehicles[1000] = dict(self.arena.vehicles[1000], isAlive=False)
+		self.arena.onVehicleKilled(1000, 0, 0, 0)
+		self.audio.on_update_to_ts()
+		assert self.get_written_clients(self.api.set_client_positions.call_args) == [(2, (4, 5, 6))]
+
+	def test_adds_client_when_its_vehicle_gets_position(self):
+		self.users[3] = unittest.mock.Mock(client_id=3, unique_id="uid3")
+		self.user_cache.pairings["uid3"] = [300]
+		self.arena.vehicles[3000] = {"accountDBID": 300, "name": "Player300", "isAlive": True}
+		self.arena.onVehicleAdded(3000)
+		self.users.on_added()
+		self.audio.on_update_to_ts()
+		assert not self.api.set_client_positions.called
+		self.arena.positions[3000] = (0, 0, 1)
+		self.arena.onPositionsUpdated()
+		self.audio.on_update_to_ts()
+		assert self.get_written_clients(self.api.set_client_positions.call_args) == [
+			(1, (1, 2, 3)), (2, (4, 5, 6)), (3, (0, 0, 1))]
+
+	def test_binds_each_client_of_paired_ts_user(self):
+		self.users[3] = unittest.mock.Mock(client_id=3, unique_id="uid1")
+		self.users.on_added()
+		self.audio.on_update_to_ts()
+		assert self.get_written_clients(self.api.set_client_positions.call_args) == [
+			(1, (1, 2, 3)), (2, (4, 5, 6)), (3, (1, 2, 3))]
+
+	def test_keeps_client_slots_when_arena_is_enumerated_in_other_order(self):
+		self.users[0] = unittest.mock.Mock(client_id=0, unique_id="uid0")
+		self.user_cache.pairings["uid0"] = [300]
+		self.arena.vehicles[3000] = {"accountDBID": 300, "name": "Player300", "isAlive": True}
+		self.arena.positions[3000] = (0, 0, 1)
+		self.arena.onVehicleAdded(3000)
+		self.arena.onPositionsUpdated()
+		self.users.on_added()
+		self.audio.on_update_to_ts()
+		assert self.get_written_clients(self.api.set_client_positions.call_args) == [
+			(1, (1, 2, 3)), (2, (4, 5, 6)), (0, (0, 0, 1))]
+		self.api.reset_mock()
+		vehicles = list(self.arena.vehicles.items())
+		self.arena.vehicles.clear()
+		self.arena.vehicles.update(reversed(vehicles))
+		self.arena.onNewVehicleListReceived()
+		self.audio.on_update_to_ts()
+		assert not self.api.set_client_positions.called
+
+	def test_clears_clients_on_disable(self):
+		self.audio.disable()
+		assert self.get_written_clients(self.api.set_client_positions.call_args) == []
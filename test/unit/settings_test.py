@@ -0,0 +1,130 @@
+# TessuMod: Mod for integrating TeamSpeak into World of Tanks
+# Copyright (C) 2019  Janne Hakonen
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from tessumod.settings import Settings
+
+class TestSettings(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.tmp_dir)
+		self.ini_path = os.path.join(self.tmp_dir, "tessu_mod.ini")
+
+	def write_ini(self, contents):
+		with io.open(self.ini_path, "wt", encoding="utf8") as f:
+			f.write(u"\n".join(line.strip() for line in contents.split(u"\n")))
+
+	def test_writes_default_file_and_uses_defaults(self):
+		settings = Settings(self.ini_path)
+		assert os.path.isfile(self.ini_path)
+		assert settings.get_log_level() == 1
+		assert settings.get_speak_stop_delay() == 1.0
+		assert settings.get_client_query_port() == 25639
+		assert settings.is_client_query_pipelining_enabled() is True
+		assert settings.get_client_query_interval() < settings.get_client_query_idle_interval()
+		assert settings.get_nick_extract_patterns() == ()
+		assert settings.get_name_mappings() == {}
+
+	def test_returns_typed_values(self):
+		self.write_ini(u"""
+			[General]
+			speak_stop_delay: 2.5
+			update_cache_in_replays: on
+			nick_extract_patterns: ^(\\w+), \\[T\\](\\w+)
+			[NameMappings]
+			TsUser: WotUser
+			[TSClientQueryService]
+			api_key: ABCD
+			port: 1234
+		""")
+		settings = Settings(self.ini_path)
+		assert settings.get_speak_stop_delay() == 2.5
+		assert settings.should_update_cache_in_replays() is True
+		assert [p.pattern for p in settings.get_nick_extract_patterns()] == [u"^(\\w+)", u" \\[T\\](\\w+)"]
+		assert settings.get_name_mappings() == {u"tsuser": u"wotuser"}
+		assert settings.get_client_query_apikey() == u"ABCD"
+		assert settings.get_client_query_port() == 1234
+
+	def test_compiles_patterns_once_per_load(self):
+		self.write_ini(u"""
+			[General]
+			nick_extract_patterns: ^(\\w+)
+		""")
+		settings = Settings(self.ini_path)
+		assert settings.get_nick_extract_patterns() is settings.get_nick_extract_patterns()
+
+	def test_name_mappings_cannot_be_modified_by_callers(self):
+		self.write_ini(u"""
+			[NameMappings]
+			TsUser: WotUser
+		""")
+		settings = Settings(self.ini_path)
+		with self.assertRaises(TypeError):
+			settings.get_name_mappings()[u"tsuser"] = u"other"
+		assert settings.get_name_mappings() == {u"tsuser": u"wotuser"}
+
+	def test_returns_same_name_mappings_until_reload(self):
+		self.write_ini(u"""
+			[NameMappings]
+			TsUser: WotUser
+		""")
+		settings = Settings(self.ini_path)
+		assert settings.get_name_mappings() is settings.get_name_mappings()
+
+	def test_reload_replaces_values_before_notifying(self):
+		settings = Settings(self.ini_path)
+		delays = []
+		settings.on_reloaded += lambda: delays.append(settings.get_speak_stop_delay())
+		self.write_ini(u"""
+			[General]
+			speak_stop_delay: 3
+		""")
+		settings.sync(force=True)
+		assert delays == [3.0]
+
+	def test_keeps_previous_values_on_invalid_value(self):
+		self.write_ini(u"""
+			[General]
+			speak_stop_delay: 3
+		""")
+		settings = Settings(self.ini_path)
+		self.write_ini(u"""
+			[General]
+			speak_stop_delay: 5
+			log_level: invalid
+		""")
+		with unittest.mock.patch("tessumod.settings.LOG_ERROR") as log_error:
+			settings.sync(force=True)
+		assert log_error.called
+		assert settings.get_speak_stop_delay() == 3.0
+		assert settings.get_log_level() == 1
+
+	def test_uses_defaults_on_invalid_value_in_first_load(self):
+		self.write_ini(u"""
+			[General]
+			log_level: invalid
+		""")
+		with unittest.mock.patch("tessumod.settings.LOG_ERROR"):
+			settings = Settings(self.ini_path)
+		assert settings.get_log_level() == 1
@@ -0,0 +1,107 @@
+# TessuMod: Mod for integrating TeamSpeak into World of Tanks
+# Copyright (C) 2019  Janne Hakonen
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+import unittest.mock
+
+from tessumod import talk_states
+
+class TestTalkStateStore(unittest.TestCase):
+
+	def setUp(self):
+		patcher = unittest.mock.patch("tessumod.talk_states.BigWorld")
+		self.bigworld = patcher.start()
+		self.addCleanup(patcher.stop)
+		self.store = talk_states.TalkStateStore()
+		self.addCleanup(self.store.fini)
+		self.on_changed = unittest.mock.Mock()
+		self.store.on_changed += self.on_changed
+
+	def next_frame(self):
+		self.bigworld.callback.call_args[0][1]()
+
+	def get_changes(self):
+		changes = [change for call in self.on_changed.call_args_list for change in call[0][0]]
+		self.on_changed.reset_mock()
+		return changes
+
+	def test_keeps_talk_states(self):
+		assert not self.store.is_talking(1)
+		self.store.set_talking(1, True)
+		assert self.store.is_talking(1)
+		self.store.set_talking(1, False)
+		assert not self.store.is_talking(1)
+
+	def test_publishes_in_next_frame(self):
+		self.store.publish(1, True, True)
+		assert not self.on_changed.called
+		assert self.store.get_pending_count() == 1
+		self.next_frame()
+		assert self.get_changes() == [(1, True, True)]
+		assert self.store.get_pending_count() == 0
+
+	def test_batches_publishes_of_frame_to_one_event(self):
+		self.store.publish(1, True, True)
+		self.store.publish(2, True, False)
+		assert self.bigworld.callback.call_count == 1
+		self.next_frame()
+		assert self.on_changed.call_count == 1
+		assert self.get_changes() == [(1, True, True), (2, True, False)]
+
+	def test_publishes_only_changes(self):
+		self.store.publish(1, True, True)
+		self.next_frame()
+		self.get_changes()
+		self.store.publish(1, True, True)
+		self.next_frame()
+		assert not self.on_changed.called
+		self.store.publish(1, False, False)
+		self.next_frame()
+		assert self.get_changes() == [(1, False, False)]
+
+	def test_does_not_publish_not_talking_for_unpublished_player(self):
+		self.store.publish(1, False, False)
+		self.next_frame()
+		assert not self.on_changed.called
+
+	def test_publishes_only_latest_state_of_frame(self):
+		self.store.publish(1, True, True)
+		self.next_frame()
+		self.get_changes()
+		self.store.publish(1, False, False)
+		self.store.publish(1, True, True)
+		self.next_frame()
+		assert not self.on_changed.called
+
+	def test_reset_publishes_talking_players_as_not_talking_at_once(self):
+		self.store.set_talking(1, True)
+		self.store.publish(1, True, True)
+		self.store.publish(2, True, False)
+		self.store.publish(3, False, False)
+		self.next_frame()
+		self.get_changes()
+		self.store.reset()
+		assert self.on_changed.call_count == 1
+		assert self.get_changes() == [(1, False, False), (2, False, False)]
+		assert not self.store.is_talking(1)
+
+	def test_reset_drops_pending_publishes(self):
+		self.store.publish(1, True, True)
+		self.store.reset()
+		assert self.bigworld.cancelCallback.called
+		assert not self.on_changed.called
+		assert self.store.get_pending_count() == 0
@@ -15,9 +15,47 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import random
+import socket
+import timeit
+import tracemalloc
 import unittest
+import unittest.mock
+import weakref
+
 from nose.tools import assert_equal
-from tessumod import ts3
+import pytest
+
+from tessumod import ts3, asyncore_utils
+
+# Lines as received from TeamSpeak's client query, used for comparing the
+# parser against the original per-character implementation
+RECORDED_LINES = [
+	"clid=3",
+	"clid=3 cid=173",
+	"clid=24 client_meta_data",
+	"client_meta_data clid=24",
+	"",
+	"clid=1  cid=2",
+	"schandlerid=1",
+	"virtualserver_name=Dummy\\sServer",
+	"notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=5",
+	"notifyclientmoved schandlerid=1 ctid=12 reasonid=0 clid=5",
+	"notifyconnectstatuschange schandlerid=1 status=disconnected error=0",
+	r"notifyclientupdated schandlerid=1 clid=7 client_meta_data=Version:\s2.5.1.982\nArma\sConnected:\sNo<wot_nickname_start>Testinukke<wot_nickname_end>",
+	r"notifycliententerview schandlerid=1 cfid=0 ctid=2 reasonid=0 clid=8 client_unique_identifier=asaZjcw\/gfebE\/PM= client_nickname=Erkki\s[T-BAD] client_meta_data=<wot_nickname_start>TuhoajaErkki<wot_nickname_end>|clid=9 client_nickname=Matti",
+	r"clid=24 client_meta_data=Weird\sName:\s\\\/\p\a\b\f\n\r\t\v",
+	"clid=24 client_meta_data=trailing\\",
+	r"clid=24 client_meta_data=a=b=c|clid=25",
+	"|".join(
+		"clid={0} cid={1} client_database_id={0} client_nickname=Player\\s{0}\\s[CLAN] client_type=0 "
+		"client_flag_talking={2} client_input_muted=0 client_output_muted=0 client_input_hardware=1 "
+		"client_output_hardware=1 client_talk_power=75 client_is_talker=0 client_is_priority_speaker=0 "
+		"client_is_recording=0 client_is_channel_commander=0 client_unique_identifier=UID{0}\\/abc="
+		.format(index, index % 5, index % 2)
+		for index in range(40)
+	)
+]
 
 class TestCQParameterParsing(unittest.TestCase):
 
@@ -55,6 +93,82 @@ class TestCQParameterParsing(unittest.TestCase):
 		assert 1 == int(p2["clid"])
 		assert 2 == int(p3["clid"])
 
+	def test_keeps_raw_equal_signs_in_value(self):
+		[params] = ts3.parse_client_query_parameters("clid=24 client_meta_data=a=b")
+		assert "a=b" == params["client_meta_data"]
+
+	def test_parses_empty_line_to_single_empty_entry(self):
+		assert [{"": ""}] == ts3.parse_client_query_parameters("")
+
+	def test_matches_legacy_parser_with_recorded_lines(self):
+		for line in RECORDED_LINES:
+			assert_equal(ts3.parse_client_query_parameters(line), LegacyParamsParser().parse(line))
+
+class TestCQParameterValueParsing(unittest.TestCase):
+
+	def test_can_parse_values(self):
+		status, client_id = ts3.parse_client_query_values("notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=5", "status", "clid")
+		assert_equal(status, "1")
+		assert_equal(client_id, "5")
+
+	def test_returns_none_for_missing_value(self):
+		client_id, channel_id = ts3.parse_client_query_values("clid=3", "clid", "cid")
+		assert_equal(client_id, "3")
+		assert channel_id is None
+
+	def test_returns_empty_string_for_value_less_parameter(self):
+		[metadata] = ts3.parse_client_query_values("clid=24 client_meta_data", "client_meta_data")
+		assert_equal(metadata, "")
+
+	def test_unescapes_value(self):
+		[metadata] = ts3.parse_client_query_values(r"clid=24 client_meta_data=Weird\sName:\s\\\/\p\a\b\f\n\r\t\v", "client_meta_data")
+		assert_equal(metadata, "Weird Name: \\/|\a\b\f\n\r\t\v")
+
+	def test_does_not_unescape_other_values(self):
+		# unknown escape would raise KeyError if it was unescaped
+		[client_id] = ts3.parse_client_query_values(r"clid=24 client_meta_data=\x", "clid")
+		assert_equal(client_id, "24")
+
+	def test_reads_only_first_entry(self):
+		[client_id] = ts3.parse_client_query_values("clid=3|clid=1|clid=2", "clid")
+		assert_equal(client_id, "3")
+		[channel_id] = ts3.parse_client_query_values("clid=3|cid=1", "cid")
+		assert channel_id is None
+
+	def test_single_parameter_matches_full_parse(self):
+		for line in RECORDED_LINES:
+			entry = ts3.parse_client_query_parameters(line)[0]
+			for key in entry:
+				assert_equal(ts3.parse_client_query_parameter(line, key), entry[key])
+
+@pytest.mark.slow
+class TestCQParameterParsingBenchmark(unittest.TestCase):
+
+	def test_value_parsing_is_faster_than_full_parse(self):
+		lines = [
+			"notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=5",
+			"notifyclientmoved schandlerid=1 ctid=12 reasonid=0 clid=5",
+			r"notifyclientupdated schandlerid=1 clid=7 client_meta_data=Version:\s2.5.1.982\nArma\sConnected:\sNo<wot_nickname_start>Testinukke<wot_nickname_end>",
+		]
+		def full_parse():
+			for line in lines:
+				[entry] = ts3.parse_client_query_parameters(line)
+				entry.get("clid"), entry.get("status")
+		def values_parse():
+			for line in lines:
+				ts3.parse_client_query_values(line, "clid", "status")
+		full_time = min(timeit.repeat(full_parse, number=2000, repeat=3))
+		values_time = min(timeit.repeat(values_parse, number=2000, repeat=3))
+		assert values_time < full_time
+
+	def test_parser_is_faster_than_legacy_parser(self):
+		def parse_all(parser_factory):
+			for line in RECORDED_LINES:
+				parser_factory().parse(line)
+		legacy_time = min(timeit.repeat(lambda: parse_all(LegacyParamsParser), number=20, repeat=3))
+		current_time = min(timeit.repeat(lambda: parse_all(ts3.ParamsParser), number=20, repeat=3))
+		assert current_time < legacy_time
+
 class TestCommandStringBuilding(unittest.TestCase):
 
 	def test_builds_command_without_args(self):
@@ -82,3 +196,689 @@ class TestCommandStringBuilding(unittest.TestCase):
 		cmd_str = ts3.build_command_string("clientupdate", [], {"client_meta_data": client_meta_data})
 		[params] = ts3.parse_client_query_parameters(cmd_str.split(" ", 1)[1])
 		assert_equal(params["client_meta_data"], client_meta_data)
+
+class TestUser(unittest.TestCase):
+
+	def setUp(self):
+		self.model = ts3.UserModel()
+		self.model.add(client_id=1, nick="Erkki", channel_id=1)
+		self.user = self.model[1]
+		self.on_modified = unittest.mock.Mock()
+		self.model.on_modified += self.on_modified
+
+	def test_has_no_instance_dict(self):
+		assert not hasattr(self.user, "__dict__")
+
+	def test_update_sets_fields(self):
+		self.user.update(nick="Matti", wot_nick="TestMatti", speaking=True)
+		assert_equal((self.user.nick, self.user.wot_nick, self.user.speaking), ("Matti", "TestMatti", True))
+
+	def test_update_notifies_once(self):
+		assert self.user.update(nick="Matti", wot_nick="TestMatti", channel_id=2)
+		self.on_modified.assert_called_once_with(1)
+
+	def test_update_does_not_notify_without_changes(self):
+		assert not self.user.update(nick="Erkki", channel_id=1, wot_nick=None)
+		assert not self.on_modified.called
+
+	def test_update_rejects_unknown_field(self):
+		with pytest.raises(TypeError):
+			self.user.update(name="Matti")
+
+	def test_model_add_notifies_existing_user_once(self):
+		self.model.add(client_id=1, nick="Matti", wot_nick="TestMatti", channel_id=2)
+		self.on_modified.assert_called_once_with(1)
+		assert self.model[1] is self.user
+
+	def test_model_add_does_not_create_user_for_existing_client(self):
+		with unittest.mock.patch("tessumod.ts3.User") as user_class:
+			self.model.add(client_id=1, channel_id=2)
+		assert not user_class.called
+
+class TestUserFilterProxy(unittest.TestCase):
+
+	def setUp(self):
+		self.channel_id = 1
+		self.model = ts3.UserModel()
+		for client_id, channel_id in [(1, 1), (2, 1), (3, 2), (4, 2), (5, 3)]:
+			self.model.add(client_id=client_id, nick="User%d" % client_id, channel_id=channel_id)
+		self.proxy = ts3.UserFilterProxy(self.model, lambda user: user.channel_id == self.channel_id)
+		self.proxy.invalidate()
+		self.on_added = unittest.mock.Mock()
+		self.on_removed = unittest.mock.Mock()
+		self.proxy.on_added += self.on_added
+		self.proxy.on_removed += self.on_removed
+
+	def get_notified(self, mock):
+		return sorted(call[0][0] for call in mock.call_args_list)
+
+	def test_invalidate_notifies_changed_clients(self):
+		self.channel_id = 2
+		self.proxy.invalidate()
+		assert_equal(self.get_notified(self.on_removed), [1, 2])
+		assert_equal(self.get_notified(self.on_added), [3, 4])
+		assert_equal(sorted(self.proxy), [3, 4])
+
+	def test_looks_up_only_included_clients_from_indexes(self):
+		self.model.add(client_id=1, unique_id="uid", wot_nick="Tanker")
+		self.model.add(client_id=3, unique_id="uid", wot_nick="tanker")
+		assert_equal(self.proxy.client_ids_by_unique_id("uid"), set([1]))
+		assert_equal(self.proxy.client_ids_by_wot_nick("TANKER"), set([1]))
+
+	def test_invalidate_does_not_notify_unchanged_clients(self):
+		included = set([1, 2, 3])
+		proxy = ts3.UserFilterProxy(self.model, lambda user: user.client_id in included)
+		proxy.invalidate()
+		proxy.on_added += self.on_added
+		proxy.on_removed += self.on_removed
+		included.difference_update([2])
+		included.update([4])
+		proxy.invalidate()
+		assert_equal(self.get_notified(self.on_removed), [2])
+		assert_equal(self.get_notified(self.on_added), [4])
+		assert_equal(sorted(proxy), [1, 3, 4])
+
+	def test_invalidate_without_changes_notifies_nothing(self):
+		self.proxy.invalidate()
+		assert not self.on_added.called
+		assert not self.on_removed.called
+
+class TestUserModelChannelIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.model = ts3.UserModel()
+		for client_id, channel_id in [(1, 1), (2, 1), (3, 2)]:
+			self.model.add(client_id=client_id, channel_id=channel_id)
+
+	def test_returns_clients_in_channel(self):
+		assert_equal(self.model.client_ids_in_channel(1), set([1, 2]))
+		assert_equal(self.model.client_ids_in_channel(2), set([3]))
+		assert_equal(self.model.client_ids_in_channel(3), set())
+
+	def test_updates_index_when_user_moves(self):
+		self.model.add(client_id=1, channel_id=2)
+		self.model[2].channel_id = 3
+		assert_equal(self.model.client_ids_in_channel(1), set())
+		assert_equal(self.model.client_ids_in_channel(2), set([1, 3]))
+		assert_equal(self.model.client_ids_in_channel(3), set([2]))
+
+	def test_updates_index_when_user_is_removed(self):
+		self.model.remove(1)
+		assert_equal(self.model.client_ids_in_channel(1), set([2]))
+
+	def test_clears_index(self):
+		self.model.clear()
+		assert_equal(self.model.client_ids_in_channel(1), set())
+
+	def test_index_is_updated_before_modification_is_notified(self):
+		channels = []
+		self.model.on_modified += lambda client_id: channels.append(self.model.client_ids_in_channel(2))
+		self.model.add(client_id=1, channel_id=2)
+		assert_equal(channels, [set([1, 3])])
+
+class TestUserModelIndexes(unittest.TestCase):
+
+	def setUp(self):
+		self.model = ts3.UserModel()
+		self.model.add(client_id=1, unique_id="UID1", wot_nick="TestTomato", channel_id=1)
+		self.model.add(client_id=2, unique_id="UID2", wot_nick="TestDummy", channel_id=1)
+
+	def test_finds_clients_by_unique_id(self):
+		assert_equal(self.model.client_ids_by_unique_id("UID1"), set([1]))
+		assert_equal(self.model.client_ids_by_unique_id("UID3"), set())
+
+	def test_finds_clients_by_wot_nick_case_insensitive(self):
+		assert_equal(self.model.client_ids_by_wot_nick("testtomato"), set([1]))
+		assert_equal(self.model.client_ids_by_wot_nick("TESTDUMMY"), set([2]))
+
+	def test_finds_same_user_connected_twice(self):
+		self.model.add(client_id=3, unique_id="UID1", wot_nick="TestTomato", channel_id=2)
+		assert_equal(self.model.client_ids_by_unique_id("UID1"), set([1, 3]))
+		assert_equal(self.model.client_ids_by_wot_nick("TestTomato"), set([1, 3]))
+
+	def test_does_not_index_empty_wot_nick(self):
+		self.model.add(client_id=3, unique_id="UID3", wot_nick="", channel_id=2)
+		assert_equal(self.model.client_ids_by_wot_nick(""), set())
+
+	def test_updates_indexes_when_user_changes(self):
+		self.model[1].wot_nick = "TestBanana"
+		self.model[2].update(unique_id="UID4", wot_nick="TestTomato")
+		assert_equal(self.model.client_ids_by_wot_nick("TestTomato"), set([2]))
+		assert_equal(self.model.client_ids_by_wot_nick("TestBanana"), set([1]))
+		assert_equal(self.model.client_ids_by_unique_id("UID2"), set())
+		assert_equal(self.model.client_ids_by_unique_id("UID4"), set([2]))
+
+	def test_stays_consistent_under_random_churn(self):
+		rnd = random.Random(4321)
+		model = ts3.UserModel()
+		unique_ids = ["UID%d" % index for index in range(20)]
+		wot_nicks = ["Tanker%d" % index for index in range(15)] + ["TANKER1", "tanker2", ""]
+		for step in range(3000):
+			action = rnd.random()
+			client_id = rnd.randint(1, 60)
+			if action < 0.4:
+				model.add(
+					client_id  = client_id,
+					nick       = "User%d" % client_id,
+					wot_nick   = rnd.choice(wot_nicks + [None]),
+					unique_id  = rnd.choice(unique_ids + [None]),
+					channel_id = rnd.choice([0, 1, 2, 3, None])
+				)
+			elif action < 0.6 and client_id in model:
+				setattr(model[client_id], rnd.choice(["wot_nick", "unique_id"]), rnd.choice(unique_ids + wot_nicks))
+			elif action < 0.75 and client_id in model:
+				model[client_id].update(channel_id=rnd.randint(0, 3), wot_nick=rnd.choice(wot_nicks))
+			elif action < 0.95 and client_id in model:
+				model.remove(client_id)
+			elif action < 0.96:
+				model.clear()
+			elif action < 0.98:
+				model.begin_batch()
+				model.add(client_id=client_id, channel_id=rnd.randint(0, 3), unique_id=rnd.choice(unique_ids))
+				model.end_batch()
+			self.assert_indexes_consistent(model, unique_ids, wot_nicks)
+
+	def assert_indexes_consistent(self, model, unique_ids, wot_nicks):
+		users = [model[client_id] for client_id in model]
+		for unique_id in unique_ids + wot_nicks:
+			assert_equal(model.client_ids_by_unique_id(unique_id),
+				set(user.client_id for user in users if user.unique_id == unique_id))
+		for wot_nick in unique_ids + wot_nicks:
+			assert_equal(model.client_ids_by_wot_nick(wot_nick),
+				set(user.client_id for user in users if wot_nick and user.wot_nick and user.wot_nick.lower() == wot_nick.lower()))
+		for channel_id in range(4):
+			assert_equal(model.client_ids_in_channel(channel_id),
+				set(user.client_id for user in users if user.channel_id == channel_id))
+
+class TestChannelFilterProxy(unittest.TestCase):
+
+	def setUp(self):
+		self.model = ts3.UserModel()
+		for client_id, channel_id in [(1, 1), (2, 1), (3, 2), (4, 2)]:
+			self.model.add(client_id=client_id, channel_id=channel_id)
+		self.proxy = ts3.ChannelFilterProxy(self.model)
+		self.on_added = unittest.mock.Mock()
+		self.on_removed = unittest.mock.Mock()
+		self.proxy.on_added += self.on_added
+		self.proxy.on_removed += self.on_removed
+
+	def test_is_empty_without_channel(self):
+		assert_equal(len(self.proxy), 0)
+
+	def test_includes_users_in_channel(self):
+		self.proxy.set_channel_id(1)
+		assert_equal(sorted(self.proxy), [1, 2])
+
+	def test_changing_channel_uses_channel_index(self):
+		with unittest.mock.patch.object(ts3.UserModel, "__iter__", side_effect=AssertionError("iterated")):
+			self.proxy.set_channel_id(2)
+		assert_equal(sorted(self.proxy), [3, 4])
+
+	def test_follows_users_moving_between_channels(self):
+		self.proxy.set_channel_id(1)
+		self.model.add(client_id=3, channel_id=1)
+		self.model.add(client_id=1, channel_id=2)
+		assert_equal(sorted(self.proxy), [2, 3])
+		assert_equal([call[0][0] for call in self.on_removed.call_args_list], [1])
+
+	def test_setting_same_channel_notifies_nothing(self):
+		self.proxy.set_channel_id(1)
+		self.on_added.reset_mock()
+		self.proxy.set_channel_id(1)
+		assert not self.on_added.called
+		assert not self.on_removed.called
+
+@pytest.mark.slow
+class TestUserMemoryBenchmark(unittest.TestCase):
+
+	USER_COUNT = 1000
+
+	def measure(self, create_users):
+		tracemalloc.start()
+		try:
+			users = create_users()
+			size = tracemalloc.get_traced_memory()[0]
+		finally:
+			tracemalloc.stop()
+		assert_equal(len(users), self.USER_COUNT)
+		return size
+
+	def create_model(self):
+		model = ts3.UserModel()
+		for index in range(self.USER_COUNT):
+			model.add(client_id=index, nick="Player %d" % index, wot_nick="Tanker%d" % index,
+				unique_id="UID%d/abc=" % index, channel_id=index % 5)
+		return model
+
+	def create_legacy_users(self):
+		model = ts3.UserModel()
+		users = {}
+		indexes = ({}, {}, {})
+		for index in range(self.USER_COUNT):
+			user = LegacyUser(model)
+			user.client_id = index
+			user.nick = "Player %d" % index
+			user.wot_nick = "Tanker%d" % index
+			user.unique_id = "UID%d/abc=" % index
+			user.channel_id = index % 5
+			users[index] = user
+			# same lookups as the model provides, kept as plain sets of client ids
+			keys = (user.unique_id, user.wot_nick.lower(), user.channel_id)
+			for key_index, key in zip(indexes, keys):
+				key_index.setdefault(key, set()).add(index)
+		self.legacy_indexes = indexes
+		return users
+
+	def test_model_takes_less_memory_than_legacy_users(self):
+		legacy_size = self.measure(self.create_legacy_users)
+		current_size = self.measure(self.create_model)
+		assert current_size < legacy_size
+
+class TestStateEventCoalescing(unittest.TestCase):
+
+	def test_keeps_latest_talk_status_per_client(self):
+		lines = ts3.coalesce_state_events([
+			"notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=5",
+			"notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=6",
+			"notifyclientmoved schandlerid=1 ctid=12 reasonid=0 clid=5",
+			"notifytalkstatuschange schandlerid=1 status=0 isreceivedwhisper=0 clid=5"
+		])
+		assert_equal(lines, [
+			"notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=6",
+			"notifyclientmoved schandlerid=1 ctid=12 reasonid=0 clid=5",
+			"notifytalkstatuschange schandlerid=1 status=0 isreceivedwhisper=0 clid=5"
+		])
+
+	def test_keeps_other_lines(self):
+		lines = ["clid=5 cid=1", "error id=0 msg=ok", "clid=5 cid=1", "error id=0 msg=ok"]
+		assert_equal(ts3.coalesce_state_events(lines), lines)
+
+class TestUserModelBatching(unittest.TestCase):
+
+	def setUp(self):
+		self.model = ts3.UserModel()
+		self.model.add(client_id=1, nick="Erkki", channel_id=1)
+		self.model.add(client_id=2, nick="Matti", channel_id=1)
+		self.on_modified = unittest.mock.Mock()
+		self.model.on_modified += self.on_modified
+
+	def test_notifies_modifications_immediately_outside_batch(self):
+		self.model[1].speaking = True
+		self.model[1].speaking = False
+		assert_equal(self.on_modified.call_count, 2)
+
+	def test_notifies_each_modified_user_once_per_batch(self):
+		self.model.begin_batch()
+		self.model[1].speaking = True
+		self.model[2].speaking = True
+		self.model[1].nick = "Erkki2"
+		assert not self.on_modified.called
+		self.model.end_batch()
+		assert_equal(self.on_modified.call_args_list, [unittest.mock.call(1), unittest.mock.call(2)])
+
+	def test_notifies_when_outermost_batch_ends(self):
+		self.model.begin_batch()
+		self.model.begin_batch()
+		self.model[1].speaking = True
+		self.model.end_batch()
+		assert not self.on_modified.called
+		self.model.end_batch()
+		self.on_modified.assert_called_once_with(1)
+
+	def test_notifies_pending_modification_before_removal(self):
+		on_removed = unittest.mock.Mock()
+		self.model.on_removed += on_removed
+		self.model.begin_batch()
+		self.model[1].speaking = True
+		self.model.remove(1)
+		self.on_modified.assert_called_once_with(1)
+		on_removed.assert_called_once_with(1)
+		self.model.end_batch()
+		self.on_modified.assert_called_once_with(1)
+
+class TestClientQueryProtocolBatching(unittest.TestCase):
+
+	def setUp(self):
+		patcher = unittest.mock.patch("tessumod.asyncore_utils.BigWorld")
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.client = ts3.TS3Client(asyncore_utils.EventLoopAdapter())
+		self.addCleanup(self.client.fini)
+		self.client.users.add(client_id=5, nick="Erkki", channel_id=1)
+		self.client.users.add(client_id=6, nick="Matti", channel_id=1)
+		self.speaking_changes = []
+		self.client.users.on_modified += lambda client_id: self.speaking_changes.append(
+			(client_id, self.client.users[client_id].speaking))
+		protocol = self.client._protocol
+		sock, self.peer = socket.socketpair()
+		sock.setblocking(False)
+		self.addCleanup(self.peer.close)
+		protocol.set_socket(sock)
+		protocol.connected = True
+		protocol.handle_connect()
+		protocol._data_in_handler = protocol._handle_in_data_actions
+
+	def receive(self, *lines):
+		self.peer.sendall("".join(line + "\n\r" for line in lines).encode("utf-8"))
+		self.client._protocol.handle_read()
+
+	def test_notifies_latest_talk_status_once_per_read(self):
+		self.receive(
+			"notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=5",
+			"notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=6",
+			"notifytalkstatuschange schandlerid=1 status=0 isreceivedwhisper=0 clid=5",
+			"notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=5"
+		)
+		assert_equal(self.speaking_changes, [(6, True), (5, True)])
+
+	def test_receives_long_response_in_pieces(self):
+		clientlist = "|".join(
+			"clid={0} cid=1 client_nickname=Pl\u00e4yer\\s{0}\\s\u20ac client_unique_identifier=UID{0}".format(index)
+			for index in range(500)
+		)
+		callback = unittest.mock.Mock()
+		self.client._protocol.send_command("clientlist", callback, 30)
+		data = (clientlist + "\n\rerror id=0 msg=ok\n\r").encode("utf-8")
+		for position in range(0, len(data), 1001):
+			self.peer.sendall(data[position:position+1001])
+			self.client._protocol.handle_read()
+		self.client._protocol.handle_out_commands()
+		err, lines = callback.call_args[0]
+		assert err is None
+		entries = ts3.parse_client_query_parameters(lines[0])
+		assert_equal(len(entries), 500)
+		assert_equal(entries[499]["client_nickname"], "Pl\u00e4yer 499 \u20ac")
+
+	def test_notifies_separate_reads_separately(self):
+		self.receive("notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=5")
+		self.receive("notifytalkstatuschange schandlerid=1 status=0 isreceivedwhisper=0 clid=5")
+		assert_equal(self.speaking_changes, [(5, True), (5, False)])
+
+class TestClientQueryCommandTimeouts(unittest.TestCase):
+
+	def setUp(self):
+		self.now = 1000.0
+		patcher = unittest.mock.patch("tessumod.utils.monotonic_time", lambda: self.now)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		patcher = unittest.mock.patch("tessumod.utils.BigWorld")
+		self.bigworld = patcher.start()
+		self.addCleanup(patcher.stop)
+		patcher = unittest.mock.patch("tessumod.asyncore_utils.BigWorld")
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.protocol = ts3._ClientQueryProtocol(unittest.mock.Mock(), asyncore_utils.EventLoopAdapter())
+		self.protocol.push = unittest.mock.Mock()
+		self.protocol._data_in_handler = self.protocol._handle_in_data_actions
+
+	def send_command(self, command, timeout):
+		callback = unittest.mock.Mock()
+		self.protocol.send_command(command, callback, timeout)
+		return callback
+
+	def get_scheduled_delay(self):
+		return self.bigworld.callback.call_args[0][0]
+
+	def fire_timeout(self, at_time):
+		self.now = at_time
+		self.bigworld.callback.call_args[0][1]()
+
+	def test_schedules_callback_for_earliest_deadline(self):
+		self.send_command("first", 30)
+		assert_equal(self.get_scheduled_delay(), 30)
+		self.send_command("second", 5)
+		assert_equal(self.get_scheduled_delay(), 5)
+		self.send_command("third", 10)
+		assert_equal(self.get_scheduled_delay(), 5)
+		assert_equal(self.bigworld.callback.call_count, 2)
+
+	def test_times_out_command_queued_behind_stuck_command(self):
+		stuck = self.send_command("stuck", 30)
+		queued = self.send_command("queued", 5)
+		self.protocol.handle_out_commands()
+		self.fire_timeout(1005.0)
+		self.assert_timed_out(queued)
+		assert not stuck.called
+		assert_equal(self.get_scheduled_delay(), 25)
+
+	def assert_timed_out(self, callback):
+		assert_equal(callback.call_count, 1)
+		assert isinstance(callback.call_args[0][0], ts3.CommandTimeoutError)
+
+	def test_times_out_sent_command(self):
+		callback = self.send_command("whoami", 5)
+		self.protocol.handle_out_commands()
+		self.protocol._handle_in_data_actions("clid=1 cid=1")
+		self.fire_timeout(1005.0)
+		self.assert_timed_out(callback)
+		self.protocol._handle_in_data_actions("error id=0 msg=ok")
+		self.protocol.handle_out_commands()
+		self.assert_timed_out(callback)
+		assert_equal(self.protocol._commands, [])
+
+	def test_keeps_timed_out_sent_command_until_its_response_ends(self):
+		self.protocol.pipelined = True
+		stuck = self.send_command("stuck", 5)
+		next = self.send_command("next", 30)
+		self.fire_timeout(1005.0)
+		self.assert_timed_out(stuck)
+		# late response of the timed out command must not go to next command
+		self.protocol._handle_in_data_actions("error id=1538 msg=invalid\\sparameter")
+		assert not next.called
+		self.protocol._handle_in_data_actions("clid=1 cid=1")
+		self.protocol._handle_in_data_actions("error id=0 msg=ok")
+		next.assert_called_once_with(None, ["clid=1 cid=1"])
+
+	def test_does_not_time_out_finished_command(self):
+		callback = self.send_command("whoami", 5)
+		self.protocol.handle_out_commands()
+		self.protocol._handle_in_data_actions("error id=0 msg=ok")
+		self.protocol.handle_out_commands()
+		assert self.bigworld.cancelCallback.called
+		self.fire_timeout(1005.0)
+		callback.assert_called_once_with(None, [])
+
+	def test_drops_sent_command_with_optional_response_on_timeout(self):
+		callback = unittest.mock.Mock()
+		self.protocol.send_command("clientnotifyunregister", callback, 5, response_optional=True)
+		self.protocol.handle_out_commands()
+		self.fire_timeout(1005.0)
+		callback.assert_called_once_with(None, [])
+		assert_equal(self.protocol._commands, [])
+
+	def send_pipelined_batch_with_optional_response(self):
+		self.protocol.pipelined = True
+		first = self.send_command("first", 30)
+		unregister = unittest.mock.Mock()
+		self.protocol.send_command("clientnotifyunregister", unregister, 5, response_optional=True)
+		last = self.send_command("last", 30)
+		return first, unregister, last
+
+	def get_pushed_commands(self):
+		return [call[0][0].strip() for call in self.protocol.push.call_args_list]
+
+	def test_sends_command_with_optional_response_alone_when_pipelined(self):
+		first, unregister, last = self.send_pipelined_batch_with_optional_response()
+		assert_equal(self.get_pushed_commands(), ["first"])
+		self.protocol._handle_in_data_actions("error id=0 msg=ok")
+		assert_equal(self.get_pushed_commands(), ["first", "clientnotifyunregister"])
+		self.protocol._handle_in_data_actions("error id=0 msg=ok")
+		assert_equal(self.get_pushed_commands(), ["first", "clientnotifyunregister", "last"])
+		self.protocol._handle_in_data_actions("clid=1 cid=1")
+		self.protocol._handle_in_data_actions("error id=0 msg=ok")
+		first.assert_called_once_with(None, [])
+		unregister.assert_called_once_with(None, [])
+		last.assert_called_once_with(None, ["clid=1 cid=1"])
+
+	def test_unanswered_command_with_optional_response_does_not_desync_pipeline(self):
+		first, unregister, last = self.send_pipelined_batch_with_optional_response()
+		self.protocol._handle_in_data_actions("error id=0 msg=ok")
+		self.fire_timeout(1005.0)
+		unregister.assert_called_once_with(None, [])
+		assert_equal(self.get_pushed_commands(), ["first", "clientnotifyunregister", "last"])
+		self.protocol._handle_in_data_actions("clid=1 cid=1")
+		self.protocol._handle_in_data_actions("error id=0 msg=ok")
+		last.assert_called_once_with(None, ["clid=1 cid=1"])
+
+	def test_sends_next_command_when_timed_out_head_gets_response(self):
+		self.send_command("stuck", 5)
+		self.send_command("next", 30)
+		self.protocol.handle_out_commands()
+		self.fire_timeout(1005.0)
+		self.protocol.handle_out_commands()
+		assert_equal(self.protocol.push.call_args_list, [unittest.mock.call("stuck\n\r")])
+		self.protocol._handle_in_data_actions("error id=0 msg=ok")
+		self.protocol.handle_out_commands()
+		self.protocol.handle_out_commands()
+		assert_equal(self.protocol.push.call_args_list, [
+			unittest.mock.call("stuck\n\r"),
+			unittest.mock.call("next\n\r")
+		])
+
+class TestClientQueryEventDispatching(unittest.TestCase):
+
+	class Receiver(object):
+
+		def __init__(self):
+			self.lines = []
+
+		def on_notifytalkstatuschange_ts3_event(self, line):
+			self.lines.append(line)
+
+		def on_unrelated_method(self, line):
+			pass
+
+	def setUp(self):
+		patcher = unittest.mock.patch("tessumod.asyncore_utils.BigWorld")
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.receiver = self.Receiver()
+		self.protocol = ts3._ClientQueryProtocol(self.receiver, asyncore_utils.EventLoopAdapter())
+		self.protocol._data_in_handler = self.protocol._handle_in_data_actions
+
+	def test_finds_event_handlers_from_class(self):
+		assert_equal(ts3.get_event_handler_names(self.Receiver), {
+			"notifytalkstatuschange": "on_notifytalkstatuschange_ts3_event"
+		})
+
+	def test_builds_event_handler_names_once_per_class(self):
+		assert ts3.get_event_handler_names(self.Receiver) is ts3.get_event_handler_names(self.Receiver)
+
+	def test_routes_event_to_handler_method(self):
+		line = "notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=5"
+		self.protocol._handle_in_data_actions(line)
+		assert_equal(self.receiver.lines, [line])
+
+	def test_routes_event_without_parameters(self):
+		handler = unittest.mock.Mock()
+		self.protocol.add_event_handler("notifysomething", handler)
+		self.protocol._handle_in_data_actions("notifysomething")
+		handler.assert_called_once_with("notifysomething")
+
+	def test_routes_event_to_added_handlers(self):
+		line = "notifytalkstatuschange schandlerid=1 status=1 isreceivedwhisper=0 clid=5"
+		handler = unittest.mock.Mock()
+		self.protocol.add_event_handler("notifytalkstatuschange", handler)
+		self.protocol._handle_in_data_actions(line)
+		handler.assert_called_once_with(line)
+		assert_equal(self.receiver.lines, [line])
+
+	def test_does_not_route_event_to_removed_handler(self):
+		handler = unittest.mock.Mock()
+		self.protocol.add_event_handler("notifytextmessage", handler)
+		self.protocol.remove_event_handler("notifytextmessage", handler)
+		self.protocol._handle_in_data_actions("notifytextmessage schandlerid=1 msg=hello")
+		assert not handler.called
+
+	def test_routes_command_response_to_command(self):
+		callback = unittest.mock.Mock()
+		self.protocol.push = unittest.mock.Mock()
+		self.protocol.send_command("whoami", callback, 30)
+		self.protocol.handle_out_commands()
+		self.protocol._handle_in_data_actions("clid=1 cid=1")
+		self.protocol._handle_in_data_actions("error id=0 msg=ok")
+		self.protocol.handle_out_commands()
+		callback.assert_called_once_with(None, ["clid=1 cid=1"])
+
+class LegacyLineEnd(object):
+	pass
+
+class LegacyParamsParser(object):
+	'''The original per-character client query parameter parser, kept as a
+	reference for the current implementation.
+	'''
+
+	def parse(self, parameter_str):
+		self._entry = {}
+		self._entries = []
+		self._change_parse_state(self._parse_key)
+		for char in parameter_str:
+			self._char_parser(char)
+		self._char_parser(LegacyLineEnd)
+		self._char_parser = None
+		return self._entries
+
+	def _parse_common(self, char):
+		if char == " ":
+			self._entry[self._key_name] = self._key_value
+			self._change_parse_state(self._parse_key)
+			return True
+		if char == LegacyLineEnd:
+			self._entry[self._key_name] = self._key_value
+			self._entries.append(self._entry)
+			return True
+		if char == "|":
+			self._entry[self._key_name] = self._key_value
+			self._entries.append(self._entry)
+			self._entry = {}
+			self._change_parse_state(self._parse_key)
+			return True
+		return False
+
+	def _parse_key(self, char):
+		if not self._parse_common(char):
+			if char == "=":
+				self._change_parse_state(self._parse_value)
+			else:
+				self._key_name += char
+
+	def _parse_value(self, char):
+		if not self._parse_common(char):
+			if char == "\\" and not self._escaping:
+				self._escaping = True
+			elif self._escaping:
+				self._key_value += ts3.ParamsParser._ESCAPE_LOOKUP[char]
+				self._escaping = False
+			else:
+				self._key_value += char
+
+	def _change_parse_state(self, parse_func):
+		if parse_func == self._parse_key:
+			self._key_name = ""
+			self._key_value = ""
+			self._escaping = False
+		self._char_parser = parse_func
+
+class LegacyUser(object):
+	'''User record as it was before using slots, values stored in instance's
+	dict and a weak proxy to the model created for each user.
+	'''
+
+	def __init__(self, model):
+		self.__model = weakref.proxy(model)
+		self.__nick = None
+		self.__wot_nick = None
+		self.__client_id = None
+		self.__unique_id = None
+		self.__channel_id = None
+		self.__speaking = False
+
+	def __set(self, name, value):
+		if value is not None and getattr(self, name) != value:
+			setattr(self, name, value)
+
+	client_id = property(lambda self: self.__client_id, lambda self, value: self.__set("_LegacyUser__client_id", value))
+	nick = property(lambda self: self.__nick, lambda self, value: self.__set("_LegacyUser__nick", value))
+	wot_nick = property(lambda self: self.__wot_nick, lambda self, value: self.__set("_LegacyUser__wot_nick", value))
+	unique_id = property(lambda self: self.__unique_id, lambda self, value: self.__set("_LegacyUser__unique_id", value))
+	channel_id = property(lambda self: self.__channel_id, lambda self, value: self.__set("_LegacyUser__channel_id", value))
@@ -16,11 +16,21 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import timeit
 import unittest
+import unittest.mock
 
 from configparser import RawConfigParser
 
-from tessumod.user_cache import UserCache
+import pytest
+
+from tessumod.file_writer import BackgroundFileWriter
+from tessumod.py3compat import to_unicode
+from tessumod.user_cache import INICache, UserCache, _render_cache_file
 
 base_path = os.path.dirname(os.path.realpath(__file__))
 ini_path = os.path.realpath(os.path.join(base_path, "..", "..", "tmp", "tessu_mod_cache.ini"))
@@ -60,7 +70,9 @@ class TestUserCache(unittest.TestCase):
 		print(contents)
 		with open(ini_path, "w") as file:
 			file.write(contents)
-		self.cache._ini_cache._sync_time = 0
+		# make the change look settled so that it gets synced immediately
+		modified_time = time.time() - 10
+		os.utime(ini_path, (modified_time, modified_time))
 
 	def get_cache_file_contents(self):
 		with open(ini_path, "r") as file:
@@ -205,3 +217,395 @@ class TestUserCache(unittest.TestCase):
 		assert not has_cache_value("TeamSpeakUsers", "Erkki")
 		assert not has_cache_value("GamePlayers", "ErkkiTuhoaja")
 		assert not has_cache_value("UserPlayerPairings", "Erkki")
+
+	def test_does_not_read_unchanged_file(self):
+		on_read = unittest.mock.Mock()
+		self.cache._storage.on_read += on_read
+		self.cache.sync()
+		assert not on_read.called
+
+	def test_writes_removed_cache_file_back(self):
+		self.cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		self.cache.sync()
+		os.remove(ini_path)
+		self.cache.sync()
+		assert get_cache_value("TeamSpeakUsers", "erkki") == "asaZjcw/gfebE/PM="
+
+	def test_write_delayed_until_write_delay_elapsed(self):
+		self.cache.write_delay = 10
+		with unittest.mock.patch("tessumod.user_cache.monotonic_time", return_value=100):
+			self.cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+			self.cache.sync()
+		assert not has_cache_value("TeamSpeakUsers", "erkki")
+		with unittest.mock.patch("tessumod.user_cache.monotonic_time", return_value=105):
+			self.cache.add_ts_user("Matti", "adfZjcw/gffbE/FO=")
+			self.cache.sync()
+		assert not has_cache_value("TeamSpeakUsers", "erkki")
+		with unittest.mock.patch("tessumod.user_cache.monotonic_time", return_value=110):
+			self.cache.sync()
+		assert get_cache_value("TeamSpeakUsers", "erkki") == "asaZjcw/gfebE/PM="
+		assert get_cache_value("TeamSpeakUsers", "matti") == "adfZjcw/gffbE/FO="
+
+	def test_fini_writes_pending_changes(self):
+		self.cache.write_delay = 10
+		self.cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		self.cache.fini()
+		assert get_cache_value("TeamSpeakUsers", "erkki") == "asaZjcw/gfebE/PM="
+
+	def test_does_not_rewrite_unchanged_contents(self):
+		self.cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		self.cache.sync()
+		with unittest.mock.patch("tessumod.file_writer.write_file_atomically") as write:
+			self.cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+			self.cache._storage.write_needed()
+			self.cache.sync()
+		assert not write.called
+
+	def test_can_get_paired_ts_users_of_player(self):
+		self.cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		self.cache.add_ts_user("Matti", "adfZjcw/gffbE/FO=")
+		self.cache.add_player("ErkkiTuhoaja", 1234567)
+		self.cache.pair(1234567, "adfZjcw/gffbE/FO=")
+		self.cache.pair(1234567, "asaZjcw/gfebE/PM=")
+		assert list(self.cache.get_paired_ts_user_ids(1234567)) == ["adfZjcw/gffbE/FO=", "asaZjcw/gfebE/PM="]
+		assert list(self.cache.get_paired_ts_user_ids(4897346)) == []
+
+	def test_paired_player_ids_keep_pairing_order(self):
+		self.cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		for player_id in [5, 3, 4, 1, 2]:
+			self.cache.add_player("Player%d" % player_id, player_id)
+			self.cache.pair(player_id, "asaZjcw/gfebE/PM=")
+		self.cache.pair(3, "asaZjcw/gfebE/PM=")
+		assert list(self.cache.get_paired_player_ids("asaZjcw/gfebE/PM=")) == [5, 3, 4, 1, 2]
+
+	def test_read_pairings_can_be_looked_up_by_player(self):
+		self.write_cache_file("""
+			[TeamSpeakUsers]
+			erkki = asaZjcw/gfebE/PM=
+			matti = adfZjcw/gffbE/FO=
+			[GamePlayers]
+			erkkituhoaja = 1234567
+			[UserPlayerPairings]
+			erkki = erkkituhoaja
+			matti = erkkituhoaja
+		""")
+		self.cache.sync()
+		assert sorted(self.cache.get_paired_ts_user_ids(1234567)) == ["adfZjcw/gffbE/FO=", "asaZjcw/gfebE/PM="]
+
+	def test_init_removes_unpaired_users_and_players(self):
+		self.write_cache_file("""
+			[TeamSpeakUsers]
+			erkki = asaZjcw/gfebE/PM=
+			matti = adfZjcw/gffbE/FO=
+			[GamePlayers]
+			erkkituhoaja = 1234567
+			watnao = 4897346
+			[UserPlayerPairings]
+			erkki = erkkituhoaja
+		""")
+		cache = UserCache(ini_path)
+		cache.init()
+		assert has_cache_value("TeamSpeakUsers", "erkki")
+		assert not has_cache_value("TeamSpeakUsers", "matti")
+		assert has_cache_value("GamePlayers", "erkkituhoaja")
+		assert not has_cache_value("GamePlayers", "watnao")
+
+class TestUserCacheWithBackgroundWriter(unittest.TestCase):
+
+	def setUp(self):
+		try:
+			os.makedirs(os.path.dirname(ini_path))
+		except:
+			pass
+		try:
+			os.remove(ini_path)
+		except:
+			pass
+		self.writer = BackgroundFileWriter()
+		self.addCleanup(self.writer.fini)
+		self.cache = UserCache(ini_path, file_writer=self.writer)
+		self.cache.init()
+		self.wait_until_written()
+
+	def wait_until_written(self):
+		for _ in range(1000):
+			if not self.writer.is_writing(ini_path):
+				return
+			time.sleep(0.001)
+		assert False, "Write did not finish"
+
+	def test_writes_cache_file(self):
+		self.cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		self.cache.sync()
+		self.wait_until_written()
+		assert get_cache_value("TeamSpeakUsers", "erkki") == "asaZjcw/gfebE/PM="
+
+	def test_does_not_reload_own_write(self):
+		on_read = unittest.mock.Mock()
+		self.cache._storage.on_read += on_read
+		self.cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		self.cache.sync()
+		self.wait_until_written()
+		self.cache.sync()
+		assert not on_read.called
+
+class TestSQLiteUserCache(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.tmp_dir)
+		self.ini_path = os.path.join(self.tmp_dir, "tessu_mod_cache.ini")
+		self.db_path = os.path.join(self.tmp_dir, "tessu_mod_cache.db")
+
+	def create_cache(self):
+		cache = UserCache(self.ini_path, db_path=self.db_path)
+		self.addCleanup(cache.fini)
+		cache.init()
+		return cache
+
+	def write_ini_file(self, contents):
+		with open(self.ini_path, "w") as file:
+			file.write("\n".join([line.strip() for line in contents.split("\n")]))
+		modified_time = time.time() - 10
+		os.utime(self.ini_path, (modified_time, modified_time))
+
+	def query(self, statement):
+		connection = sqlite3.connect(self.db_path)
+		try:
+			return connection.execute(statement).fetchall()
+		finally:
+			connection.close()
+
+	def test_imports_ini_file_to_database(self):
+		self.write_ini_file("""
+			[TeamSpeakUsers]
+			erkki = asaZjcw/gfebE/PM=
+			[GamePlayers]
+			erkkituhoaja = 1234567
+			[UserPlayerPairings]
+			erkki = erkkituhoaja
+		""")
+		cache = self.create_cache()
+		assert list(cache.get_paired_player_ids("asaZjcw/gfebE/PM=")) == [1234567]
+		assert self.query("SELECT ts_user_id, player_id FROM pairings") == [("asaZjcw/gfebE/PM=", "1234567")]
+
+	def test_loads_from_database_without_reading_ini_file(self):
+		cache = self.create_cache()
+		cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		cache.add_player("ErkkiTuhoaja", 1234567)
+		cache.pair(1234567, "asaZjcw/gfebE/PM=")
+		cache.fini()
+		cache = UserCache(self.ini_path, db_path=self.db_path)
+		self.addCleanup(cache.fini)
+		on_read = unittest.mock.Mock()
+		cache._storage.on_read += on_read
+		cache.init()
+		assert not on_read.called
+		assert list(cache.get_paired_player_ids("asaZjcw/gfebE/PM=")) == [1234567]
+
+	def read_ini_file(self):
+		parser = RawConfigParser()
+		parser.read([self.ini_path])
+		return parser
+
+	def test_writes_changes_to_database_and_ini_file(self):
+		cache = self.create_cache()
+		cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		cache.add_player("ErkkiTuhoaja", 1234567)
+		cache.pair(1234567, "asaZjcw/gfebE/PM=")
+		cache.sync()
+		assert self.query("SELECT id, nick FROM ts_users") == [("asaZjcw/gfebE/PM=", "erkki")]
+		assert self.query("SELECT id, nick FROM players") == [("1234567", "erkkituhoaja")]
+		assert self.read_ini_file().get("UserPlayerPairings", "erkki") == "erkkituhoaja"
+
+	def test_keeps_pairings_made_during_session_on_reload(self):
+		cache = self.create_cache()
+		cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		cache.add_player("ErkkiTuhoaja", 1234567)
+		cache.pair(1234567, "asaZjcw/gfebE/PM=")
+		cache.sync()
+		cache.sync(force=True)
+		assert list(cache.get_paired_player_ids("asaZjcw/gfebE/PM=")) == [1234567]
+		assert self.query("SELECT ts_user_id, player_id FROM pairings") == [("asaZjcw/gfebE/PM=", "1234567")]
+
+	def test_exports_ini_file_on_fini(self):
+		cache = self.create_cache()
+		cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		cache.add_player("ErkkiTuhoaja", 1234567)
+		cache.pair(1234567, "asaZjcw/gfebE/PM=")
+		cache.sync()
+		cache.fini()
+		assert self.read_ini_file().get("UserPlayerPairings", "erkki") == "erkkituhoaja"
+
+	def test_exports_ini_file_on_demand(self):
+		cache = self.create_cache()
+		cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		cache.add_player("ErkkiTuhoaja", 1234567)
+		cache.pair(1234567, "asaZjcw/gfebE/PM=")
+		cache._storage.export_cache_file(immediate=True)
+		assert self.read_ini_file().get("UserPlayerPairings", "erkki") == "erkkituhoaja"
+
+	def test_imports_modified_ini_file(self):
+		cache = self.create_cache()
+		self.write_ini_file("""
+			[TeamSpeakUsers]
+			matti = adfZjcw/gffbE/FO=
+			[GamePlayers]
+			watnao = 4897346
+			[UserPlayerPairings]
+			matti = watnao
+		""")
+		cache.sync()
+		assert list(cache.get_paired_player_ids("adfZjcw/gffbE/FO=")) == [4897346]
+		assert self.query("SELECT id FROM ts_users") == [("adfZjcw/gffbE/FO=",)]
+
+	def test_imports_ini_file_modified_while_not_running(self):
+		cache = self.create_cache()
+		cache.fini()
+		self.write_ini_file("""
+			[TeamSpeakUsers]
+			matti = adfZjcw/gffbE/FO=
+			[GamePlayers]
+			watnao = 4897346
+			[UserPlayerPairings]
+			matti = watnao
+		""")
+		cache = self.create_cache()
+		assert list(cache.get_paired_player_ids("adfZjcw/gffbE/FO=")) == [4897346]
+
+	def test_keeps_database_when_ini_file_is_invalid(self):
+		cache = self.create_cache()
+		cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		cache.add_player("ErkkiTuhoaja", 1234567)
+		cache.pair(1234567, "asaZjcw/gfebE/PM=")
+		cache.fini()
+		self.write_ini_file("""
+			[TeamSpeakUsers]
+			[GamePlayers]
+			[UserPlayerPairings]
+			matti = watnao
+		""")
+		cache = UserCache(self.ini_path, db_path=self.db_path)
+		self.addCleanup(cache.fini)
+		errors = []
+		cache.on_read_error += errors.append
+		cache.init()
+		assert errors
+		assert list(cache.get_paired_player_ids("asaZjcw/gfebE/PM=")) == [1234567]
+		# the invalid file is left for user to fix
+		cache.add_ts_user("Matti", "adfZjcw/gffbE/FO=")
+		cache.sync()
+		assert self.query("SELECT id FROM ts_users") == [("asaZjcw/gfebE/PM=",)]
+
+	def test_removes_unpaired_users_from_database_on_init(self):
+		cache = self.create_cache()
+		cache.add_ts_user("Erkki", "asaZjcw/gfebE/PM=")
+		cache.add_player("ErkkiTuhoaja", 1234567)
+		cache.fini()
+		self.create_cache()
+		assert self.query("SELECT id FROM ts_users") == []
+		assert self.query("SELECT id FROM players") == []
+
+	def test_falls_back_to_ini_file_without_sqlite3(self):
+		with unittest.mock.patch("tessumod.user_cache.sqlite3", None):
+			cache = UserCache(self.ini_path, db_path=self.db_path)
+		assert isinstance(cache._storage, INICache)
+
+def legacy_init_cleanup(ts_users, players, pairings):
+	"""Cleanup as it was implemented with pairings stored in lists."""
+	cleanup_ts_ids = [id for id in ts_users]
+	cleanup_player_ids = [id for id in players]
+	for ts_id, player_ids in pairings.items():
+		cleanup_ts_ids.remove(ts_id)
+		for player_id in pairings[ts_id]:
+			try:
+				cleanup_player_ids.remove(player_id)
+			except:
+				pass
+	return cleanup_ts_ids, cleanup_player_ids
+
+def legacy_pair(pairings, player_id, ts_user_id):
+	"""Pairing as it was implemented with pairings stored in lists."""
+	if ts_user_id not in pairings:
+		pairings[ts_user_id] = []
+	if player_id not in pairings[ts_user_id]:
+		pairings[ts_user_id].append(player_id)
+
+@pytest.mark.slow
+class TestUserCachePairingBenchmark(unittest.TestCase):
+
+	USER_COUNT = 10000
+
+	def setUp(self):
+		self.cache = UserCache(ini_path)
+		self.cache.write_delay = 3600
+		self.ts_user_ids = ["ts%d" % index for index in range(self.USER_COUNT)]
+		self.player_ids = list(range(self.USER_COUNT))
+		for index in range(self.USER_COUNT):
+			self.cache.add_ts_user("User%d" % index, self.ts_user_ids[index])
+			self.cache.add_player("Player%d" % index, self.player_ids[index])
+
+	def test_init_cleanup_is_faster_than_legacy_cleanup(self):
+		for index in range(0, self.USER_COUNT, 2):
+			self.cache.pair(self.player_ids[index], self.ts_user_ids[index])
+		legacy_pairings = {ts_id: list(player_ids) for ts_id, player_ids in self.cache._pairings.items()}
+		legacy_time = min(timeit.repeat(lambda: legacy_init_cleanup(
+			self.cache._ts_users, self.cache._players, legacy_pairings), number=1, repeat=1))
+		current_time = min(timeit.repeat(self.cache._on_init_cleanup, number=1, repeat=3))
+		assert current_time < legacy_time
+		assert len(self.cache._ts_users) == self.USER_COUNT // 2
+		assert len(self.cache._players) == self.USER_COUNT // 2
+
+	def test_pairing_is_faster_than_legacy_pairing(self):
+		# worst case for lists: every player paired to the same TS user
+		ts_user_id = self.ts_user_ids[0]
+		legacy_pairings = {}
+		def legacy():
+			for player_id in self.player_ids:
+				legacy_pair(legacy_pairings, to_unicode(player_id), ts_user_id)
+		def current():
+			for player_id in self.player_ids:
+				self.cache.pair(player_id, ts_user_id)
+		legacy_time = min(timeit.repeat(legacy, number=1, repeat=1))
+		current_time = min(timeit.repeat(current, number=1, repeat=3))
+		assert current_time < legacy_time
+		assert len(list(self.cache.get_paired_player_ids(ts_user_id))) == self.USER_COUNT
+
+	def test_reverse_lookup_of_all_players(self):
+		for index in range(self.USER_COUNT):
+			self.cache.pair(self.player_ids[index], self.ts_user_ids[index])
+		lookups = [list(self.cache.get_paired_ts_user_ids(player_id)) for player_id in self.player_ids]
+		assert lookups == [[ts_user_id] for ts_user_id in self.ts_user_ids]
+
+@pytest.mark.slow
+class TestUserCacheLoadBenchmark(unittest.TestCase):
+
+	PAIRING_COUNT = 50000
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.tmp_dir)
+		self.ini_path = os.path.join(self.tmp_dir, "tessu_mod_cache.ini")
+		self.db_path = os.path.join(self.tmp_dir, "tessu_mod_cache.db")
+		ts_users = {"ts%d" % index: "user%d" % index for index in range(self.PAIRING_COUNT)}
+		players = {str(index): "player%d" % index for index in range(self.PAIRING_COUNT)}
+		pairings = {"ts%d" % index: [str(index)] for index in range(self.PAIRING_COUNT)}
+		with open(self.ini_path, "w") as file:
+			file.write(_render_cache_file((ts_users, players, pairings)))
+		# first start imports the ini-file to the database
+		cache = UserCache(self.ini_path, db_path=self.db_path)
+		cache.init()
+		cache.fini()
+
+	def load(self, db_path):
+		cache = UserCache(self.ini_path, db_path=db_path)
+		cache.init()
+		cache.fini()
+		return cache
+
+	def test_database_loads_faster_than_ini_file(self):
+		ini_time = min(timeit.repeat(lambda: self.load(None), number=1, repeat=3))
+		db_time = min(timeit.repeat(lambda: self.load(self.db_path), number=1, repeat=3))
+		assert db_time < ini_time
+		cache = self.load(self.db_path)
+		assert list(cache.get_paired_player_ids("ts%d" % (self.PAIRING_COUNT - 1))) == [self.PAIRING_COUNT - 1]
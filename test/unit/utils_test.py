@@ -20,6 +20,7 @@ import re
 import unittest
 import unittest.mock
 
+import Avatar
 from tessumod import utils, ts3
 
 class TestUtilsTSUserToPlayer(unittest.TestCase):
@@ -94,3 +95,478 @@ class TestUtilsTSUserToPlayer(unittest.TestCase):
 		)
 		assert player is not None
 		assert player.name == "TESTtomato"
+
+	def test_accepts_player_matcher(self):
+		matcher = utils.PlayerMatcher(self.create_players("TestDummy", "TESTtomato"))
+		player = utils.ts_user_to_player(
+			ts_user = self.create_ts_user(nick="[T-BAD] TestTomato"),
+			players = matcher,
+			use_ts_nick_search = True
+		)
+		assert player is not None
+		assert player.name == "TESTtomato"
+
+class TestUtilsPlayerMatcher(unittest.TestCase):
+
+	def create_matcher(self, *names):
+		return utils.PlayerMatcher(utils.Player(name, index) for index, name in enumerate(names))
+
+	def test_finds_by_name_case_insensitive(self):
+		matcher = self.create_matcher("TestDummy", "TESTtomato")
+		assert matcher.find_by_name("testtomato").name == "TESTtomato"
+		assert matcher.find_by_name("TestBanana") is None
+		assert matcher.find_by_name(None) is None
+
+	def test_first_player_wins_on_same_names(self):
+		matcher = self.create_matcher("TestTomato", "testtomato")
+		assert matcher.find_by_name("TESTTOMATO").id == 0
+
+	def test_finds_name_contained_in_text(self):
+		matcher = self.create_matcher("TestDummy", "TestTomato")
+		assert matcher.find_contained_in("[T-BAD] testtomato (squad)").name == "TestTomato"
+		assert matcher.find_contained_in("[T-BAD] TestBanana") is None
+		assert matcher.find_contained_in(None) is None
+
+	def test_first_player_wins_on_contained_names(self):
+		matcher = self.create_matcher("Tomato", "Test", "estTom")
+		assert matcher.find_contained_in("TestTomato").name == "Tomato"
+		matcher = self.create_matcher("mato", "TestTo")
+		assert matcher.find_contained_in("xTestTomato").name == "mato"
+
+	def test_finds_overlapping_names(self):
+		matcher = self.create_matcher("abcd", "bc")
+		assert matcher.find_contained_in("xabcx").name == "bc"
+
+	def test_matches_naive_search_with_random_names(self):
+		rnd = random.Random(98765)
+		for _ in range(200):
+			names = ["".join(rnd.choice("abAB_") for _ in range(rnd.randint(0 if rnd.random() < 0.05 else 1, 5)))
+				for _ in range(rnd.randint(1, 10))]
+			matcher = self.create_matcher(*names)
+			for _ in range(20):
+				text = "".join(rnd.choice("abAB_x") for _ in range(rnd.randint(0, 12)))
+				expected = next((index for index, name in enumerate(names) if name.lower() in text.lower()), None)
+				player = matcher.find_contained_in(text)
+				assert (player.id if player else None) == expected, (names, text)
+
+class TestUtilsPlayerResolutionCache(unittest.TestCase):
+
+	def setUp(self):
+		self.cache = utils.PlayerResolutionCache()
+		self.matcher = utils.PlayerMatcher([utils.Player("TestTomato", 1)])
+		self.model = ts3.UserModel()
+		self.model.add(client_id=1, nick="TestTomato", unique_id="UID1")
+		self.ts_user = self.model[1]
+		self.resolve_func = unittest.mock.Mock(return_value=utils.Player("TestTomato", 1))
+
+	def resolve(self):
+		return self.cache.resolve(self.ts_user, self.matcher, self.resolve_func)
+
+	def test_resolves_once(self):
+		first = self.resolve()
+		second = self.resolve()
+		assert first is second
+		assert self.resolve_func.call_count == 1
+		assert (self.cache.hits, self.cache.misses) == (1, 1)
+
+	def test_caches_failed_resolution(self):
+		self.resolve_func.return_value = None
+		assert self.resolve() is None
+		assert self.resolve() is None
+		assert self.resolve_func.call_count == 1
+
+	def test_hits_when_speak_status_changes(self):
+		self.resolve()
+		self.ts_user.speaking = True
+		self.resolve()
+		assert self.cache.hits == 1
+
+	def test_misses_when_nick_changes(self):
+		self.resolve()
+		self.ts_user.nick = "TestBanana"
+		self.resolve()
+		assert self.cache.misses == 2
+
+	def test_misses_when_wot_nick_changes(self):
+		self.resolve()
+		self.ts_user.wot_nick = "TestBanana"
+		self.resolve()
+		assert self.cache.misses == 2
+
+	def test_misses_when_players_change(self):
+		self.resolve()
+		self.matcher = utils.PlayerMatcher([utils.Player("TestTomato", 1), utils.Player("TestBanana", 2)])
+		self.resolve()
+		assert self.cache.misses == 2
+
+	def test_hits_first_user_after_resolving_second(self):
+		self.model.on_modified += lambda client_id: self.cache.invalidate_user(self.model[client_id])
+		self.model.add(client_id=2, nick="TestBanana", unique_id="UID2")
+		self.resolve()
+		self.cache.resolve(self.model[2], self.matcher, lambda: None)
+		self.model.add(client_id=2, nick="TestCarrot")
+		self.resolve()
+		assert (self.cache.hits, self.cache.misses) == (1, 2)
+		assert self.resolve_func.call_count == 1
+
+	def test_invalidate_user_drops_only_changed_user(self):
+		self.resolve()
+		self.ts_user.speaking = True
+		self.cache.invalidate_user(self.ts_user)
+		self.resolve()
+		self.ts_user.nick = "TestBanana"
+		self.cache.invalidate_user(self.ts_user)
+		assert self.cache._results == {}
+
+	def test_misses_after_invalidate(self):
+		self.resolve()
+		self.cache.invalidate()
+		self.resolve()
+		assert self.cache.misses == 2
+
+	def test_get_player_matcher_rebuilds_only_when_players_change(self):
+		players = [utils.Player("TestTomato", 1)]
+		get_players = unittest.mock.Mock(side_effect=lambda *args: iter(players))
+		self.addCleanup(utils.invalidate_player_matchers)
+		with unittest.mock.patch("tessumod.utils.get_players", get_players):
+			first = utils.get_player_matcher(in_battle=True)
+			assert utils.get_player_matcher(in_battle=True) is first
+			assert get_players.call_count == 1
+			players.append(utils.Player("TestBanana", 2))
+			utils.g_arena_index.on_players_changed()
+			second = utils.get_player_matcher(in_battle=True)
+			assert second is not first
+			assert second.find_by_name("testbanana") is players[1]
+
+	def test_get_player_matcher_rebuilds_when_prebattle_roster_changes(self):
+		listener = utils.PrebattleListener()
+		listener.on_updated += utils.invalidate_player_matchers
+		self.addCleanup(utils.invalidate_player_matchers)
+		with unittest.mock.patch("tessumod.utils.g_prebattleListener", listener, create=True):
+			first = utils.get_player_matcher(in_prebattle=True)
+			assert utils.get_player_matcher(in_prebattle=True) is first
+			info = unittest.mock.Mock(dbID=1)
+			info.name = "TestTomato"
+			listener.onUnitPlayerAdded(info)
+			second = utils.get_player_matcher(in_prebattle=True)
+			assert second is not first
+			assert second.find_by_name("TestTomato").id == 1
+
+class TestUtilsArenaIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.arena = self.create_arena({
+			10: {"accountDBID": 1, "name": "TestTomato", "isAlive": True},
+			20: {"accountDBID": 2, "name": "TestBanana", "isAlive": True},
+		})
+		self.player = unittest.mock.Mock(arena=self.arena)
+		patcher = unittest.mock.patch("tessumod.utils.BigWorld")
+		self.bigworld = patcher.start()
+		self.addCleanup(patcher.stop)
+		self.bigworld.player.return_value = self.player
+		self.index = utils.ArenaIndex()
+		self.addCleanup(self.index.fini)
+
+	def create_arena(self, vehicles):
+		arena = Avatar.TestArena()
+		arena.vehicles.update(vehicles)
+		return arena
+
+	def test_finds_vehicle_by_account_dbid(self):
+		assert self.index.get_vehicle_id(2) == 20
+		assert self.index.get_vehicle(20)["name"] == "TestBanana"
+		assert self.index.get_vehicle_id(3) is None
+		assert self.index.get_vehicle(None) is None
+
+	def test_returns_players(self):
+		players = self.index.get_players()
+		assert sorted((player.name, player.id) for player in players) == [("TestBanana", 2), ("TestTomato", 1)]
+		assert self.index.get_players() is players
+
+	def test_builds_tables_only_when_vehicles_change(self):
+		self.index.get_vehicle_id(1)
+		self.arena.vehicles = unittest.mock.MagicMock(wraps=self.arena.vehicles)
+		for _ in range(10):
+			self.index.get_vehicle_id(1)
+		assert not self.arena.vehicles.__iter__.called
+
+	def test_rebuilds_on_vehicle_list_events(self):
+		self.index.get_vehicle_id(1)
+		self.arena.vehicles[30] = {"accountDBID": 3, "name": "TestCarrot", "isAlive": True}
+		assert self.index.get_vehicle_id(3) is None
+		self.arena.onVehicleAdded(30)
+		assert self.index.get_vehicle_id(3) == 30
+		self.arena.vehicles[30] = {"accountDBID": 3, "name": "TestCarrot", "isAlive": False}
+		self.arena.onVehicleKilled(30, 10, 0, 0)
+		assert not self.index.get_vehicle(30)["isAlive"]
+
+	def test_updates_only_changed_vehicle(self):
+		self.index.update()
+		self.arena.vehicles = unittest.mock.MagicMock(wraps=self.arena.vehicles)
+		self.arena.onVehicleUpdated(10)
+		self.arena.onVehicleKilled(20, 10, 0, 0)
+		assert not self.arena.vehicles.__iter__.called
+
+	def test_notifies_players_changed_only_when_players_change(self):
+		self.index.update()
+		on_players_changed = unittest.mock.Mock()
+		self.index.on_players_changed += on_players_changed
+		self.arena.onVehicleKilled(10, 20, 0, 0)
+		assert not on_players_changed.called
+		self.arena.vehicles[30] = {"accountDBID": 3, "name": "TestCarrot", "isAlive": True}
+		self.arena.onVehicleAdded(30)
+		assert on_players_changed.call_count == 1
+		assert self.index.get_players()[-1].name == "TestCarrot"
+
+	def test_notifies_when_updated(self):
+		on_updated = unittest.mock.Mock()
+		self.index.on_updated += on_updated
+		self.index.update()
+		assert on_updated.call_count == 1
+		self.index.update()
+		assert on_updated.call_count == 1
+		self.arena.onVehicleUpdated(10)
+		assert on_updated.call_count == 2
+
+	def test_follows_arena_change(self):
+		self.index.get_vehicle_id(1)
+		self.player.arena = self.create_arena({
+			40: {"accountDBID": 4, "name": "TestCarrot", "isAlive": True}
+		})
+		assert self.index.get_vehicle_id(1) is None
+		assert self.index.get_vehicle_id(4) == 40
+		on_updated = unittest.mock.Mock()
+		self.index.on_updated += on_updated
+		self.arena.onNewVehicleListReceived()
+		assert not on_updated.called
+
+	def test_detaches_from_arena_on_reset(self):
+		self.index.update()
+		on_players_changed = unittest.mock.Mock()
+		self.index.on_players_changed += on_players_changed
+		self.index.reset()
+		assert on_players_changed.call_count == 1
+		on_updated = unittest.mock.Mock()
+		self.index.on_updated += on_updated
+		self.arena.onVehicleUpdated(10)
+		self.arena.onNewVehicleListReceived()
+		assert not on_updated.called
+
+	def test_empty_without_arena(self):
+		del self.player.arena
+		assert self.index.get_vehicle_id(1) is None
+		assert self.index.get_players() == ()
+
+class TestUtilsMinimapMarkersController(unittest.TestCase):
+
+	def setUp(self):
+		self.now = 100.0
+		patcher = unittest.mock.patch("tessumod.utils.monotonic_time", lambda: self.now)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		patcher = unittest.mock.patch("tessumod.utils.BigWorld")
+		self.bigworld = patcher.start()
+		self.addCleanup(patcher.stop)
+		patcher = unittest.mock.patch("tessumod.utils.g_sessionProvider", create=True)
+		self.feedback = patcher.start().shared.feedback
+		self.addCleanup(patcher.stop)
+		self.controller = utils.MinimapMarkersController()
+		self.addCleanup(self.controller.fini)
+
+	def get_shown_markers(self):
+		markers = [call[0][1:] for call in self.feedback.onMinimapFeedbackReceived.call_args_list]
+		self.feedback.onMinimapFeedbackReceived.reset_mock()
+		return markers
+
+	def advance(self, secs):
+		self.now += secs
+		self.bigworld.callback.call_args[0][1]()
+
+	def test_shows_marker_immediately_on_start(self):
+		self.controller.start(10, "attack", 2)
+		assert self.get_shown_markers() == [(10, "attack")]
+
+	def test_repeats_marker_every_interval(self):
+		self.controller.start(10, "attack", 2)
+		self.get_shown_markers()
+		assert self.bigworld.callback.call_args[0][0] == 2
+		self.advance(2)
+		assert self.get_shown_markers() == [(10, "attack")]
+		assert self.bigworld.callback.call_args[0][0] == 2
+
+	def test_uses_one_callback_for_all_markers(self):
+		for vehicle_id in range(15):
+			self.controller.start(vehicle_id, "attack", 2)
+		self.get_shown_markers()
+		self.advance(2)
+		assert len(self.get_shown_markers()) == 15
+		self.advance(2)
+		assert len(self.get_shown_markers()) == 15
+		assert self.bigworld.callback.call_count <= 3
+
+	def test_batches_markers_due_in_same_frame(self):
+		self.controller.start(10, "attack", 2)
+		self.now += 0.01
+		self.controller.start(20, "attack", 2)
+		self.get_shown_markers()
+		self.advance(2)
+		assert sorted(self.get_shown_markers()) == [(10, "attack"), (20, "attack")]
+
+	def test_shows_markers_due_in_same_frame_in_one_call(self):
+		for vehicle_id in (10, 20, 30):
+			self.controller.start(vehicle_id, "attack", 2)
+		with unittest.mock.patch.object(self.controller, "_show_markers") as show_markers:
+			self.advance(2)
+		show_markers.assert_called_once_with([(10, "attack"), (20, "attack"), (30, "attack")])
+
+	def test_cancels_callback_when_last_marker_stops(self):
+		self.controller.start(10, "attack", 2)
+		self.controller.start(20, "attack", 2)
+		self.controller.stop(10)
+		assert not self.bigworld.cancelCallback.called
+		self.controller.stop(20)
+		assert self.bigworld.cancelCallback.called
+		assert self.controller.get_running_count() == 0
+
+	def test_stop_all_cancels_callback(self):
+		self.controller.start(10, "attack", 2)
+		self.controller.start(20, "attack", 2)
+		self.controller.stop_all()
+		assert self.bigworld.cancelCallback.called
+		assert self.controller.get_running_count() == 0
+
+	def test_stopped_marker_is_not_shown(self):
+		self.controller.start(10, "attack", 2)
+		self.controller.start(20, "attack", 2)
+		self.get_shown_markers()
+		self.controller.stop(10)
+		self.advance(2)
+		assert self.get_shown_markers() == [(20, "attack")]
+
+	def test_restart_waits_for_interval_to_pass(self):
+		self.controller.start(10, "attack", 2)
+		self.get_shown_markers()
+		self.now += 0.5
+		self.controller.stop(10)
+		self.controller.start(10, "attack", 2)
+		assert self.get_shown_markers() == []
+		assert self.bigworld.callback.call_args[0][0] == 1.5
+		self.advance(1.5)
+		assert self.get_shown_markers() == [(10, "attack")]
+
+	def test_forgets_stopped_markers_once_interval_has_passed(self):
+		for vehicle_id in range(10):
+			self.controller.start(vehicle_id, "attack", 2)
+			self.controller.stop(vehicle_id)
+		self.controller.start(20, "attack", 2)
+		self.advance(2)
+		assert self.controller._resting_markers == {}
+
+	def test_start_when_running_changes_action(self):
+		self.controller.start(10, "attack", 2)
+		self.controller.start(10, "help_me", 2)
+		assert self.get_shown_markers() == [(10, "attack")]
+		self.advance(2)
+		assert self.get_shown_markers() == [(10, "help_me")]
+
+class TestUtilsTimerQueue(unittest.TestCase):
+
+	def setUp(self):
+		self.now = 100.0
+		patcher = unittest.mock.patch("tessumod.utils.monotonic_time", lambda: self.now)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		patcher = unittest.mock.patch("tessumod.utils.BigWorld")
+		self.bigworld = patcher.start()
+		self.addCleanup(patcher.stop)
+		self.timers = utils.TimerQueue()
+		self.addCleanup(self.timers.fini)
+
+	def advance(self, secs):
+		self.now += secs
+		self.bigworld.callback.call_args[0][1]()
+
+	def test_calls_function_after_delay(self):
+		func = unittest.mock.Mock()
+		self.timers.call_later(1, 0.5, func)
+		assert self.bigworld.callback.call_args[0][0] == 0.5
+		self.advance(0.5)
+		assert func.called
+		assert self.timers.get_pending_count() == 0
+
+	def test_replaces_pending_call_with_same_key(self):
+		first = unittest.mock.Mock()
+		second = unittest.mock.Mock()
+		self.timers.call_later(1, 0.5, first)
+		self.now += 0.3
+		self.timers.call_later(1, 0.5, second)
+		assert self.timers.get_pending_count() == 1
+		self.advance(0.2)
+		assert not first.called
+		assert not second.called
+		self.advance(0.3)
+		assert not first.called
+		assert second.call_count == 1
+
+	def test_cancelled_call_is_not_called(self):
+		func = unittest.mock.Mock()
+		self.timers.call_later(1, 0.5, func)
+		self.timers.cancel(1)
+		assert self.bigworld.cancelCallback.called
+		assert self.timers.get_pending_count() == 0
+
+	def test_keeps_one_callback_for_many_keys(self):
+		funcs = [unittest.mock.Mock() for _ in range(20)]
+		for key, func in enumerate(funcs):
+			self.timers.call_later(key, 0.5, func)
+		assert self.bigworld.callback.call_count == 1
+		assert self.timers.get_pending_count() == 20
+		self.advance(0.5)
+		assert all(func.called for func in funcs)
+
+	def test_reschedules_for_next_deadline(self):
+		first = unittest.mock.Mock()
+		second = unittest.mock.Mock()
+		self.timers.call_later(1, 0.5, first)
+		self.timers.call_later(2, 1.0, second)
+		self.advance(0.5)
+		assert first.called
+		assert self.bigworld.callback.call_args[0][0] == 0.5
+		self.advance(0.5)
+		assert second.called
+
+	def test_calls_functions_due_within_batch_window_together(self):
+		timers = utils.TimerQueue(batch_window=0.1)
+		self.addCleanup(timers.fini)
+		first = unittest.mock.Mock()
+		second = unittest.mock.Mock()
+		timers.call_later(1, 0.5, first)
+		timers.call_later(2, 0.55, second)
+		self.advance(0.5)
+		assert first.called
+		assert second.called
+
+	def test_notifies_once_after_calling_due_functions(self):
+		calls = []
+		on_dispatched = unittest.mock.Mock(side_effect=lambda: calls.append("dispatched"))
+		self.timers.on_dispatched += on_dispatched
+		self.timers.call_later(1, 0.5, lambda: calls.append(1))
+		self.timers.call_later(2, 0.5, lambda: calls.append(2))
+		self.advance(0.5)
+		assert calls == [1, 2, "dispatched"]
+
+	def test_schedules_once_when_called_function_schedules_again(self):
+		def func():
+			self.timers.call_later(1, 0.5, func)
+		self.timers.call_later(1, 0.5, func)
+		self.advance(0.5)
+		assert self.bigworld.callback.call_count == 2
+		assert not self.bigworld.cancelCallback.called
+
+	def test_cancel_all(self):
+		func = unittest.mock.Mock()
+		self.timers.call_later(1, 0.5, func)
+		self.timers.call_later(2, 0.5, func)
+		self.timers.cancel_all()
+		assert self.bigworld.cancelCallback.called
+		assert self.timers.get_pending_count() == 0